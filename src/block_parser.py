@@ -0,0 +1,286 @@
+# block_parser.py
+"""
+Splits markdown responses into block descriptors, tuples with the kind of
+block followed by its arguments. They don't hold widgets so they can be
+cached and tested without GTK. parse_blocks() takes a finished message,
+BlockTokenizer takes a response while it streams.
+"""
+
+import re
+
+patterns = [
+    r'(?P<online_picture>!\[(?P<label>[^\]]*)\]\((?P<url>.*?)\))',
+    r'(?P<code>```(?P<language>[a-zA-Z0-9_+\-]*)\n(?P<code_content>.*?)\n\s*```)',
+    r'(?P<latex>\\\[\s*(?P<latex_content1>.*?)\s*\\\]|\$\$\s*(?P<latex_content2>.*?)\s*\$\$|\$\s*(?P<latex_content3>.*?)\s*\$)',
+    r'(?P<table>(?:^|(?<=\n))\|[^\n]*\|[\s\xa0]*\n\|[\s\xa0\-|:]*\|[\s\xa0]*\n(?:\|[^\n]*\|(?:[\s\xa0]*\n|$))+)',
+    r'(?P<line>^\s*-{3,}\s*$|\n-{3,}\n)'
+]
+master_regex = re.compile('|'.join(patterns), re.DOTALL | re.MULTILINE)
+# What can show up inside a paragraph, code and tables are left to the tokenizer
+inline_regex = re.compile('|'.join((patterns[0], patterns[2], patterns[4])), re.DOTALL | re.MULTILINE)
+
+fence_pattern = re.compile(r'```([a-zA-Z0-9_+\-]*)\n$')
+code_content_pattern = re.compile(r'(.*?)\n\s*$', re.DOTALL)
+table_header_pattern = re.compile(r'\|[^\n]*\|[\s\xa0]*\n$')
+table_delimiter_pattern = re.compile(r'\|[\s\xa0\-|:]*\|[\s\xa0]*\n$')
+table_row_pattern = re.compile(r'\|[^\n]*\|[\s\xa0]*\n?$')
+# Reasoning some models write in the content, held until it closes
+closing_tags = {'<think>': '</think>', '<|begin_of_thought|>': '<|end_of_thought|>'}
+
+def parse_blocks(raw_content:str, regex:re.Pattern=master_regex) -> tuple:
+    """
+    Splits the content into block descriptors
+    """
+    blocks = []
+    last_idx = 0
+
+    def add_text(content:str):
+        if len(blocks) > 0 and blocks[-1][0] == 'text':
+            blocks[-1] = ('text', blocks[-1][1] + (content,))
+        else:
+            blocks.append(('text', (content,)))
+
+    for match in regex.finditer(raw_content):
+        if match.start() > last_idx:
+            content = raw_content[last_idx:match.start()]
+            if content:
+                add_text(content)
+
+        kind = match.lastgroup
+
+        if kind == 'online_picture':
+            url = match.group('url')
+            # label = match.group('label')
+            if url:
+                blocks.append(('picture', url))
+
+        elif kind == 'code':
+            content = match.group('code_content')
+            language = match.group('language')
+            if content:
+                if language.lower() == 'latex':
+                    blocks.append(('latex', content))
+                else:
+                    blocks.append(('code', content, language))
+
+        elif kind == 'latex':
+            rawcontent = match.group('latex_content3') or ""
+            content = rawcontent.strip()
+            if content:
+                if '\\' in content:
+                    blocks.append(('latex', content))
+            else:
+                rawcontent = match.group('latex_content1') or match.group('latex_content2') or ""
+                content = rawcontent.strip()
+                if content:
+                    if '\\' in content:
+                        blocks.append(('latex', content))
+                    else:
+                        add_text(content)
+
+        elif kind == 'table':
+            content = match.group(0)
+            if content:
+                blocks.append(('table', content))
+        elif kind == 'line':
+            blocks.append(('line',))
+
+        last_idx = match.end()
+
+    if last_idx < len(raw_content):
+        add_text(raw_content[last_idx:])
+
+    return tuple(blocks)
+
+class BlockTokenizer:
+    """
+    Incremental tokenizer for streamed responses. Complete lines go through a
+    state machine (paragraph, code fence, table) that keeps its state between
+    chunks, every block is emitted once when it closes and no line is looked
+    at twice. Pictures, inline LaTeX and separators are matched inside the
+    paragraph they belong to.
+
+    The result is the same as parse_blocks() on the whole response except for
+    inline LaTeX that spans paragraphs ($ across a blank line) or starts
+    before a code fence or table and ends after it. A paragraph with $$ or \[
+    still open is held until it closes, so is a <think> block.
+    """
+
+    def __init__(self):
+        self.partial = '' # Line that hasn't ended yet
+        self.state = 'text'
+        self.lines = [] # Lines of the open paragraph, code or table
+        self.held = [] # Blank lines after a table, they belong to it if another row follows
+        self.fence = None # (opening fence, language) while in a code block
+        self.rows = 0 # Rows of the open table after the delimiter
+        self.filled = False # The paragraph has more than blank lines
+        self.inline_open = False # The paragraph has markers of inline LaTeX or pictures
+        self.closing_tag = None # Closes the open <think> block
+
+    def feed(self, text:str) -> list:
+        """
+        Takes the next piece of the response, returns the descriptors of the
+        blocks it closed
+        """
+        output = []
+        if '\n' not in text:
+            self.partial += text
+            return output
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.process_line(line + '\n', output)
+        return output
+
+    def finish(self) -> list:
+        """
+        Closes whatever is still open once the response is done
+        """
+        output = []
+        if self.partial:
+            line, self.partial = self.partial, ''
+            self.process_line(line, output)
+
+        if self.state == 'code':
+            # A fence that never closed is plain text, its lines are read again
+            fence, lines = self.fence[0], self.lines
+            self.state, self.lines, self.fence = 'text', [fence], None
+            self.filled = self.inline_open = True
+            for line in lines:
+                self.process_line(line, output)
+            output.extend(self.finish())
+        elif self.state == 'table':
+            self.close_table(output)
+        if self.state == 'text' and self.lines:
+            # Only left open by unbalanced math or <think>, nothing comes after it
+            self.closing_tag = None
+            self.close_paragraph(output, master_regex)
+        return output
+
+    def get_pending(self) -> str:
+        """
+        Raw text that hasn't become a block yet
+        """
+        fence = self.fence[0] if self.fence else ''
+        return fence + ''.join(self.lines) + ''.join(self.held) + self.partial
+
+    def close_paragraph(self, output:list, regex:re.Pattern=inline_regex) -> None:
+        text = ''.join(self.lines)
+        if text:
+            output.extend(parse_blocks(text, regex))
+        self.lines, self.filled, self.inline_open = [], False, False
+
+    def close_table(self, output:list) -> None:
+        held = self.held
+        self.state, self.held = 'text', []
+        if self.rows:
+            output.append(('table', ''.join(self.lines + held)))
+            self.lines = []
+        else:
+            # Tables need a row after the delimiter, otherwise they are text
+            self.lines += held
+            self.filled = self.inline_open = True
+
+    def find_table_header(self) -> int:
+        # Blank lines can go between the header and the delimiter
+        for index in range(len(self.lines) - 1, -1, -1):
+            if self.lines[index].strip():
+                return index if table_header_pattern.match(self.lines[index]) else None
+
+    def has_open_math(self) -> bool:
+        text = ''.join(self.lines)
+        return text.count('$$') % 2 == 1 or text.count('\\[') > text.count('\\]')
+
+    def process_line(self, line:str, output:list) -> None:
+        if self.state == 'code':
+            self.process_code_line(line, output)
+        elif self.state == 'table':
+            self.process_table_line(line, output)
+        else:
+            self.process_text_line(line, output)
+
+    def process_code_line(self, line:str, output:list) -> None:
+        stripped = line.lstrip()
+        # The closing fence needs a newline inside the block before it
+        if not stripped.startswith('```') or not self.lines:
+            self.lines.append(line)
+            return
+
+        match = code_content_pattern.match(''.join(self.lines) + line[:len(line) - len(stripped)])
+        content, language = match.group(1), self.fence[1]
+        # Indentation before the opening fence stays as text
+        indentation = self.fence[0][:self.fence[0].index('```')]
+        if indentation:
+            output.append(('text', (indentation,)))
+        if content:
+            if language.lower() == 'latex':
+                output.append(('latex', content))
+            else:
+                output.append(('code', content, language))
+        self.state, self.lines, self.fence = 'text', [], None
+        # Anything after the closing fence is text
+        if stripped[3:]:
+            self.process_text_line(stripped[3:], output)
+
+    def process_table_line(self, line:str, output:list) -> None:
+        if table_row_pattern.match(line):
+            self.lines.extend(self.held)
+            self.held = []
+            self.lines.append(line)
+            self.rows += 1
+        elif not line.strip() and line.endswith('\n'):
+            self.held.append(line)
+        else:
+            self.close_table(output)
+            self.process_text_line(line, output)
+
+    def process_text_line(self, line:str, output:list) -> None:
+        if self.closing_tag:
+            self.lines.append(line)
+            if self.closing_tag in line:
+                self.closing_tag = None
+                self.close_paragraph(output, master_regex)
+            return
+
+        if not self.filled:
+            opening = next((tag for tag in closing_tags if line.lstrip().startswith(tag)), None)
+            if opening and closing_tags.get(opening) not in line:
+                self.lines.append(line)
+                self.filled = True
+                self.closing_tag = closing_tags.get(opening)
+                return
+
+        if self.lines and table_delimiter_pattern.match(line):
+            header = self.find_table_header()
+            if header is not None and not self.has_open_math():
+                table = self.lines[header:] + [line]
+                del self.lines[header:]
+                self.close_paragraph(output)
+                self.state, self.lines, self.rows = 'table', table, 0
+                return
+
+        fence = fence_pattern.search(line)
+        if fence and not (self.inline_open and self.has_open_math()):
+            prefix = line[:fence.start()]
+            if prefix.strip():
+                self.lines.append(prefix)
+                prefix = ''
+            self.close_paragraph(output)
+            self.state = 'code'
+            self.fence = (prefix + line[fence.start():], fence.group(1))
+            return
+
+        if not line.strip():
+            # A blank line ends the paragraph unless a table or display math could still follow
+            if self.filled and self.find_table_header() is None and not self.has_open_math():
+                self.close_paragraph(output)
+            self.lines.append(line)
+            return
+
+        self.lines.append(line)
+        self.filled = True
+        self.inline_open = self.inline_open or any(marker in line for marker in ('$', '\\[', '!['))
+        # Lines are handed over right away unless something in the paragraph
+        # could continue on the next one
+        if not self.inline_open and not line.startswith('|'):
+            self.close_paragraph(output)
@@ -0,0 +1,49 @@
+# cli.py
+"""
+Command line options that don't need the interface, they are handled before
+GTK and the widgets get imported so they return right away.
+"""
+
+import sys
+import importlib.util
+from .constants import ARGUMENT_ACTIVITY_REQUIREMENTS
+
+# Options that take a value, used to avoid mistaking a value for a flag
+VALUE_OPTIONS = ('--add-model', '--activity', '--new-chat', '--select-chat', '--ask')
+
+def get_argument_activities() -> list:
+    return [name for name, modules in ARGUMENT_ACTIVITY_REQUIREMENTS.items() if all(importlib.util.find_spec(module) for module in modules)]
+
+def print_version(version:str) -> None:
+    print(f"Alpaca version {version}")
+
+def print_chats() -> None:
+    from .sql_manager import Instance as SQL
+    SQL.initialize()
+    chats = SQL.get_chats_by_folder(None)
+    if chats:
+        for chat in chats:
+            print(chat[1])
+    else:
+        print()
+
+def print_activities() -> None:
+    print(*get_argument_activities(), sep='\n')
+
+def run(argv:list, version:str) -> bool:
+    """
+    Handles --version, --list-chats and --list-activities, returns False when
+    the arguments need the full application
+    """
+    flags = [arg for i, arg in enumerate(argv) if i == 0 or argv[i - 1] not in VALUE_OPTIONS]
+    if '-h' in flags or '--help' in flags:
+        return False
+    if '--version' in flags:
+        print_version(version)
+    elif '--list-chats' in flags:
+        print_chats()
+    elif '--list-activities' in flags:
+        print_activities()
+    else:
+        return False
+    return True
@@ -0,0 +1,114 @@
+# completion.py
+"""
+Assembles streamed OpenAI compatible chat completions and runs the tool
+calls they ask for. Tool call fragments come split across deltas and are
+merged by their index, reasoning comes in its own deltas.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+class StreamedCompletion:
+    """
+    Collects the deltas of one streamed completion
+    """
+
+    def __init__(self):
+        self.content = ''
+        self.reasoning = ''
+        self.tool_calls = {} # Fragments get merged by their index
+
+    def add_chunk(self, chunk) -> tuple:
+        """
+        Merges a chunk, returns the (content, reasoning) it added
+        """
+        if not chunk.choices or not chunk.choices[0].delta:
+            return '', ''
+        delta = chunk.choices[0].delta
+        # Not part of the official API, used by DeepSeek, vLLM, OpenRouter and others
+        reasoning = getattr(delta, 'reasoning_content', None) or getattr(delta, 'reasoning', None) or ''
+        content = delta.content or ''
+        self.reasoning += reasoning
+        self.content += content
+        for call in delta.tool_calls or []:
+            fragment = self.tool_calls.setdefault(call.index, {'id': '', 'name': '', 'arguments': ''})
+            if call.id:
+                fragment['id'] = call.id
+            if call.function:
+                fragment['name'] += call.function.name or ''
+                fragment['arguments'] += call.function.arguments or ''
+        return content, reasoning
+
+    def get_tool_calls(self) -> list:
+        return [self.tool_calls.get(index) for index in sorted(self.tool_calls)]
+
+    def get_calls(self) -> list:
+        """
+        (name, arguments) tuples for run_tool_calls
+        """
+        calls = []
+        for call in self.get_tool_calls():
+            try:
+                arguments = json.loads(call.get('arguments') or '{}')
+            except json.JSONDecodeError:
+                arguments = {}
+            calls.append((call.get('name'), arguments))
+        return calls
+
+    def get_assistant_message(self) -> dict:
+        return {
+            'role': 'assistant',
+            'content': self.content or None,
+            'tool_calls': [{
+                'id': call.get('id'),
+                'type': 'function',
+                'function': {'name': call.get('name'), 'arguments': call.get('arguments')}
+            } for call in self.get_tool_calls()]
+        }
+
+    def get_tool_messages(self, tool_responses:list) -> list:
+        return [{
+            'role': 'tool',
+            'tool_call_id': call.get('id'),
+            'content': str(tool_response)
+        } for call, tool_response in zip(self.get_tool_calls(), tool_responses)]
+
+def run_tool_calls(calls:list, available_tools:dict, messages:list, bot_message, on_response=None) -> list:
+    """
+    Runs a batch of tool calls, each call is a (name, arguments) tuple.
+    Calls to tools marked as parallel run at the same time, the rest (tools
+    that need the user) run one after the other. Returns the responses in the
+    same order as the calls, on_response(tool, arguments, response) is called
+    after each one.
+    """
+    responses = [''] * len(calls)
+    groups = []
+    sequential = {}
+    for index, (name, arguments) in enumerate(calls):
+        tool = available_tools.get(name)
+        if tool and not tool.parallel:
+            if name not in sequential:
+                sequential[name] = []
+                groups.append(sequential[name])
+            sequential.get(name).append((index, name, arguments))
+        else:
+            groups.append([(index, name, arguments)])
+
+    def run_calls(group:list):
+        for index, name, arguments in group:
+            tool = available_tools.get(name)
+            if not tool:
+                responses[index] = 'Error: Tool "{}" is not available'.format(name)
+                continue
+            try:
+                responses[index] = tool.run(arguments, messages, bot_message)
+            except Exception as e:
+                responses[index] = 'Error: {}'.format(e)
+            if on_response:
+                on_response(tool, arguments, responses[index])
+
+    with ThreadPoolExecutor(max_workers=max(1, len(groups)), thread_name_prefix='ToolCall') as executor:
+        for future in [executor.submit(run_calls, group) for group in groups]:
+            future.result()
+
+    return responses
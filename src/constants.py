@@ -385,6 +385,17 @@ return (
 IN_FLATPAK = bool(os.getenv("FLATPAK_ID"))
 IN_SNAP = bool(os.getenv("FLATPAK_ID"))
 
+# Activities that can be launched with --activity and the optional modules they need
+ARGUMENT_ACTIVITY_REQUIREMENTS = {
+    'web-browser': (),
+    'terminal': (),
+    'attachment-creator': (),
+    'camera': (),
+    'live-chat': ('kokoro', 'sounddevice'),
+    'transcriber': ('whisper',),
+    'background-remover': ('rembg',)
+}
+
 TITLE_GENERATION_PROMPT_OLLAMA = (
     "You are an assistant that generates short chat titles based on the "
     "prompt. If you want to, you can add a single emoji. Format the response as a single JSON object."
@@ -394,6 +405,10 @@ TITLE_GENERATION_PROMPT_OPENAI = (
     "message from a user. If you want to, you can add a single emoji."
 )
 MAX_TOKENS_TITLE_GENERATION = 31
+RETRIEVAL_PROMPT = (
+    "These excerpts from the attached documents and from previous conversations "
+    "might be relevant to the next message, use them only if they help answer it."
+)
 
 LEGAL_NOTICE = """Alpaca is an independent client interface designed to connect to various third-party AI services.
 All underlying AI models and instances are the intellectual property of their respective providers.
@@ -0,0 +1,145 @@
+# documents.py
+"""
+Splits extracted documents into page and section chunks and picks which of
+them fit in the model's context, so a long PDF doesn't get pasted whole into
+every request.
+"""
+
+import re, math
+from functools import lru_cache
+
+DOCUMENT_TYPES = ('plain_text', 'pdf', 'docx', 'pptx', 'odt', 'website', 'youtube')
+MAX_CHUNK_TOKENS = 512
+CHARS_PER_TOKEN = 4 # Rough average for English text, good enough for budgeting
+CONTEXT_SHARE = 0.75 # The rest of the context is left for the response
+MIN_DOCUMENT_SHARE = 0.125
+
+SLIDE_PATTERN = re.compile(r'^<!-- Slide number: (\d+) -->\s*$', re.M)
+HEADING_PATTERN = re.compile(r'^#{1,3} +(.+)$', re.M)
+WORD_PATTERN = re.compile(r'\w{3,}')
+
+def estimate_tokens(text:str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def split_sections(text:str) -> list:
+    """
+    Returns (title, content) tuples using page breaks (PDF), slide markers
+    (pptx) or markdown headings, whichever the text has
+    """
+    if '\f' in text:
+        return [(_('Page {}').format(i + 1), page) for i, page in enumerate(text.split('\f'))]
+
+    for pattern, title_format in ((SLIDE_PATTERN, _('Slide {}')), (HEADING_PATTERN, '{}')):
+        matches = list(pattern.finditer(text))
+        if matches:
+            sections = [('', text[:matches[0].start()])]
+            for i, match in enumerate(matches):
+                end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+                sections.append((title_format.format(match.group(1).strip()), text[match.start():end]))
+            return sections
+
+    return [('', text)]
+
+def split_long(content:str, max_tokens:int=MAX_CHUNK_TOKENS) -> list:
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(content) <= max_chars:
+        return [content]
+    parts = []
+    current = ''
+    for paragraph in re.split(r'\n\s*\n', content):
+        while len(paragraph) > max_chars:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            parts.append(current)
+            current = ''
+        current = '{}\n\n{}'.format(current, paragraph) if current else paragraph
+    if current:
+        parts.append(current)
+    return parts
+
+@lru_cache(maxsize=64)
+def chunk_document(text:str) -> tuple:
+    """
+    Chunks of at most MAX_CHUNK_TOKENS as (title, content, tokens) tuples in
+    document order
+    """
+    chunks = []
+    for title, section in split_sections(text):
+        for part in split_long(section.strip()):
+            if part.strip():
+                chunks.append((title, part, estimate_tokens(part)))
+    return tuple(chunks)
+
+def get_terms(text:str) -> list:
+    return WORD_PATTERN.findall(text.lower())
+
+def score_chunks(chunks:list, query:str) -> list:
+    """
+    BM25 relevance of every chunk to the query
+    """
+    query_terms = set(get_terms(query))
+    if not query_terms or not chunks:
+        return [0.0] * len(chunks)
+
+    chunk_terms = [get_terms(chunk[1]) for chunk in chunks]
+    average_length = sum(len(terms) for terms in chunk_terms) / len(chunk_terms) or 1
+    document_frequency = {term: sum(1 for terms in chunk_terms if term in terms) for term in query_terms}
+    scores = []
+    for terms in chunk_terms:
+        score = 0.0
+        for term in query_terms:
+            frequency = terms.count(term)
+            if frequency:
+                idf = math.log(1 + (len(chunks) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+                score += idf * frequency * 2.2 / (frequency + 1.2 * (0.25 + 0.75 * len(terms) / average_length))
+        scores.append(score)
+    return scores
+
+def get_document_budget(num_ctx:int, used_tokens:int) -> int:
+    return max(int(num_ctx * MIN_DOCUMENT_SHARE), int(num_ctx * CONTEXT_SHARE) - used_tokens)
+
+def fit_documents(documents:list, query:str, budget:int) -> list:
+    """
+    Receives the text of every document in the chat (oldest first) and
+    returns them trimmed to the chunks that fit in the budget. Chunks are
+    picked by relevance to the query, ties go to the most recent document and
+    to the start of it. Documents that already fit are returned untouched.
+    """
+    if sum(estimate_tokens(text) for text in documents) <= budget:
+        return documents
+
+    indexed_chunks = [(doc_index, chunk_index, chunk) for doc_index, text in enumerate(documents) for chunk_index, chunk in enumerate(chunk_document(text))]
+    scores = score_chunks([chunk for doc_index, chunk_index, chunk in indexed_chunks], query)
+    order = sorted(range(len(indexed_chunks)), key=lambda i: (-scores[i], -indexed_chunks[i][0], indexed_chunks[i][1]))
+
+    selected = set()
+    used = 0
+    for i in order:
+        tokens = indexed_chunks[i][2][2]
+        if used + tokens <= budget:
+            selected.add(i)
+            used += tokens
+
+    results = [[] for text in documents]
+    previous = {}
+    for i, (doc_index, chunk_index, (title, content, tokens)) in enumerate(indexed_chunks):
+        if i not in selected:
+            continue
+        if chunk_index != previous.get(doc_index, -1) + 1:
+            results[doc_index].append('[…]')
+        results[doc_index].append('[{}]\n{}'.format(title, content) if title else content)
+        previous[doc_index] = chunk_index
+
+    fitted = []
+    for doc_index, parts in enumerate(results):
+        if not parts:
+            fitted.append(_('[Left out to fit the context window]'))
+            continue
+        if previous.get(doc_index) != len(chunk_document(documents[doc_index])) - 1:
+            parts.append('[…]')
+        fitted.append('\n\n'.join(parts))
+    return fitted
@@ -0,0 +1,215 @@
+# extraction.py
+"""
+Text extraction for document attachments. Documents are converted in worker
+processes so parsing a large PDF doesn't hold the interpreter lock the UI
+needs, converters are created once per worker and results are cached on disk
+by the SHA-256 of the file.
+"""
+
+import os, hashlib, threading, logging, multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .constants import cache_dir
+
+logger = logging.getLogger(__name__)
+
+PROCESS_TYPES = ('pdf', 'docx', 'pptx', 'odt') # CPU bound, parsed in worker processes
+CACHED_TYPES = PROCESS_TYPES
+CACHE_DIR = os.path.join(cache_dir, 'extraction')
+MAX_PROCESS_WORKERS = max(1, min(4, (os.cpu_count() or 2) // 2))
+MAX_CACHE_SIZE = 256 * 1024 * 1024 # Bytes, least recently used files go first
+MAX_FILE_HASHES = 1024
+
+lock = threading.Lock()
+dispatcher = ThreadPoolExecutor(max_workers=4, thread_name_prefix='Extraction')
+process_pool = None
+process_pool_available = True
+file_hashes = OrderedDict() # (path, size, mtime_ns): sha256
+local = threading.local()
+
+################
+## CONVERTERS ##
+################
+
+# These run inside the worker processes, keep them free of GTK imports
+
+def get_converter():
+    converter = getattr(local, 'converter', None)
+    if converter is None:
+        from markitdown import MarkItDown
+        converter = MarkItDown(enable_plugins=False)
+        local.converter = converter
+    return converter
+
+def convert_odt(file_path:str) -> str:
+    import odf.opendocument as odfopen
+    import odf.table as odftable
+    doc = odfopen.load(file_path)
+    markdown_elements = []
+    for child in doc.text.childNodes:
+        if child.qname[1] == 'p' or child.qname[1] == 'span':
+            markdown_elements.append(str(child))
+        elif child.qname[1] == 'h':
+            markdown_elements.append('# {}'.format(str(child)))
+        elif child.qname[1] == 'table':
+            generated_table = []
+            column_sizes = []
+            for row in child.getElementsByType(odftable.TableRow):
+                generated_table.append([])
+                for column_n, cell in enumerate(row.getElementsByType(odftable.TableCell)):
+                    if column_n + 1 > len(column_sizes):
+                        column_sizes.append(0)
+                    if len(str(cell)) > column_sizes[column_n]:
+                        column_sizes[column_n] = len(str(cell))
+                    generated_table[-1].append(str(cell))
+            generated_table.insert(1, [])
+            for column_n in range(len(generated_table[0])):
+                generated_table[1].append('-' * column_sizes[column_n])
+            table_str = ''
+            for row in generated_table:
+                for column_n, cell in enumerate(row):
+                    table_str += '| {} '.format(cell.ljust(column_sizes[column_n], ' '))
+                table_str += '|\n'
+            markdown_elements.append(table_str)
+    return '\n\n'.join(markdown_elements)
+
+def convert(file_type:str, file_path:str) -> str:
+    if file_type in ('plain_text', 'code'):
+        with open(file_path, 'r') as f:
+            return f.read()
+    elif file_type == 'odt':
+        return convert_odt(file_path)
+    elif file_type in ('pdf', 'docx', 'pptx', 'youtube'):
+        return get_converter().convert(file_path).text_content
+
+###########
+## CACHE ##
+###########
+
+def get_file_hash(file_path:str) -> str:
+    stat = os.stat(file_path)
+    key = (os.path.realpath(file_path), stat.st_size, stat.st_mtime_ns)
+    with lock:
+        file_hash = file_hashes.get(key)
+        if file_hash:
+            file_hashes.move_to_end(key)
+            return file_hash
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1048576), b''):
+            digest.update(block)
+    with lock:
+        file_hashes[key] = digest.hexdigest()
+        while len(file_hashes) > MAX_FILE_HASHES:
+            file_hashes.popitem(last=False)
+    return digest.hexdigest()
+
+def get_cache_path(file_type:str, file_hash:str) -> str:
+    return os.path.join(CACHE_DIR, '{}.{}.md'.format(file_hash, file_type))
+
+def read_cache(cache_path:str) -> str:
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        try:
+            os.utime(cache_path) # Marks it as recently used
+        except OSError:
+            pass
+        return content
+
+def write_cache(cache_path:str, content:str) -> None:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Written aside and renamed so parallel extractions never see half a file
+        temp_path = '{}.{}.tmp'.format(cache_path, threading.get_ident())
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, cache_path)
+        trim_cache(CACHE_DIR, MAX_CACHE_SIZE)
+    except Exception as e:
+        logger.error(e)
+
+def trim_cache(directory:str, max_size:int) -> None:
+    """
+    Removes the least recently used files of a cache directory until it
+    fits in max_size bytes
+    """
+    files = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and not entry.name.endswith('.tmp'):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(file[1] for file in files)
+    for mtime, size, path in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+#############
+## SERVICE ##
+#############
+
+def get_process_pool():
+    global process_pool
+    with lock:
+        if process_pool is None and process_pool_available:
+            # Forking a process that runs GTK isn't safe, workers start clean
+            process_pool = ProcessPoolExecutor(
+                max_workers=MAX_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return process_pool
+
+def run_conversion(file_type:str, file_path:str) -> str:
+    global process_pool, process_pool_available
+    pool = get_process_pool() if file_type in PROCESS_TYPES else None
+    if pool:
+        try:
+            return pool.submit(convert, file_type, file_path).result()
+        except (BrokenProcessPool, OSError) as e:
+            logger.error('Document workers unavailable, converting in process: {}'.format(e))
+            with lock:
+                process_pool_available = False
+                process_pool = None
+    return convert(file_type, file_path)
+
+def extract_document(file_type:str, file_path:str, progress_callback:callable=None) -> str:
+    """
+    Returns the text of a document, blocks until it's extracted.
+    progress_callback receives 'reading' and 'extracting' as the work moves on.
+    """
+    if progress_callback:
+        progress_callback('reading')
+    cache_path = None
+    if file_type in CACHED_TYPES:
+        cache_path = get_cache_path(file_type, get_file_hash(file_path))
+        content = read_cache(cache_path)
+        if content is not None:
+            return content
+
+    if progress_callback:
+        progress_callback('extracting')
+    content = run_conversion(file_type, file_path)
+    if cache_path and content:
+        write_cache(cache_path, content)
+    return content
+
+def extract(file_type:str, file_path:str, progress_callback:callable=None):
+    """
+    Queues the extraction and returns a Future with the text, several files
+    are extracted at the same time
+    """
+    return dispatcher.submit(extract_document, file_type, file_path, progress_callback)
+
+def shutdown() -> None:
+    global process_pool
+    with lock:
+        pool, process_pool = process_pool, None
+    if pool:
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,138 @@
+# images.py
+"""
+Resizing for image attachments. The model gets images at 'max-image-size'
+as PNG (keeping text chunks like character cards), chats show smaller
+previews cached on disk by the SHA-256 of the image (the id of its blob).
+JPEGs are decoded at a reduced scale when they are much bigger than the
+target and all the work runs in a small pool instead of the calling thread.
+"""
+
+import os, io, base64, hashlib, threading, logging
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from .constants import cache_dir
+from .extraction import trim_cache
+from .sql_manager import Instance as SQL
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_SIZE = (1440, 480) # Previews are shown 240px tall, doubled for scaled displays
+CACHE_DIR = os.path.join(cache_dir, 'thumbnails')
+MAX_CACHE_SIZE = 128 * 1024 * 1024 # Bytes, least recently used previews go first
+
+pool = ThreadPoolExecutor(max_workers=max(2, min(4, os.cpu_count() or 2)), thread_name_prefix='Images')
+
+def fit_size(size:tuple, box:tuple) -> tuple:
+    """
+    Size that fits in the box keeping the aspect ratio, images are never
+    enlarged
+    """
+    width, height = size
+    ratio = min(box[0] / width, box[1] / height, 1)
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+def load(img:Image.Image, box:tuple) -> None:
+    if img.format == 'JPEG':
+        # Lets libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the box
+        img.draft(img.mode, box)
+    img.load()
+
+def resize(img:Image.Image, box:tuple) -> Image.Image:
+    size = fit_size(img.size, box)
+    if size == img.size:
+        return img
+    return img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+def encode_model_input(image_path:str, max_size:int) -> bytes:
+    with Image.open(image_path) as img:
+        load(img, (max_size, max_size))
+        metadata = PngInfo()
+        for key, value in (img.info or {}).items():
+            if key not in ('exif', 'dpi', 'icc_profile'):
+                metadata.add_text(key, str(value))
+
+        resized_img = resize(img, (max_size, max_size))
+        if resized_img.mode == 'CMYK':
+            resized_img = resized_img.convert('RGB')
+        with io.BytesIO() as output:
+            resized_img.save(
+                output,
+                format="PNG",
+                pnginfo=metadata,
+                exif=img.info.get('exif'),
+                dpi=img.info.get('dpi')
+            )
+            return output.getvalue()
+
+def extract_image(image_path:str, max_size:int) -> str:
+    """
+    Returns the image as base64 PNG resized to fit max_size
+    """
+    return base64.b64encode(encode_model_input(image_path, max_size)).decode('utf-8')
+
+def extract(image_path:str, max_size:int):
+    """
+    Queues extract_image and returns a Future with the result
+    """
+    return pool.submit(extract_image, image_path, max_size)
+
+def encode_preview(image_data:bytes) -> bytes:
+    with Image.open(io.BytesIO(image_data)) as img:
+        if fit_size(img.size, PREVIEW_SIZE) == img.size:
+            return image_data
+        load(img, PREVIEW_SIZE)
+        preview = resize(img, PREVIEW_SIZE)
+        with io.BytesIO() as output:
+            if preview.mode in ('RGBA', 'LA', 'PA') or 'transparency' in preview.info:
+                preview.save(output, format='PNG')
+            else:
+                preview.convert('RGB').save(output, format='JPEG', quality=85)
+            return output.getvalue()
+
+def get_preview(image_data:bytes, image_hash:str=None) -> bytes:
+    """
+    Returns the bytes of a preview of the image, small images are their own
+    preview
+    """
+    image_hash = image_hash or hashlib.sha256(image_data).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, image_hash)
+    if os.path.isfile(cache_path):
+        with open(cache_path, 'rb') as f:
+            preview = f.read()
+        try:
+            os.utime(cache_path) # Marks it as recently used
+        except OSError:
+            pass
+        return preview
+
+    preview = encode_preview(image_data)
+    if preview is not image_data:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            temp_path = '{}.{}.tmp'.format(cache_path, threading.get_ident())
+            with open(temp_path, 'wb') as f:
+                f.write(preview)
+            os.replace(temp_path, cache_path)
+            trim_cache(CACHE_DIR, MAX_CACHE_SIZE)
+        except Exception as e:
+            logger.error(e)
+    return preview
+
+def remove_unused_previews() -> None:
+    """
+    Removes the previews of images no attachment uses anymore, their blob
+    was dropped once its refcount reached zero. Runs with the database
+    maintenance.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return
+    names = [entry.name for entry in os.scandir(CACHE_DIR) if entry.is_file() and not entry.name.endswith('.tmp')]
+    used = SQL.get_blob_ids(names)
+    for name in names:
+        if name not in used:
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+            except OSError:
+                pass
@@ -36,9 +36,9 @@ GtkSource.init()
 GLib.set_prgname("Alpaca")
 GLib.set_application_name("Alpaca")
 
-from .widgets import activities, models
+from . import cli, extraction
 from .constants import TRANSLATORS, LEGAL_NOTICE, cache_dir, data_dir, config_dir, source_dir
-from .sql_manager import Instance as SQL
+from .sql_manager import Instance as SQL, connection_manager
 
 SQL.initialize()
 
@@ -100,12 +100,19 @@ class AlpacaService:
     def PresentAsk(self):
         self.app.create_quick_ask().present()
 
-    def Open(self, chat_name:str):
+    def Open(self, chat:str):
+        # chat can be either the id or the name of a chat in any folder
         navigationview = self.app.props.active_window.chat_list_navigationview
         page = list(navigationview.get_navigation_stack())[0]
         navigationview.pop_to_page(page)
+        for folder_id in SQL.get_chat_folder_path(chat):
+            folder_row = next((row for row in list(page.folder_list_box) if row.folder_id == folder_id), None)
+            if not folder_row:
+                break
+            folder_row.open_folder()
+            page = navigationview.find_page(folder_id)
         for chat_row in list(page.chat_list_box):
-            if chat_row.get_name() == chat_name:
+            if chat in (chat_row.chat.chat_id, chat_row.get_name()):
                 page.chat_list_box.select_row(chat_row)
                 self.Present()
                 return
@@ -121,11 +128,13 @@ class AlpacaService:
         quick_ask_window.write_and_send_message(message)
 
     def Activity(self, activity_name:str):
+        from .widgets import activities
         page = activities.ARGUMENT_ACTIVITIES.get(activity_name)
         if page:
             activities.launch_detached_activity(page(), self.app.props.active_window)
 
     def Model(self, model_name:str):
+        from .widgets import models
         main_window = self.app.props.active_window
 
         for dialog in main_window.get_dialogs():
@@ -176,6 +185,8 @@ class AlpacaApplication(Adw.Application):
             app_service.PresentAsk()
         elif self.args.ask:
             app_service.Ask(self.args.ask)
+        elif self.args.select_chat:
+            app_service.Open(self.args.select_chat)
         elif self.args.live_chat:  # DEPRECATED
             logger.warning('--live-chat is deprecated, use --activity live-chat')
             app_service.Activity('live-chat')
@@ -267,6 +278,7 @@ def main(version):
     parser.add_argument('--add-model', type=str, metavar='MODEL', help='add a model from the active instance by the name')
     parser.add_argument('--activity', type=str, metavar='ACTIVITY', help='open an activity directly')
     parser.add_argument('--new-chat', type=str, metavar='CHAT', help='start a new chat with the specified title')
+    parser.add_argument('--select-chat', type=str, metavar='CHAT', help='open an existing chat by its id or title')
     parser.add_argument('--ask', type=str, metavar='"MESSAGE"', help='open Quick Ask with a message')
 
     parser.add_argument('--live-chat', action='store_true', help='open Live Chat (DEPRECATED, USE --activity live-chat)')
@@ -274,20 +286,15 @@ def main(version):
     args = parser.parse_args()
 
     if args.version:
-        print(f"Alpaca version {version}")
+        cli.print_version(version)
         sys.exit(0)
 
     if args.list_chats:
-        chats = SQL.get_chats_by_folder(None)
-        if chats:
-            for chat in chats:
-                print(chat[1])
-        else:
-            print()
+        cli.print_chats()
         sys.exit(0)
 
     if args.list_activities:
-        print(*activities.ARGUMENT_ACTIVITIES, sep='\n')
+        cli.print_activities()
         sys.exit(0)
 
     logger.info(f"Alpaca version: {version}")
@@ -302,4 +309,7 @@ def main(version):
     except Exception as e:
         pass
 
-    return application.run([])
+    exit_status = application.run([])
+    extraction.shutdown()
+    connection_manager.close_all()
+    return exit_status
@@ -0,0 +1,105 @@
+# network.py
+"""
+Shared HTTP connection pools, every instance and download borrows from them
+so repeated requests to the same host reuse keep-alive connections instead
+of paying a new TCP/TLS handshake each time.
+"""
+
+import threading, importlib.util, http.cookiejar, logging
+
+logger = logging.getLogger(__name__)
+
+# Per host connection limit, hosts kept by the requests session and default
+# (connect, read) timeouts in seconds
+MAX_CONNECTIONS_PER_HOST = 10
+MAX_HOSTS = 20
+TIMEOUT = (10, 60)
+KEEPALIVE_EXPIRY = 60
+
+lock = threading.Lock()
+session = None
+transports = {}
+
+def get_session():
+    """
+    requests session for plain downloads and API calls. It is shared by every
+    thread instead of being thread local so the pools are too, urllib3 pools
+    are thread safe and the cookie jar (the state that isn't) never stores
+    anything since no caller needs cookies.
+    """
+    global session
+    with lock:
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_connections=MAX_HOSTS, pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+def get(url:str, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().get(url, **kwargs)
+
+def get_transport(verify:bool=True):
+    """
+    httpx transport shared by the Ollama and OpenAI clients, one per SSL
+    verification mode since that setting lives in the transport. httpx.Limits
+    applies to a whole pool, so requests are routed to a pool per host to make
+    the limit per host and keep a busy instance from starving the others.
+
+    httpx skips the proxy environment variables once a client gets a
+    transport, so they are applied here: requests a proxy applies to share a
+    pool per proxy, NO_PROXY hosts connect directly.
+    """
+    with lock:
+        if verify not in transports:
+            import httpx
+            from httpx._utils import get_environment_proxies, URLPattern
+
+            class SharedTransport(httpx.BaseTransport):
+                def __init__(self):
+                    self.pools = {}
+                    self.pools_lock = threading.Lock()
+                    # Most specific pattern first, same order httpx gives its mounts
+                    self.proxies = sorted(((URLPattern(pattern), proxy) for pattern, proxy in get_environment_proxies().items()), key=lambda item: item[0])
+
+                def get_proxy(self, url:httpx.URL) -> str:
+                    return next((proxy for pattern, proxy in self.proxies if pattern.matches(url)), None)
+
+                def get_pool(self, url:httpx.URL) -> httpx.HTTPTransport:
+                    proxy = self.get_proxy(url)
+                    key = ('proxy', proxy) if proxy else (url.scheme, url.host, url.port)
+                    with self.pools_lock:
+                        if key not in self.pools:
+                            self.pools[key] = httpx.HTTPTransport(
+                                verify=verify,
+                                proxy=proxy,
+                                http2=bool(importlib.util.find_spec('h2')),
+                                limits=httpx.Limits(
+                                    max_connections=MAX_CONNECTIONS_PER_HOST,
+                                    max_keepalive_connections=MAX_CONNECTIONS_PER_HOST,
+                                    keepalive_expiry=KEEPALIVE_EXPIRY
+                                )
+                            )
+                        return self.pools.get(key)
+
+                def handle_request(self, request:httpx.Request) -> httpx.Response:
+                    return self.get_pool(request.url).handle_request(request)
+
+                # Clients come and go when instances restart, the pools stay
+                def close(self):
+                    pass
+
+            transports[verify] = SharedTransport()
+        return transports.get(verify)
+
+def get_http_client(verify:bool=True):
+    """
+    httpx client for openai.OpenAI, cheap to create since the connections
+    live in the shared transport
+    """
+    import httpx
+    return httpx.Client(transport=get_transport(verify), timeout=httpx.Timeout(600, connect=TIMEOUT[0]), follow_redirects=True)
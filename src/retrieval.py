@@ -0,0 +1,188 @@
+# retrieval.py
+"""
+Embedding index that brings relevant chunks of past conversations and their
+documents into the prompt. Vectors are normalized float16 rows kept
+in one memory mapped file per embedding model next to alpaca.db, the
+embedding table maps each row to the message or attachment chunk it came from.
+"""
+
+import os, hashlib, threading, logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from .constants import data_dir
+from .sql_manager import Instance as SQL
+from . import documents
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_DIR = os.path.join(data_dir, 'embeddings')
+BATCH_SIZE = 32 # Chunks per embed request
+BACKGROUND_BATCHES = 8 # Batches indexed per background run
+TOP_K = 6
+MIN_SCORE = 0.3
+
+class EmbeddingIndex:
+    """
+    Append only vector file, rows of deleted content are skipped until the
+    file is compacted.
+    """
+
+    def __init__(self, model:str):
+        self.model = model
+        self.lock = threading.RLock()
+        self.prefix = hashlib.sha256(model.encode()).hexdigest()[:16]
+        self.dimensions = None
+        self.vectors = None
+        os.makedirs(EMBEDDINGS_DIR, exist_ok=True)
+        for file_name in os.listdir(EMBEDDINGS_DIR):
+            if file_name.startswith(self.prefix + '-') and file_name.endswith('.f16'):
+                self.dimensions = int(file_name[len(self.prefix) + 1:-4])
+
+    def get_path(self) -> str:
+        return os.path.join(EMBEDDINGS_DIR, '{}-{}.f16'.format(self.prefix, self.dimensions))
+
+    def get_vectors(self) -> np.ndarray:
+        if not self.dimensions or not os.path.isfile(self.get_path()):
+            return np.zeros((0, self.dimensions or 1), dtype=np.float16)
+        rows = os.path.getsize(self.get_path()) // (self.dimensions * 2)
+        if self.vectors is None or len(self.vectors) != rows:
+            self.vectors = np.memmap(self.get_path(), dtype=np.float16, mode='r', shape=(rows, self.dimensions)) if rows else np.zeros((0, self.dimensions), dtype=np.float16)
+        return self.vectors
+
+    def append(self, vectors:list) -> int:
+        """
+        Adds the vectors at the end of the file, returns the position of the first one
+        """
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        with self.lock:
+            if self.dimensions is None:
+                self.dimensions = matrix.shape[1]
+            elif matrix.shape[1] != self.dimensions:
+                raise ValueError('Embedding size changed from {} to {}'.format(self.dimensions, matrix.shape[1]))
+            start = len(self.get_vectors())
+            with open(self.get_path(), 'ab') as f:
+                f.write(matrix.astype(np.float16).tobytes())
+            return start
+
+    def search(self, query_vector:list, positions:list, k:int) -> list:
+        """
+        Returns (position, score) of the k rows closest to the query
+        """
+        vectors = self.get_vectors()
+        positions = np.asarray([p for p in positions if 0 <= p < len(vectors)], dtype=np.int64)
+        if len(positions) == 0:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        scores = vectors[positions].astype(np.float32) @ query
+        best = np.argsort(-scores)[:k]
+        return [(int(positions[i]), float(scores[i])) for i in best]
+
+    def compact(self) -> None:
+        """
+        Rewrites the file without the rows of deleted content once they are
+        the majority
+        """
+        with self.lock:
+            vectors = self.get_vectors()
+            live_positions = [p for p in SQL.get_embedding_positions(self.model) if p < len(vectors)]
+            if len(vectors) == 0 or len(live_positions) * 2 > len(vectors):
+                return
+            logger.info('Compacting embeddings of {} ({} of {} rows in use)'.format(self.model, len(live_positions), len(vectors)))
+            live = np.array(vectors[live_positions])
+            temp_path = self.get_path() + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(live.tobytes())
+            self.vectors = None
+            os.replace(temp_path, self.get_path())
+            # Rows pointing past the end of the file lost their vector, they are dropped
+            SQL.move_embeddings(self.model, {old: new for new, old in enumerate(live_positions)})
+
+indexes = {}
+indexes_lock = threading.Lock()
+background_indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='EmbeddingIndexer')
+background_pending = set()
+
+def get_index(model:str) -> EmbeddingIndex:
+    with indexes_lock:
+        if model not in indexes:
+            indexes[model] = EmbeddingIndex(model)
+        return indexes.get(model)
+
+def index_sources(embed:callable, model:str, sources:list) -> None:
+    """
+    Chunks and embeds (source_type, source_id, chat_id, content) sources,
+    sending BATCH_SIZE chunks per request
+    """
+    index = get_index(model)
+    chunks = []
+    for source_type, source_id, chat_id, content in sources:
+        for chunk_index, (title, text, tokens) in enumerate(documents.chunk_document(content)):
+            chunks.append((chat_id, source_type, source_id, chunk_index, text))
+
+    for i in range(0, len(chunks), BATCH_SIZE):
+        batch = chunks[i:i+BATCH_SIZE]
+        vectors = embed(model, [chunk[4] for chunk in batch])
+        # Rows must be recorded before a compaction can look at them
+        with index.lock:
+            start = index.append(vectors)
+            SQL.insert_embeddings([(model, *chunk[:4], start + n) for n, chunk in enumerate(batch)])
+
+def index_history(embed:callable, model:str, chat_id:str) -> None:
+    try:
+        for i in range(BACKGROUND_BATCHES):
+            sources = SQL.get_unembedded_sources(model, documents.DOCUMENT_TYPES, exclude_chat_id=chat_id, limit=BATCH_SIZE)
+            if not sources:
+                break
+            index_sources(embed, model, sources)
+        get_index(model).compact()
+    except Exception as e:
+        logger.error(e)
+    finally:
+        background_pending.discard(model)
+
+def retrieve(embed:callable, model:str, chat_id:str, query:str, k:int=TOP_K) -> list:
+    """
+    Returns up to k chunks of other chats relevant to the query, the chat's
+    own messages and documents are already in the prompt. Past conversations
+    are indexed a few batches at a time in the background so the response
+    isn't held back.
+    """
+    if not query.strip():
+        return []
+
+    if model not in background_pending:
+        background_pending.add(model)
+        background_indexer.submit(index_history, embed, model, chat_id)
+
+    query_vector = embed(model, [query])[0]
+    index = get_index(model)
+    with index.lock:
+        rows = {row[0]: row[1:] for row in SQL.get_embeddings(model, chat_id)}
+        hits = index.search(query_vector, list(rows.keys()), k)
+
+    results = []
+    for position, score in hits:
+        if score < MIN_SCORE:
+            break
+        source_type, source_id, chunk_index = rows.get(position)
+        chunks = documents.chunk_document(SQL.get_source_content(source_type, source_id))
+        if chunk_index < len(chunks):
+            results.append(chunks[chunk_index][1])
+    return results
+
+def fit_excerpts(excerpts:list, budget:int) -> list:
+    """
+    Keeps the most relevant excerpts that fit in the token budget
+    """
+    fitted = []
+    used = 0
+    for excerpt in excerpts:
+        tokens = documents.estimate_tokens(excerpt)
+        if used + tokens > budget:
+            break
+        fitted.append(excerpt)
+        used += tokens
+    return fitted
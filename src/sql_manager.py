@@ -8,17 +8,23 @@ for storing chats, instances, preferences and more.
 from typing import Union
 import sqlite3
 import uuid
+import base64
+import hashlib
 import datetime
 import os
 import shutil
 import json
 import sys
+import time
+import threading
+import logging
 
-from . import widgets as Widgets
 from .constants import data_dir
-from gi.repository import Gio, GLib
+
+logger = logging.getLogger(__name__)
 
 def format_datetime(dt:datetime.datetime) -> str:
+    from gi.repository import GLib
     date = GLib.DateTime.new(
         GLib.DateTime.new_now_local().get_timezone(),
         dt.year,
@@ -119,6 +125,157 @@ def prettify_model_name(name:str, separated:bool=False) -> str or tuple:
             else:
                 return name.replace('-', ' ').title()
 
+class MetricsCursor(sqlite3.Cursor):
+    """
+    Cursor that reports every statement and the time spent inside SQLite
+    to the connection manager.
+    """
+
+    def _measure(self, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            connection_manager.record(time.perf_counter() - start)
+
+    def execute(self, *args):
+        return self._measure(super().execute, *args)
+
+    def executemany(self, *args):
+        return self._measure(super().executemany, *args)
+
+    def executescript(self, *args):
+        return self._measure(super().executescript, *args)
+
+    def fetchone(self):
+        return self._measure(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._measure(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._measure(super().fetchall)
+
+class SQLiteConnectionManager:
+    """
+    Keeps a pool of long-lived SQLite connections, one per thread, so
+    entering SQLiteConnection doesn't open and close the database each time.
+    Connections belonging to finished threads are closed on the next acquire.
+    """
+
+    cached_statements: int = 256
+    pragmas: dict = {
+        'synchronous': 'NORMAL', # Safe with WAL, only the last commits can be lost on power failure
+        'cache_size': -16000, # KiB
+        'mmap_size': 134217728,
+        'temp_store': 'MEMORY'
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.connections = {} # thread ident: (thread, connection)
+        self.last_activity = time.monotonic()
+        self.stats = {
+            'connections_opened': 0,
+            'statements': 0,
+            'time_spent': 0.0,
+            'max_statement_time': 0.0
+        }
+
+    def connect(self, sql_path:str) -> sqlite3.Connection:
+        sqlite_con = sqlite3.connect(sql_path, cached_statements=self.cached_statements, check_same_thread=False)
+        for pragma, value in self.pragmas.items():
+            sqlite_con.execute("PRAGMA {}={}".format(pragma, value))
+        with self.lock:
+            self.stats['connections_opened'] += 1
+        return sqlite_con
+
+    def prune(self) -> None:
+        with self.lock:
+            dead_threads = [ident for ident, (thread, con) in self.connections.items() if not thread.is_alive()]
+            dead_connections = [self.connections.pop(ident)[1] for ident in dead_threads]
+        for con in dead_connections:
+            try:
+                con.close()
+            except Exception:
+                pass
+
+    def acquire(self, sql_path:str) -> sqlite3.Connection:
+        sqlite_con = getattr(self.local, 'connection', None)
+        if sqlite_con is None or self.local.sql_path != sql_path:
+            self.prune()
+            if sqlite_con is not None:
+                sqlite_con.close()
+            sqlite_con = self.connect(sql_path)
+            self.local.connection = sqlite_con
+            self.local.sql_path = sql_path
+            self.local.depth = 0
+            with self.lock:
+                self.connections[threading.get_ident()] = (threading.current_thread(), sqlite_con)
+        self.local.depth += 1
+        return sqlite_con
+
+    def release(self) -> None:
+        """
+        Commits once the outermost context using the thread's connection exits.
+        """
+
+        self.local.depth -= 1
+        if self.local.depth == 0 and self.local.connection.in_transaction:
+            self.local.connection.commit()
+
+    def record(self, elapsed:float) -> None:
+        with self.lock:
+            self.stats['statements'] += 1
+            self.stats['time_spent'] += elapsed
+            self.stats['max_statement_time'] = max(self.stats['max_statement_time'], elapsed)
+            self.last_activity = time.monotonic()
+
+    def get_idle_time(self) -> float:
+        return time.monotonic() - self.last_activity
+
+    def close_thread_connection(self) -> None:
+        """
+        Closes the connection of the calling thread, for threads that only
+        use the database once in a while.
+        """
+
+        sqlite_con = getattr(self.local, 'connection', None)
+        if sqlite_con is None:
+            return
+        with self.lock:
+            self.connections.pop(threading.get_ident(), None)
+        self.local.connection = None
+        try:
+            if sqlite_con.in_transaction:
+                sqlite_con.commit()
+            sqlite_con.close()
+        except Exception:
+            pass
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = self.stats.copy()
+            stats['open_connections'] = len(self.connections)
+        return stats
+
+    def close_all(self) -> None:
+        with self.lock:
+            connections = [con for thread, con in self.connections.values()]
+            self.connections = {}
+        for con in connections:
+            try:
+                if con.in_transaction:
+                    con.commit()
+                con.close()
+            except Exception:
+                pass
+        self.local = threading.local()
+        logger.debug('SQLite stats: {}'.format(self.get_stats()))
+
+connection_manager = SQLiteConnectionManager()
+
 class SQLiteConnection:
     """
     This class manages the context for SQLite database connections.
@@ -130,25 +287,23 @@ class SQLiteConnection:
 
     def __enter__(self):
         """
-        What happens when the context is entered - in this case, establish a
-        connection to the database.
+        What happens when the context is entered - in this case, borrow the
+        current thread's connection from the pool.
         """
 
-        self.sqlite_con = sqlite3.connect(self.sql_path)
-        self.cursor = self.sqlite_con.cursor()
+        self.sqlite_con = connection_manager.acquire(self.sql_path)
+        self.cursor = self.sqlite_con.cursor(MetricsCursor)
 
         return self
 
     def __exit__(self, exception_type, exception_val, traceback) -> None:
         """
-        What to do once the context is exited again: commit and close the
-        connection.
+        What to do once the context is exited again: commit if this was the
+        outermost context, the connection stays open for the next call.
         """
 
-        if self.sqlite_con.in_transaction:
-            self.sqlite_con.commit()
-
-        self.sqlite_con.close()
+        self.cursor.close()
+        connection_manager.release()
 
 
 class Instance:
@@ -157,145 +312,358 @@ class Instance:
     to interface with the database in a modular and extensible way.
     """
 
+    schema: dict = {
+        "chat": {
+            "id": "TEXT NOT NULL PRIMARY KEY",
+            "name": "TEXT NOT NULL",
+            "folder": "TEXT",
+            "is_template": "INTEGER NOT NULL DEFAULT 0"
+        },
+        "message": {
+            "id": "TEXT NOT NULL PRIMARY KEY",
+            "chat_id": "TEXT NOT NULL",
+            "role": "TEXT NOT NULL",
+            "model": "TEXT",
+            "date_time": "DATETIME NOT NULL",
+            "content": "TEXT NOT NULL",
+        },
+        "attachment": {
+            "id": "TEXT NOT NULL PRIMARY KEY",
+            "message_id": "TEXT NOT NULL",
+            "type": "TEXT NOT NULL",
+            "name": "TEXT NOT NULL",
+            "content": "TEXT NOT NULL",
+            "blob_id": "TEXT" # attachment_blob.id, images keep an empty content
+        },
+        "attachment_blob": {
+            "id": "TEXT NOT NULL PRIMARY KEY", # SHA-256 of the content
+            "content": "BLOB NOT NULL",
+            "refs": "INTEGER NOT NULL DEFAULT 0"
+        },
+        "model_preferences": {
+            "id": "TEXT NOT NULL PRIMARY KEY",
+            "picture": "TEXT",
+            "voice": "TEXT",
+            "character": "TEXT" #JSON
+        },
+        "instance": {
+            "id": "TEXT NOT NULL PRIMARY KEY",
+            "pinned": "INTEGER NOT NULL",
+            "type": "TEXT NOT NULL",
+            "properties": "TEXT NOT NULL" #JSON
+        },
+        "online_instance_model_list": {
+            "id": "TEXT NOT NULL PRIMARY KEY",
+            "list": "TEXT NOT NULL" #JSON
+        },
+        "chat_folder": {
+            "id": "TEXT NOT NULL PRIMARY KEY",
+            "name": "TEXT NOT NULL",
+            "color": "TEXT",
+            "parent": "TEXT"
+        },
+        "embedding": {
+            "id": "TEXT NOT NULL PRIMARY KEY", # model:source_id:chunk
+            "model": "TEXT NOT NULL",
+            "chat_id": "TEXT NOT NULL",
+            "source_type": "TEXT NOT NULL", # message | attachment
+            "source_id": "TEXT NOT NULL",
+            "chunk": "INTEGER NOT NULL",
+            "position": "INTEGER NOT NULL" # Row in the vector file of the model
+        }
+    }
+
+    maintenance_interval: int = 120 # seconds between idle checks
+    maintenance_idle_time: int = 30 # seconds without statements before maintenance runs
+    maintenance_timeout_id = None
+    maintenance_thread = None
+    maintenance_last_run: float = 0.0 # monotonic time the last run finished
+    maintenance_tasks: tuple = () # Cleanups outside the database, run after it
+
     def initialize():
         if os.path.exists(os.path.join(data_dir, "chats_test.db")) and not os.path.exists(os.path.join(data_dir, "alpaca.db")):
             shutil.move(os.path.join(data_dir, "chats_test.db"), os.path.join(data_dir, "alpaca.db"))
 
         with SQLiteConnection() as c:
-            tables = {
-                "chat": {
-                    "id": "TEXT NOT NULL PRIMARY KEY",
-                    "name": "TEXT NOT NULL",
-                    "folder": "TEXT",
-                    "is_template": "INTEGER NOT NULL DEFAULT 0"
-                },
-                "message": {
-                    "id": "TEXT NOT NULL PRIMARY KEY",
-                    "chat_id": "TEXT NOT NULL",
-                    "role": "TEXT NOT NULL",
-                    "model": "TEXT",
-                    "date_time": "DATETIME NOT NULL",
-                    "content": "TEXT NOT NULL",
-                },
-                "attachment": {
-                    "id": "TEXT NOT NULL PRIMARY KEY",
-                    "message_id": "TEXT NOT NULL",
-                    "type": "TEXT NOT NULL",
-                    "name": "TEXT NOT NULL",
-                    "content": "TEXT NOT NULL",
-                },
-                "model_preferences": {
-                    "id": "TEXT NOT NULL PRIMARY KEY",
-                    "picture": "TEXT",
-                    "voice": "TEXT",
-                    "character": "TEXT" #JSON
-                },
-                "instance": {
-                    "id": "TEXT NOT NULL PRIMARY KEY",
-                    "pinned": "INTEGER NOT NULL",
-                    "type": "TEXT NOT NULL",
-                    "properties": "TEXT NOT NULL" #JSON
-                },
-                "tool_parameters": {
-                    "name": "TEXT NOT NULL PRIMARY KEY",
-                    "variables": "TEXT NOT NULL",
-                    "activated": "INTEGER NOT NULL"
-                },
-                "online_instance_model_list": {
-                    "id": "TEXT NOT NULL PRIMARY KEY",
-                    "list": "TEXT NOT NULL" #JSON
-                },
-                "chat_folder": {
-                    "id": "TEXT NOT NULL PRIMARY KEY",
-                    "name": "TEXT NOT NULL",
-                    "color": "TEXT",
-                    "parent": "TEXT"
-                }
-            }
+            # WAL lets the GTK thread keep reading while a generation commits
+            c.cursor.execute("PRAGMA journal_mode=WAL")
 
-            for table_name, columns in tables.items():
+            for table_name, columns in Instance.schema.items():
                 columns_def = ", ".join([f"{col_name} {col_def}" for col_name, col_def in columns.items()])
                 c.cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_def})")
 
-            c.cursor.execute("PRAGMA table_info(chat)")
-            columns = [col[1] for col in c.cursor.fetchall()]
-            if 'folder' not in columns:
-                c.cursor.execute("ALTER TABLE chat ADD COLUMN folder TEXT")
-            if 'is_template' not in columns:
-                c.cursor.execute("ALTER TABLE chat ADD COLUMN is_template INTEGER NOT NULL DEFAULT 0") # Treated as boolean 0/1
-            if 'type' in columns: # Rebuild chat table (remove type)
-                c.cursor.execute("ALTER TABLE chat RENAME to chat_old")
-                columns_def = ", ".join([f"{col_name} {col_def}" for col_name, col_def in tables.get('chat').items()])
-                c.cursor.execute(f"CREATE TABLE IF NOT EXISTS chat ({columns_def})")
-                c.cursor.execute(f"INSERT INTO chat (id, name) SELECT id, name FROM chat_old")
-                c.cursor.execute(f"DROP TABLE chat_old")
-
-            c.cursor.execute("PRAGMA table_info(model_preferences)")
-            columns = [col[1] for col in c.cursor.fetchall()]
-            if 'character' not in columns:
-                c.cursor.execute("ALTER TABLE model_preferences ADD COLUMN character TEXT")
-
-            # Remove stuff from previous versions (cleaning)
+            migrations = (
+                Instance.migrate_legacy_schema,
+                Instance.migrate_indexes,
+                Instance.migrate_search_index,
+                Instance.migrate_attachment_blobs,
+                Instance.migrate_embeddings
+            )
+            version = c.cursor.execute("PRAGMA user_version").fetchone()[0]
+            for index, migration in enumerate(migrations[version:], start=version+1):
+                logger.info("Migrating database to version {}".format(index))
+                c.cursor.execute("BEGIN")
+                try:
+                    migration(c)
+                    c.cursor.execute("PRAGMA user_version = {}".format(index))
+                    c.sqlite_con.commit()
+                except Exception as e:
+                    c.sqlite_con.rollback()
+                    raise e
+
+    ################
+    ## MIGRATIONS ##
+    ################
+
+    # Each migration runs once, PRAGMA user_version stores how many were applied
+
+    def execute_script(c:SQLiteConnection, script:str) -> None:
+        """
+        Runs the statements of the script one by one, executescript() would
+        commit the migration's transaction first
+        """
+        statement = ''
+        for part in script.split(';'):
+            statement += part + ';'
+            # Trigger bodies have their own semicolons
+            if sqlite3.complete_statement(statement):
+                if statement.strip(' \n;'):
+                    c.cursor.execute(statement)
+                statement = ''
+
+    def migrate_legacy_schema(c:SQLiteConnection) -> None:
+        c.cursor.execute("PRAGMA table_info(chat)")
+        columns = [col[1] for col in c.cursor.fetchall()]
+        if 'folder' not in columns:
+            c.cursor.execute("ALTER TABLE chat ADD COLUMN folder TEXT")
+        if 'is_template' not in columns:
+            c.cursor.execute("ALTER TABLE chat ADD COLUMN is_template INTEGER NOT NULL DEFAULT 0") # Treated as boolean 0/1
+        if 'type' in columns: # Rebuild chat table (remove type)
+            c.cursor.execute("ALTER TABLE chat RENAME to chat_old")
+            columns_def = ", ".join([f"{col_name} {col_def}" for col_name, col_def in Instance.schema.get('chat').items()])
+            c.cursor.execute(f"CREATE TABLE IF NOT EXISTS chat ({columns_def})")
+            c.cursor.execute(f"INSERT INTO chat (id, name) SELECT id, name FROM chat_old")
+            c.cursor.execute(f"DROP TABLE chat_old")
+
+        c.cursor.execute("PRAGMA table_info(model_preferences)")
+        columns = [col[1] for col in c.cursor.fetchall()]
+        if 'character' not in columns:
+            c.cursor.execute("ALTER TABLE model_preferences ADD COLUMN character TEXT")
+
+        # Remove stuff from previous versions (cleaning)
+        try:
+            model_pictures = c.cursor.execute("SELECT id, picture FROM model").fetchall()
+            for p in model_pictures:
+                c.cursor.execute("INSERT INTO model_preferences (id, picture) VALUES (?, ?)", (p[0], p[1]))
+            c.cursor.execute("DROP TABLE model")
+        except Exception:
+            pass
+
+        # Move preferences to GLib
+        if c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' and name='preferences';").fetchall() != []:
+            from gi.repository import Gio
+            settings = Gio.Settings(schema_id="com.jeffser.Alpaca")
+            settings_keys = {
+                'selected_instance': 'selected-instance',
+                'last_notice_seen': 'last-notice-seen',
+                'selected_chat': 'default-chat',
+                'zoom': 'zoom',
+                'run_on_background': 'hide-on-close',
+                'powersaver_warning': 'powersaver-warning',
+                'mic_auto_send': 'stt-auto-send',
+            }
+            old_preferences = Instance.get_preferences()
+            for old_key, new_key in settings_keys.items():
+                old_value = old_preferences.get(old_key)
+                if old_value:
+                    if isinstance(old_value, bool):
+                        settings.set_boolean(new_key, old_value)
+                    elif isinstance(old_value, int):
+                        settings.set_int(new_key, old_value)
+                    elif isinstance(old_value, str):
+                        settings.set_string(new_key, old_value)
+            c.cursor.execute("DROP TABLE preferences")
+
+        # Move Instances to new table
+        if c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' and name='instances';").fetchall() != []:
+            for old_ins in Instance.get_instances_DEPRECATED():
+                properties = {
+                    'name': old_ins.get('name'),
+                    'temperature': old_ins.get('temperature'),
+                    'default_model': old_ins.get('default_model'),
+                    'title_model': old_ins.get('title_model')
+                }
+                if old_ins.get('max_tokens', -1) != -1:
+                    properties['max_tokens'] = old_ins.get('max_tokens')
+                if old_ins.get('type') in ('openai:generic', 'ollama:managed', 'ollama') and old_ins.get('url'):
+                    properties['url'] = old_ins.get('url')
+                if old_ins.get('type') != 'ollama:managed':
+                    properties['api'] = old_ins.get('api')
+                if old_ins.get('type') not in ('venice', 'deepseek', 'gemini') and old_ins.get('seed'):
+                    properties['seed'] = old_ins.get('seed')
+                if old_ins.get('type') == 'ollama:managed':
+                    properties['overrides'] = old_ins.get('overrides')
+                    properties['model_directory'] = old_ins.get('model_directory')
+
+                c.cursor.execute("INSERT INTO instance (id, pinned, type, properties) VALUES (?, ?, ?, ?)", (old_ins.get('id'), old_ins.get('pinned'), old_ins.get('type'), json.dumps(properties)))
+            c.cursor.execute("DROP TABLE instances")
+
+        # Remove tool_parameters table
+        if c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' and name='tool_parameters';").fetchall() != []:
+            c.cursor.execute("DROP TABLE tool_parameters")
+
+    def migrate_indexes(c:SQLiteConnection) -> None:
+        c.cursor.execute("CREATE INDEX IF NOT EXISTS message_chat_id_index ON message (chat_id, date_time)")
+        c.cursor.execute("CREATE INDEX IF NOT EXISTS attachment_message_id_index ON attachment (message_id)")
+        c.cursor.execute("CREATE INDEX IF NOT EXISTS chat_folder_index ON chat (folder)")
+        c.cursor.execute("CREATE INDEX IF NOT EXISTS chat_folder_parent_index ON chat_folder (parent)")
+        c.cursor.execute("ANALYZE")
+
+    def migrate_search_index(c:SQLiteConnection) -> None:
+        # External content FTS5 tables kept in sync by triggers, images and metadata aren't indexed
+        c.cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(content, content='message', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')")
+        c.cursor.execute("CREATE VIEW IF NOT EXISTS searchable_attachment AS SELECT rowid AS attachment_rowid, content FROM attachment WHERE type NOT IN ('image', 'metadata')")
+        c.cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS attachment_search USING fts5(content, content='searchable_attachment', content_rowid='attachment_rowid', tokenize='unicode61 remove_diacritics 2')")
+
+        Instance.execute_script(c, """
+            CREATE TRIGGER IF NOT EXISTS message_search_insert AFTER INSERT ON message BEGIN
+                INSERT INTO message_search (rowid, content) VALUES (new.rowid, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS message_search_delete AFTER DELETE ON message BEGIN
+                INSERT INTO message_search (message_search, rowid, content) VALUES ('delete', old.rowid, old.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS message_search_update AFTER UPDATE OF content ON message WHEN old.content IS NOT new.content BEGIN
+                INSERT INTO message_search (message_search, rowid, content) VALUES ('delete', old.rowid, old.content);
+                INSERT INTO message_search (rowid, content) VALUES (new.rowid, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS attachment_search_insert AFTER INSERT ON attachment BEGIN
+                INSERT INTO attachment_search (rowid, content) SELECT new.rowid, new.content WHERE new.type NOT IN ('image', 'metadata');
+            END;
+            CREATE TRIGGER IF NOT EXISTS attachment_search_delete AFTER DELETE ON attachment BEGIN
+                INSERT INTO attachment_search (attachment_search, rowid, content) SELECT 'delete', old.rowid, old.content WHERE old.type NOT IN ('image', 'metadata');
+            END;
+            CREATE TRIGGER IF NOT EXISTS attachment_search_update AFTER UPDATE ON attachment BEGIN
+                INSERT INTO attachment_search (attachment_search, rowid, content) SELECT 'delete', old.rowid, old.content WHERE old.type NOT IN ('image', 'metadata');
+                INSERT INTO attachment_search (rowid, content) SELECT new.rowid, new.content WHERE new.type NOT IN ('image', 'metadata');
+            END;
+        """)
+        Instance.rebuild_search_index(c)
+
+    def migrate_attachment_blobs(c:SQLiteConnection) -> None:
+        # Images move to attachment_blob as raw bytes, the triggers keep count
+        # of how many attachments share each blob and drop unused ones
+        if "blob_id" not in [column[1] for column in c.cursor.execute("PRAGMA table_info(attachment)").fetchall()]:
+            c.cursor.execute("ALTER TABLE attachment ADD COLUMN blob_id TEXT")
+
+        Instance.execute_script(c, """
+            CREATE TRIGGER IF NOT EXISTS attachment_blob_insert AFTER INSERT ON attachment WHEN new.blob_id IS NOT NULL BEGIN
+                UPDATE attachment_blob SET refs = refs + 1 WHERE id = new.blob_id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS attachment_blob_delete AFTER DELETE ON attachment WHEN old.blob_id IS NOT NULL BEGIN
+                UPDATE attachment_blob SET refs = refs - 1 WHERE id = old.blob_id;
+                DELETE FROM attachment_blob WHERE id = old.blob_id AND refs <= 0;
+            END;
+            CREATE TRIGGER IF NOT EXISTS attachment_blob_update AFTER UPDATE OF blob_id ON attachment WHEN old.blob_id IS NOT new.blob_id BEGIN
+                UPDATE attachment_blob SET refs = refs + 1 WHERE id = new.blob_id;
+                UPDATE attachment_blob SET refs = refs - 1 WHERE id = old.blob_id;
+                DELETE FROM attachment_blob WHERE id = old.blob_id AND refs <= 0;
+            END;
+        """)
+        Instance.move_images_to_blobs(c)
+
+    def move_images_to_blobs(c:SQLiteConnection) -> None:
+        """
+        Stores images still saved as base64 text in the blob store
+        """
+        rows = c.cursor.execute(
+            "SELECT rowid, content FROM attachment WHERE type='image' AND blob_id IS NULL AND content != ''"
+        ).fetchall()
+        for rowid, content in rows:
             try:
-                model_pictures = c.cursor.execute("SELECT id, picture FROM model")
-                for p in model_pictures:
-                    c.cursor.execute("INSERT INTO model_preferences (id, picture) VALUES (?, ?)", (p[0], p[1]))
-                c.cursor.execute("DROP TABLE model")
+                data = base64.b64decode(content, validate=True)
             except Exception:
-                pass
+                continue
+            c.cursor.execute(
+                "UPDATE attachment SET content='', blob_id=? WHERE rowid=?",
+                (Instance.store_blob(c, data), rowid)
+            )
 
-            # Move preferences to GLib
-            if c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' and name='preferences';").fetchall() != []:
-                settings = Gio.Settings(schema_id="com.jeffser.Alpaca")
-                settings_keys = {
-                    'selected_instance': 'selected-instance',
-                    'last_notice_seen': 'last-notice-seen',
-                    'selected_chat': 'default-chat',
-                    'zoom': 'zoom',
-                    'run_on_background': 'hide-on-close',
-                    'powersaver_warning': 'powersaver-warning',
-                    'mic_auto_send': 'stt-auto-send',
-                }
-                old_preferences = Instance.get_preferences()
-                for old_key, new_key in settings_keys.items():
-                    old_value = old_preferences.get(old_key)
-                    if old_value:
-                        if isinstance(old_value, bool):
-                            settings.set_boolean(new_key, old_value)
-                        elif isinstance(old_value, int):
-                            settings.set_int(new_key, old_value)
-                        elif isinstance(old_value, str):
-                            settings.set_string(new_key, old_value)
-                c.cursor.execute("DROP TABLE preferences")
-
-            # Move Instances to new table
-            if c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' and name='instances';").fetchall() != []:
-                for old_ins in Instance.get_instances_DEPRECATED():
-                    properties = {
-                        'name': old_ins.get('name'),
-                        'temperature': old_ins.get('temperature'),
-                        'default_model': old_ins.get('default_model'),
-                        'title_model': old_ins.get('title_model')
-                    }
-                    if old_ins.get('max_tokens', -1) != -1:
-                        properties['max_tokens'] = old_ins.get('max_tokens')
-                    if old_ins.get('type') in ('openai:generic', 'ollama:managed', 'ollama') and old_ins.get('url'):
-                        properties['url'] = old_ins.get('url')
-                    if old_ins.get('type') != 'ollama:managed':
-                        properties['api'] = old_ins.get('api')
-                    if old_ins.get('type') not in ('venice', 'deepseek', 'gemini') and old_ins.get('seed'):
-                        properties['seed'] = old_ins.get('seed')
-                    if old_ins.get('type') == 'ollama:managed':
-                        properties['overrides'] = old_ins.get('overrides')
-                        properties['model_directory'] = old_ins.get('model_directory')
-
-                    c.cursor.execute("INSERT INTO instance (id, pinned, type, properties) VALUES (?, ?, ?, ?)", (old_ins.get('id'), old_ins.get('pinned'), old_ins.get('type'), json.dumps(properties)))
-                c.cursor.execute("DROP TABLE instances")
-
-            # Remove tool_parameters table
-            if c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' and name='tool_parameters';").fetchall() != []:
-                c.cursor.execute("DROP TABLE tool_parameters")
+    def migrate_embeddings(c:SQLiteConnection) -> None:
+        # Vectors of deleted or edited content stop being used right away
+        c.cursor.execute("CREATE INDEX IF NOT EXISTS embedding_model_chat_index ON embedding (model, chat_id)")
+        c.cursor.execute("CREATE INDEX IF NOT EXISTS embedding_source_index ON embedding (source_id)")
+        Instance.execute_script(c, """
+            CREATE TRIGGER IF NOT EXISTS embedding_message_delete AFTER DELETE ON message BEGIN
+                DELETE FROM embedding WHERE source_id = old.id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS embedding_message_update AFTER UPDATE OF content ON message WHEN old.content IS NOT new.content BEGIN
+                DELETE FROM embedding WHERE source_id = old.id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS embedding_attachment_delete AFTER DELETE ON attachment BEGIN
+                DELETE FROM embedding WHERE source_id = old.id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS embedding_attachment_update AFTER UPDATE OF content, message_id ON attachment BEGIN
+                DELETE FROM embedding WHERE source_id = old.id;
+            END;
+        """)
+
+    def rebuild_search_index(c:SQLiteConnection) -> None:
+        c.cursor.execute("INSERT INTO message_search (message_search) VALUES ('rebuild')")
+        c.cursor.execute("INSERT INTO attachment_search (attachment_search) VALUES ('rebuild')")
+
+    #################
+    ## MAINTENANCE ##
+    #################
+
+    def start_maintenance(tasks:tuple=()) -> None:
+        """
+        Schedules WAL checkpoints and vacuuming, they only run once the
+        database has been idle for a while so they never compete with a
+        streaming response. The tasks are called by the same worker after.
+        """
 
+        Instance.maintenance_tasks = tuple(tasks)
+        if Instance.maintenance_timeout_id is None:
+            from gi.repository import GLib
+            Instance.maintenance_timeout_id = GLib.timeout_add_seconds(Instance.maintenance_interval, lambda: Instance.check_maintenance() or True)
+
+    def check_maintenance() -> bool:
+        """
+        Starts the maintenance worker if the database is idle, at most once per
+        idle period and never while the previous run is going. Returns whether
+        it started.
+        """
+
+        if connection_manager.get_idle_time() < Instance.maintenance_idle_time:
+            return False
+        # Nothing ran since the last maintenance, its own statements don't count
+        if connection_manager.last_activity <= Instance.maintenance_last_run:
+            return False
+        if Instance.maintenance_thread and Instance.maintenance_thread.is_alive():
+            return False
+        Instance.maintenance_thread = threading.Thread(target=Instance.run_maintenance, name='Maintenance', daemon=True)
+        Instance.maintenance_thread.start()
+        return True
+
+    def run_maintenance() -> None:
+        try:
+            with SQLiteConnection() as c:
+                c.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+                c.cursor.execute("PRAGMA optimize")
+                page_count = c.cursor.execute("PRAGMA page_count").fetchone()[0]
+                freelist_count = c.cursor.execute("PRAGMA freelist_count").fetchone()[0]
+                if page_count and freelist_count / page_count > 0.25:
+                    logger.info("Vacuuming database ({} of {} pages free)".format(freelist_count, page_count))
+                    c.cursor.execute("VACUUM")
+                    # VACUUM can renumber rowids, the search index points to them
+                    Instance.rebuild_search_index(c)
+            for task in Instance.maintenance_tasks:
+                task()
+        except Exception as e:
+            logger.error(e)
+        finally:
+            Instance.maintenance_last_run = time.monotonic()
+            connection_manager.close_thread_connection()
 
     ###########
     ## CHATS ##
@@ -321,6 +689,24 @@ class Instance:
 
         return chats
 
+    def get_chat_folder_path(chat:str) -> list:
+        """
+        Folder ids from the root down to the folder holding the chat,
+        the chat can be given by id or by name
+        """
+        with SQLiteConnection() as c:
+            rows = c.cursor.execute(
+                "WITH RECURSIVE path(id, parent, depth) AS ( \
+                SELECT chat_folder.id, chat_folder.parent, 0 FROM chat JOIN chat_folder ON chat_folder.id = chat.folder \
+                WHERE chat.id=(SELECT id FROM chat WHERE id=? OR name=? ORDER BY id=? DESC LIMIT 1) \
+                UNION ALL SELECT chat_folder.id, chat_folder.parent, path.depth + 1 FROM chat_folder \
+                JOIN path ON chat_folder.id = path.parent) \
+                SELECT id FROM path ORDER BY depth DESC",
+                (chat, chat, chat)
+            ).fetchall()
+
+        return [row[0] for row in rows]
+
     def get_templates() -> list:
         with SQLiteConnection() as c:
             templates = c.cursor.execute(
@@ -334,21 +720,140 @@ class Instance:
     def get_messages(chat) -> list:
         with SQLiteConnection() as c:
             messages = c.cursor.execute(
-                "SELECT id, role, model, date_time, content FROM message WHERE chat_id=?",
+                "SELECT id, role, model, date_time, content FROM message WHERE chat_id=? ORDER BY date_time, id",
                 (chat.chat_id,),
             ).fetchall()
 
         return messages
 
+    def get_messages_page(chat_id:str, before_date_time:str=None, limit:int=50, before_id:str=None) -> list:
+        """
+        Keyset paginated messages of a chat, returns up to `limit` messages
+        older than the cursor in chronological order (-1 returns every one
+        of them). The (date_time, id) of the first row is the cursor for the
+        next, older, page. Ids start with their creation time so they break
+        ties in order, unlike rowids they survive VACUUM.
+        """
+
+        with SQLiteConnection() as c:
+            if before_date_time is None:
+                messages = c.cursor.execute(
+                    "SELECT id, role, model, date_time, content FROM message WHERE chat_id=? \
+                    ORDER BY date_time DESC, id DESC LIMIT ?",
+                    (chat_id, limit),
+                ).fetchall()
+            else:
+                messages = c.cursor.execute(
+                    "SELECT id, role, model, date_time, content FROM message WHERE chat_id=? \
+                    AND (date_time < ? OR (date_time = ? AND id < ?)) \
+                    ORDER BY date_time DESC, id DESC LIMIT ?",
+                    (chat_id, before_date_time, before_date_time, before_id or '', limit),
+                ).fetchall()
+
+        messages.reverse()
+        return messages
+
     def get_attachments(message) -> list:
         with SQLiteConnection() as c:
             attachments = c.cursor.execute(
-                "SELECT id, type, name, content FROM attachment WHERE message_id=?",
+                "SELECT id, type, name, content, blob_id FROM attachment WHERE message_id=?",
                 (message.message_id,),
             ).fetchall()
 
         return attachments
 
+    def get_attachments_by_message(message_ids:list) -> dict:
+        attachments = {}
+        with SQLiteConnection() as c:
+            for i in range(0, len(message_ids), 500):
+                chunk = message_ids[i:i+500]
+                for row in c.cursor.execute(
+                    "SELECT message_id, id, type, name, content, blob_id FROM attachment WHERE message_id IN ({}) ORDER BY rowid".format(', '.join('?' * len(chunk))),
+                    chunk,
+                ).fetchall():
+                    attachments.setdefault(row[0], []).append(row[1:])
+
+        return attachments
+
+    def get_chat_bundle(chat_id:str, before_date_time:str=None, limit:int=-1, before_id:str=None) -> tuple:
+        """
+        Fetches a page of messages (the whole chat by default) along with
+        their attachments using two set-based queries, returns the messages
+        and a dictionary mapping message ids to their attachments.
+        """
+
+        messages = Instance.get_messages_page(chat_id, before_date_time, limit, before_id)
+        return messages, Instance.get_attachments_by_message([m[0] for m in messages])
+
+    def get_search_query(raw_query:str) -> str:
+        """
+        Turns user input into a FTS5 query that matches every word as a prefix
+        """
+        return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in raw_query.split())
+
+    def search_messages(raw_query:str, limit:int=50) -> list:
+        """
+        Searches message contents and text attachments using the FTS5 index,
+        returns the best ranked hits as dictionaries with the chat id,
+        message id, a snippet and the (start, end) offsets of the matches
+        inside the snippet.
+        """
+
+        query = Instance.get_search_query(raw_query)
+        if not query:
+            return []
+
+        with SQLiteConnection() as c:
+            rows = c.cursor.execute(
+                "SELECT m.chat_id, m.id, snippet(message_search, 0, char(1), char(2), '…', 16), bm25(message_search) AS rank \
+                FROM message_search JOIN message m ON m.rowid = message_search.rowid WHERE message_search MATCH ? \
+                UNION ALL \
+                SELECT m.chat_id, m.id, snippet(attachment_search, 0, char(1), char(2), '…', 16), bm25(attachment_search) AS rank \
+                FROM attachment_search JOIN attachment a ON a.rowid = attachment_search.rowid JOIN message m ON m.id = a.message_id \
+                WHERE attachment_search MATCH ? \
+                ORDER BY rank LIMIT ?",
+                (query, query, limit)
+            ).fetchall()
+
+        results = []
+        for chat_id, message_id, raw_snippet, rank in rows:
+            snippet = ''
+            offsets = []
+            for i, part in enumerate(raw_snippet.split('\x01')):
+                if i > 0 and '\x02' in part:
+                    match, rest = part.split('\x02', 1)
+                    offsets.append((len(snippet), len(snippet) + len(match)))
+                    snippet += match + rest
+                else:
+                    snippet += part
+            results.append({
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'snippet': snippet,
+                'offsets': offsets
+            })
+        return results
+
+    def search_chat_ids(raw_query:str) -> set:
+        """
+        Ids of every chat with a message or attachment matching the query
+        """
+
+        query = Instance.get_search_query(raw_query)
+        if not query:
+            return set()
+
+        with SQLiteConnection() as c:
+            rows = c.cursor.execute(
+                "SELECT m.chat_id FROM message_search JOIN message m ON m.rowid = message_search.rowid WHERE message_search MATCH ? \
+                UNION \
+                SELECT m.chat_id FROM attachment_search JOIN attachment a ON a.rowid = attachment_search.rowid \
+                JOIN message m ON m.id = a.message_id WHERE attachment_search MATCH ?",
+                (query, query)
+            ).fetchall()
+
+        return set(row[0] for row in rows)
+
     def export_db(chat, export_sql_path: str) -> None:
         with SQLiteConnection() as c:
             c.cursor.execute("ATTACH DATABASE ? AS export", (export_sql_path,))
@@ -360,10 +865,16 @@ class Instance:
                 "CREATE TABLE export.message AS SELECT * FROM message WHERE chat_id=?",
                 (chat.chat_id,),
             )
+            # Exports keep images inline so they don't depend on the blob store
+            c.sqlite_con.create_function('to_base64', 1, lambda data: base64.b64encode(data).decode('utf-8') if data else '', deterministic=True)
             c.cursor.execute(
-                "CREATE TABLE export.attachment AS SELECT a.* FROM attachment as a JOIN message m ON a.message_id = m.id WHERE m.chat_id=?",
+                "CREATE TABLE export.attachment AS SELECT a.id, a.message_id, a.type, a.name, \
+                COALESCE((SELECT to_base64(b.content) FROM attachment_blob b WHERE b.id = a.blob_id), a.content) AS content \
+                FROM attachment as a JOIN message m ON a.message_id = m.id WHERE m.chat_id=?",
                 (chat.chat_id,),
             )
+            c.sqlite_con.commit()
+            c.cursor.execute("DETACH DATABASE export")
 
     def insert_or_update_chat(chat) -> None:
         with SQLiteConnection() as c:
@@ -396,12 +907,10 @@ class Instance:
         with SQLiteConnection() as c:
             c.cursor.execute("DELETE FROM chat WHERE id=?", (chat.chat_id,))
 
-            for message in c.cursor.execute(
-                "SELECT id FROM message WHERE chat_id=?", (chat.chat_id,)
-            ).fetchall():
-                c.cursor.execute(
-                    "DELETE FROM attachment WHERE message_id=?", (message[0],)
-                )
+            c.cursor.execute(
+                "DELETE FROM attachment WHERE message_id IN (SELECT id FROM message WHERE chat_id=?)",
+                (chat.chat_id,)
+            )
 
             c.cursor.execute(
                 "DELETE FROM message WHERE chat_id=?", (chat.chat_id,)
@@ -413,6 +922,7 @@ class Instance:
             c.cursor.execute("DELETE FROM chat")
             c.cursor.execute("DELETE FROM message")
             c.cursor.execute("DELETE FROM attachment")
+            c.cursor.execute("DELETE FROM attachment_blob")
 
     def duplicate_chat(old_chat_id:str, new_chat) -> None:
         with SQLiteConnection() as c:
@@ -436,18 +946,20 @@ class Instance:
                     ),
                 )
 
+                # Blobs are shared, only their reference is copied
                 for attachment in c.cursor.execute(
-                    "SELECT type, name, content FROM attachment WHERE message_id=?",
+                    "SELECT type, name, content, blob_id FROM attachment WHERE message_id=?",
                     (message[0],),
                 ).fetchall():
                     c.cursor.execute(
-                        "INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
+                        "INSERT INTO attachment (id, message_id, type, name, content, blob_id) VALUES (?, ?, ?, ?, ?, ?)",
                         (
                             generate_uuid(),
                             new_message_id,
                             attachment[0],
                             attachment[1],
                             attachment[2],
+                            attachment[3],
                         ),
                     )
 
@@ -516,12 +1028,15 @@ class Instance:
                 "INSERT INTO message SELECT * FROM import.message"
             )
             c.cursor.execute(
-                "INSERT INTO attachment SELECT * FROM import.attachment"
+                "INSERT INTO attachment (id, message_id, type, name, content) SELECT id, message_id, type, name, content FROM import.attachment"
             )
+            Instance.move_images_to_blobs(c)
 
             new_chats = c.cursor.execute(
                 "SELECT * FROM import.chat"
             ).fetchall()
+            c.sqlite_con.commit()
+            c.cursor.execute("DETACH DATABASE import")
 
         return new_chats
 
@@ -530,6 +1045,7 @@ class Instance:
     ##############
 
     def insert_or_update_message(message, force_chat_id: str = None, force_content: str = None) -> None:
+        from . import widgets as Widgets
         message_author = ["user", "assistant", "system"][message.mode]
         chat_element = message.get_ancestor(Widgets.chat.Chat)
 
@@ -581,37 +1097,151 @@ class Instance:
 
     def insert_or_update_attachment(message, attachment) -> None:
         with SQLiteConnection() as c:
+            content = attachment.file_content
+            blob_id = None
+            if attachment.file_type == 'image' and hasattr(attachment, 'get_bytes'):
+                blob_id = Instance.store_blob(c, attachment.get_bytes())
+                content = ''
+
             if c.cursor.execute(
                 "SELECT id FROM attachment WHERE id=?", (attachment.get_name(),)
             ).fetchone():
                 c.cursor.execute(
-                    "UPDATE attachment SET message_id=?, type=?, name=?, content=? WHERE id=?",
+                    "UPDATE attachment SET message_id=?, type=?, name=?, content=?, blob_id=? WHERE id=?",
                     (
                         message.message_id,
                         attachment.file_type,
                         attachment.file_name,
-                        attachment.file_content,
+                        content,
+                        blob_id,
                         attachment.get_name()
                     )
                 )
             else:
                 c.cursor.execute(
-                    "INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
+                    "INSERT INTO attachment (id, message_id, type, name, content, blob_id) VALUES (?, ?, ?, ?, ?, ?)",
                     (
                         generate_uuid(),
                         message.message_id,
                         attachment.file_type,
                         attachment.file_name,
-                        attachment.file_content,
+                        content,
+                        blob_id
                     ),
                 )
 
+        if blob_id:
+            attachment.set_blob(blob_id)
+
     def delete_attachment(attachment) -> None:
         with SQLiteConnection() as c:
             c.cursor.execute(
                 "DELETE FROM attachment WHERE id=?", (attachment.get_name(),)
             )
 
+    def store_blob(c:SQLiteConnection, data:bytes) -> str:
+        """
+        Saves the bytes under their SHA-256 unless they are already stored,
+        returns the blob id
+        """
+        blob_id = hashlib.sha256(data).hexdigest()
+        c.cursor.execute(
+            "INSERT OR IGNORE INTO attachment_blob (id, content, refs) VALUES (?, ?, 0)",
+            (blob_id, data)
+        )
+        return blob_id
+
+    def get_blob_ids(blob_ids:list) -> set:
+        """
+        Returns the ids of the list that are still in the blob store
+        """
+        found = set()
+        with SQLiteConnection() as c:
+            for i in range(0, len(blob_ids), 500):
+                chunk = blob_ids[i:i+500]
+                found.update(row[0] for row in c.cursor.execute(
+                    "SELECT id FROM attachment_blob WHERE id IN ({})".format(', '.join('?' * len(chunk))),
+                    chunk
+                ).fetchall())
+        return found
+
+    def get_blob(blob_id:str) -> bytes:
+        with SQLiteConnection() as c:
+            row = c.cursor.execute(
+                "SELECT content FROM attachment_blob WHERE id=?", (blob_id,)
+            ).fetchone()
+
+        return row[0] if row else b''
+
+    ################
+    ## EMBEDDINGS ##
+    ################
+
+    def get_unembedded_sources(model:str, attachment_types:tuple, exclude_chat_id:str=None, limit:int=-1) -> list:
+        """
+        Messages and document attachments of every chat but one (its content
+        is already in the prompt) without vectors for the model as
+        (source_type, source_id, chat_id, content)
+        """
+        with SQLiteConnection() as c:
+            return c.cursor.execute(
+                "SELECT 'message', m.id, m.chat_id, m.content FROM message m JOIN chat ON chat.id = m.chat_id \
+                WHERE m.chat_id IS NOT ? AND m.role != 'system' AND TRIM(m.content) != '' \
+                AND NOT EXISTS (SELECT 1 FROM embedding e WHERE e.source_id = m.id AND e.model=?) \
+                UNION ALL \
+                SELECT 'attachment', a.id, m.chat_id, a.content FROM attachment a JOIN message m ON m.id = a.message_id \
+                WHERE m.chat_id IS NOT ? AND a.type IN ({}) AND TRIM(a.content) != '' \
+                AND NOT EXISTS (SELECT 1 FROM embedding e WHERE e.source_id = a.id AND e.model=?) LIMIT ?".format(', '.join('?' * len(attachment_types))),
+                (exclude_chat_id, model, exclude_chat_id, *attachment_types, model, limit)
+            ).fetchall()
+
+    def insert_embeddings(rows:list) -> None:
+        """
+        rows are (model, chat_id, source_type, source_id, chunk, position)
+        """
+        with SQLiteConnection() as c:
+            c.cursor.executemany(
+                "INSERT OR REPLACE INTO embedding (id, model, chat_id, source_type, source_id, chunk, position) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [('{}:{}:{}'.format(row[0], row[3], row[4]), *row) for row in rows]
+            )
+
+    def get_embeddings(model:str, exclude_chat_id:str) -> list:
+        """
+        (position, source_type, source_id, chunk) of every chat but one
+        """
+        with SQLiteConnection() as c:
+            return c.cursor.execute(
+                "SELECT position, source_type, source_id, chunk FROM embedding WHERE model=? AND chat_id!=?",
+                (model, exclude_chat_id)
+            ).fetchall()
+
+    def get_embedding_positions(model:str) -> list:
+        with SQLiteConnection() as c:
+            return [row[0] for row in c.cursor.execute(
+                "SELECT position FROM embedding WHERE model=? ORDER BY position", (model,)
+            ).fetchall()]
+
+    def move_embeddings(model:str, positions:dict) -> None:
+        """
+        Points the model's rows to new positions after the vector file is compacted
+        """
+        with SQLiteConnection() as c:
+            c.cursor.execute("UPDATE embedding SET position = -1 - position WHERE model=?", (model,))
+            c.cursor.executemany(
+                "UPDATE embedding SET position=? WHERE model=? AND position=?",
+                [(new, model, -1 - old) for old, new in positions.items()]
+            )
+            c.cursor.execute("DELETE FROM embedding WHERE model=? AND position < 0", (model,))
+
+    def get_source_content(source_type:str, source_id:str) -> str:
+        with SQLiteConnection() as c:
+            row = c.cursor.execute(
+                "SELECT content FROM {} WHERE id=?".format('message' if source_type == 'message' else 'attachment'),
+                (source_id,)
+            ).fetchone()
+
+        return row[0] if row else ''
+
     ##############################
     ## PREFERENCES (DEPRECATED) ##
     ##############################
@@ -10,6 +10,7 @@ from .camera import Camera
 from .viewers import ImageViewer, FileViewer
 from .latex_editor import LatexEditor
 from .. import dialog
+from ...constants import ARGUMENT_ACTIVITY_REQUIREMENTS
 import importlib.util
 
 last_activity_tabview = None
@@ -334,18 +335,13 @@ def launch_detached_activity(page:Gtk.Widget, root):
 
 # Activity names for console arguments (e.g. --activity "camera")
 ARGUMENT_ACTIVITIES = {
-    'web-browser': WebBrowser,
-    'terminal': Terminal,
-    'attachment-creator': AttachmentCreator,
-    'camera': Camera
+    name: page for name, page in {
+        'web-browser': WebBrowser,
+        'terminal': Terminal,
+        'attachment-creator': AttachmentCreator,
+        'camera': Camera,
+        'live-chat': LiveChat,
+        'transcriber': Transcriber,
+        'background-remover': BackgroundRemover
+    }.items() if all(importlib.util.find_spec(module) for module in ARGUMENT_ACTIVITY_REQUIREMENTS.get(name))
 }
-
-if importlib.util.find_spec('kokoro') and importlib.util.find_spec('sounddevice'):
-    ARGUMENT_ACTIVITIES['live-chat'] = LiveChat
-
-if importlib.util.find_spec('whisper'):
-    ARGUMENT_ACTIVITIES['transcriber'] = Transcriber
-
-if importlib.util.find_spec('rembg'):
-    ARGUMENT_ACTIVITIES['background-remover'] = BackgroundRemover
-
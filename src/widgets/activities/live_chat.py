@@ -181,6 +181,8 @@ class LiveChat(Adw.Bin):
         chat.add_message(m_element)
 
         for old_attachment in list(self.global_footer.attachment_container.container):
+            if old_attachment.pending: # Still extracting, stays for the next message
+                continue
             attachment = m_element.add_attachment(
                 file_id = generate_uuid(),
                 name = old_attachment.file_name,
@@ -4,7 +4,7 @@ from gi.repository import Gtk, Gio, Adw, GLib, Gdk, WebKit
 from .. import dialog, attachments, models
 from ...sql_manager import generate_uuid, Instance as SQL
 from ...constants import cache_dir, WEB_BROWSER_HTML_EXTRACT_JS
-from markitdown import MarkItDown
+from ... import extraction
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 import tempfile, os, threading, requests, random
@@ -146,7 +146,7 @@ class WebBrowser(WebKit.WebView):
 
     def extract_md(self, save_func:callable):
         def on_html_extracted(raw_html:str):
-            md = MarkItDown(enable_plugins=False)
+            md = extraction.get_converter()
             markdown_text = raw_html
             try:
                 with tempfile.NamedTemporaryFile("w", suffix=".html", delete=False) as tmp_file:
@@ -2,61 +2,29 @@
 
 from gi.repository import Adw, Gtk, Gio, Gdk, GLib, Xdp
 
-import odf.opendocument as odfopen
-import odf.table as odftable
 from pydbus import SessionBus, Variant
-from markitdown import MarkItDown
 from html2text import html2text
-from io import BytesIO
-from PIL import Image
-from PIL.PngImagePlugin import PngInfo
+from collections import OrderedDict
 from ..constants import cache_dir
 import numpy as np
-import requests, json, base64, tempfile, shutil, logging, threading, os, re, cairo
+import json, base64, tempfile, shutil, logging, threading, hashlib, os, re, cairo
 
 from urllib.robotparser import RobotFileParser
 from urllib.parse import urlparse
 
 from . import blocks, dialog, voice, activities
 from ..sql_manager import Instance as SQL
+from .. import network, extraction, images
 
 logger = logging.getLogger(__name__)
 
+MAX_PREVIEW_TEXTURES = 256
+preview_textures = OrderedDict() # sha256: Gdk.Texture
+preview_textures_lock = threading.Lock()
+
 def extract_content(file_type:str, file_path:str) -> str:
-    if file_type in ('plain_text', 'code'):
-        with open(file_path, 'r') as f:
-            return f.read()
-    elif file_type in ('pdf', 'docx', 'pptx', 'youtube'):
-        return MarkItDown(enable_plugins=False).convert(file_path).text_content
-    elif file_type == 'odt':
-        doc = odfopen.load(file_path)
-        markdown_elements = []
-        for child in doc.text.childNodes:
-            if child.qname[1] == 'p' or child.qname[1] == 'span':
-                markdown_elements.append(str(child))
-            elif child.qname[1] == 'h':
-                markdown_elements.append('# {}'.format(str(child)))
-            elif child.qname[1] == 'table':
-                generated_table = []
-                column_sizes = []
-                for row in child.getElementsByType(odftable.TableRow):
-                    generated_table.append([])
-                    for column_n, cell in enumerate(row.getElementsByType(odftable.TableCell)):
-                        if column_n + 1 > len(column_sizes):
-                            column_sizes.append(0)
-                        if len(str(cell)) > column_sizes[column_n]:
-                            column_sizes[column_n] = len(str(cell))
-                        generated_table[-1].append(str(cell))
-                generated_table.insert(1, [])
-                for column_n in range(len(generated_table[0])):
-                    generated_table[1].append('-' * column_sizes[column_n])
-                table_str = ''
-                for row in generated_table:
-                    for column_n, cell in enumerate(row):
-                        table_str += '| {} '.format(cell.ljust(column_sizes[column_n], ' '))
-                    table_str += '|\n'
-                markdown_elements.append(table_str)
-        return '\n\n'.join(markdown_elements)
+    if file_type in ('plain_text', 'code', 'pdf', 'docx', 'pptx', 'odt', 'youtube'):
+        return extraction.extract_document(file_type, file_path)
     elif file_type == 'website':
         parsed_url = urlparse(file_path)
         base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
@@ -69,7 +37,7 @@ def extract_content(file_type:str, file_path:str) -> str:
 
         if rp.can_fetch("AlpacaBot", file_path):
             headers = {"User-Agent": "AlpacaBot"}
-            response = requests.get(file_path, headers=headers)
+            response = network.get(file_path, headers=headers)
             if response.status_code == 200:
                 return '{}\n\n{}'.format(file_path, html2text(response.text))
             else:
@@ -78,7 +46,7 @@ def extract_content(file_type:str, file_path:str) -> str:
             return "Fetching this URL is disallowed by robots.txt"
 
 def extract_online_image(image_url:str, max_size:int) -> str | None:
-    image_response = requests.get(image_url)
+    image_response = network.get(image_url)
     if image_response.status_code == 200:
         image_data = None
         image_path = os.path.join(cache_dir, 'image_web.jpg')
@@ -91,38 +59,27 @@ def extract_online_image(image_url:str, max_size:int) -> str | None:
 
 def extract_image(image_path:str, max_size:int) -> str:
     #Normal Image: 640, Profile Pictures: 128
-    with Image.open(image_path) as img:
-        img.load()
-        metadata = PngInfo()
-        source_data = img.info or {}
-        for key, value in source_data.items():
-            if key not in ('exif', 'dpi', 'icc_profile'):
-                metadata.add_text(key, str(value))
-
-        width, height = img.size
-        if width > height:
-            new_width = max_size
-            new_height = int((max_size / width) * height)
-        else:
-            new_height = max_size
-            new_width = int((max_size / height) * width)
-        resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-
-        with BytesIO() as output:
-            resized_img.save(
-                output,
-                format="PNG",
-                pnginfo=metadata,
-                exif=img.info.get('exif'),
-                dpi=img.info.get('dpi')
-            )
-            image_data = output.getvalue()
-        return base64.b64encode(image_data).decode("utf-8")
+    return images.extract_image(image_path, max_size)
+
+def get_preview_texture(image_hash:str) -> Gdk.Texture:
+    with preview_textures_lock:
+        texture = preview_textures.get(image_hash)
+        if texture:
+            preview_textures.move_to_end(image_hash)
+        return texture
+
+def add_preview_texture(image_hash:str, texture:Gdk.Texture) -> None:
+    with preview_textures_lock:
+        preview_textures[image_hash] = texture
+        while len(preview_textures) > MAX_PREVIEW_TEXTURES:
+            preview_textures.popitem(last=False)
 
 @Gtk.Template(resource_path='/com/jeffser/Alpaca/widgets/attachments/attachment.ui')
 class Attachment(Gtk.Button):
     __gtype_name__ = 'AlpacaAttachment'
 
+    pending:bool = False
+
     def __init__(self, file_id:str, file_name:str, file_type:str, file_content:str):
         self.file_name = file_name
         self.file_type = file_type
@@ -222,6 +179,17 @@ class Attachment(Gtk.Button):
     def get_content(self) -> str:
         return self.file_content
 
+    def set_pending(self, status:str) -> None:
+        self.pending = True
+        self.set_sensitive(False)
+        self.get_child().set_label('{} ({})'.format(self.file_name, status))
+
+    def set_content(self, content:str) -> None:
+        self.pending = False
+        self.file_content = content
+        self.set_sensitive(bool(content))
+        self.get_child().set_label(self.file_name)
+
     def delete(self):
         if self.activity:
             self.activity.close()
@@ -303,33 +271,61 @@ class Attachment(Gtk.Button):
 class ImageAttachment(Gtk.Button):
     __gtype_name__ = 'AlpacaImageAttachment'
 
-    def __init__(self, file_id:str, file_name:str, file_content:str):
+    def __init__(self, file_id:str, file_name:str, file_content:str=None, blob_id:str=None):
         super().__init__()
         self.file_name = file_name
         self.file_type = 'image'
-        self.file_content = file_content
+        self.inline_content = file_content
+        self.blob_id = blob_id
         self.activity = None
         self.texture = None
+        self.preview = None
         self.set_name(file_id)
 
+        # Stored images are keyed by the hash of their content
+        texture = get_preview_texture(self.blob_id) if self.blob_id else None
+        if texture:
+            self.set_preview(texture)
+        else:
+            images.pool.submit(self.load_preview)
+
+    def load_preview(self) -> None:
         try:
-            image_data = base64.b64decode(self.file_content)
-            self.texture = Gdk.Texture.new_from_bytes(GLib.Bytes.new(image_data))
-            image = Gtk.Picture.new_for_paintable(self.texture)
-            image.set_size_request(int((self.texture.get_width() * 240) / self.texture.get_height()), 240)
-            self.set_tooltip_text(_("Image"))
-            self.set_child(image)
-            self.set_sensitive(True)
+            image_data = self.get_bytes()
+            image_hash = self.blob_id or hashlib.sha256(image_data).hexdigest()
+            GLib.idle_add(self.on_preview_loaded, image_hash, images.get_preview(image_data, image_hash))
         except Exception as e:
             logger.error(e)
 
+    def on_preview_loaded(self, image_hash:str, preview_data:bytes) -> None:
+        try:
+            texture = Gdk.Texture.new_from_bytes(GLib.Bytes.new(preview_data))
+            add_preview_texture(image_hash, texture)
+            self.set_preview(texture)
+        except Exception as e:
+            logger.error(e)
+
+    def set_preview(self, texture:Gdk.Texture) -> None:
+        self.preview = texture
+        image = Gtk.Picture.new_for_paintable(texture)
+        image.set_size_request(int((texture.get_width() * 240) / texture.get_height()), 240)
+        self.set_tooltip_text(_("Image"))
+        self.set_child(image)
+        self.set_sensitive(True)
+
+    def get_texture(self) -> Gdk.Texture:
+        # The full size image is only decoded when it's opened
+        if not self.texture:
+            self.texture = Gdk.Texture.new_from_bytes(GLib.Bytes.new(self.get_bytes()))
+        return self.texture
+
     @Gtk.Template.Callback()
     def show_activity(self, button=None):
         if self.activity and self.activity.get_root():
             self.activity.on_reload()
-        elif self.texture:
+        elif self.preview:
             page = activities.ImageViewer(
-                texture=self.texture,
+                texture=self.get_texture(),
                 title=self.file_name,
                 delete_callback=self.prompt_delete,
                 download_callback=self.prompt_download
@@ -340,6 +336,24 @@ class ImageAttachment(Gtk.Button):
                 self.get_parent().get_parent().get_parent().force_dialog
             )
 
+    @property
+    def file_content(self) -> str:
+        # Stored images are only read from the blob store when they are needed
+        if self.blob_id:
+            return base64.b64encode(self.get_bytes()).decode('utf-8')
+        return self.inline_content
+
+    def get_bytes(self) -> bytes:
+        # set_blob() can run while a preview loads, it sets blob_id first
+        inline_content = self.inline_content
+        if self.blob_id:
+            return SQL.get_blob(self.blob_id)
+        return base64.b64decode(inline_content or '')
+
+    def set_blob(self, blob_id:str) -> None:
+        self.blob_id = blob_id
+        self.inline_content = None
+
     def get_content(self) -> str:
         return self.file_content
 
@@ -368,7 +382,7 @@ class ImageAttachment(Gtk.Button):
             path = file.get_path()
             if path:
                 with open(path, "wb") as f:
-                    f.write(base64.b64decode(self.file_content))
+                    f.write(self.get_bytes())
                 Gio.AppInfo.launch_default_for_uri('file://{}'.format(path))
         except GLib.Error as e:
             logger.error(e)
@@ -451,7 +465,7 @@ class AttachmentContainer(Gtk.ScrolledWindow):
     def attach_youtube(self, video_url:str):
         GLib.idle_add(self.get_root().global_footer.remove_text, video_url)
         content = extract_content('youtube', video_url)
-        title = requests.get('https://noembed.com/embed?url={}'.format(video_url)).json().get('title', 'YouTube')
+        title = network.get('https://noembed.com/embed?url={}'.format(video_url)).json().get('title', 'YouTube')
         attachment = Attachment(
             file_id="-1",
             file_name=title,
@@ -486,31 +500,59 @@ class AttachmentContainer(Gtk.ScrolledWindow):
             file_type = 'plain_text'
         else:
             file_type = found_types[0]
-        if file_type == 'image':
-            content = extract_image(file.get_path(), self.get_root().settings.get_value('max-image-size').unpack())
-            if not self.get_root().get_selected_model().get_vision():
-                dialog.show_toast(_("This model might not be compatible with image recognition"), self.get_root())
-        elif file_type == 'audio':
-            content = 'AUDIO NOT TRANSCRIBED'
-        else:
-            content = extract_content(file_type, file.get_path())
-        if content:
-            file_name = os.path.basename(file.get_path())
-            if file_type == 'code':
-                file_name = os.path.splitext(file_name)[0]
-            if file_type != 'audio':
-                attachment = Attachment(
-                    file_id="-1",
-                    file_name=file_name,
-                    file_type=file_type,
-                    file_content=content
-                )
-                self.add_attachment(attachment)
-            elif voice.libraries.get('whisper'):
+        if file_type == 'audio':
+            if voice.libraries.get('whisper'):
                 activities.show_activity(
                     activities.Transcriber(file),
                     self.get_root()
                 )
+        else:
+            if file_type == 'image' and not self.get_root().get_selected_model().get_vision():
+                dialog.show_toast(_("This model might not be compatible with image recognition"), self.get_root())
+            self.extract_attachment(file, file_type)
+
+    def extract_attachment(self, file:Gio.File, file_type:str):
+        """
+        Shows the attachment right away and fills it once its text is
+        extracted, dropping several files extracts them at the same time
+        """
+        file_name = os.path.basename(file.get_path())
+        if file_type == 'code':
+            file_name = os.path.splitext(file_name)[0]
+        attachment = Attachment(
+            file_id="-1",
+            file_name=file_name,
+            file_type=file_type,
+            file_content=None
+        )
+        attachment.set_pending(_('Waiting…'))
+        self.add_attachment(attachment)
+        root = self.get_root()
+        statuses = {
+            'reading': _('Reading…'),
+            'extracting': _('Extracting…')
+        }
+
+        def on_progress(stage:str):
+            GLib.idle_add(attachment.set_pending, statuses.get(stage))
+
+        def on_finish(future):
+            try:
+                content = future.result()
+            except Exception as e:
+                logger.error(e)
+                GLib.idle_add(dialog.show_toast, _("Couldn't extract '{}'").format(file_name), root)
+                content = None
+            if content:
+                GLib.idle_add(attachment.set_content, content)
+            else:
+                GLib.idle_add(lambda: attachment.get_parent() and attachment.delete())
+
+        if file_type == 'image':
+            future = images.extract(file.get_path(), root.settings.get_value('max-image-size').unpack())
+        else:
+            future = extraction.extract(file_type, file.get_path(), on_progress)
+        future.add_done_callback(on_finish)
 
     def attachment_request(self, block_images:bool=False):
         ff = Gtk.FileFilter()
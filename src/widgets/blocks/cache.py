@@ -0,0 +1,58 @@
+# cache.py
+"""
+Bounded caches for work that gets repeated every time a chat is rendered
+"""
+
+import hashlib, threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread safe LRU cache keyed by a hash of the content so long responses
+    aren't kept around twice just to be used as keys.
+    """
+
+    def __init__(self, max_size:int=512):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, content:str) -> bytes:
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, content:str, builder:callable):
+        """
+        Returns the cached value for content, calling builder(content) on a miss
+        """
+        key = self.get_key(content)
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items.get(key)
+            self.misses += 1
+
+        value = builder(content)
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.items),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0
+            }
@@ -9,11 +9,20 @@ from ...sql_manager import generate_uuid
 from ...constants import CODE_LANGUAGE_FALLBACK, CODE_LANGUAGE_PROPERTIES
 import re, unicodedata
 
+language_property_cache = {}
+source_language_cache = {}
+
 def get_language_property(language:str) -> dict:
-    for properties in CODE_LANGUAGE_PROPERTIES:
-        if language.lower() in properties.get('aliases', []):
-            return properties
-    return {}
+    language = language.lower()
+    if language not in language_property_cache:
+        language_property_cache[language] = next((properties for properties in CODE_LANGUAGE_PROPERTIES if language in properties.get('aliases', [])), {})
+    return language_property_cache.get(language)
+
+def get_source_language(language:str):
+    language = CODE_LANGUAGE_FALLBACK.get(language.lower(), language)
+    if language not in source_language_cache:
+        source_language_cache[language] = GtkSource.LanguageManager.get_default().get_language(language)
+    return source_language_cache.get(language)
 
 @Gtk.Template(resource_path='/com/jeffser/Alpaca/widgets/blocks/code.ui')
 class Code(Gtk.Box):
@@ -23,13 +32,17 @@ class Code(Gtk.Box):
     button_container = Gtk.Template.Child()
     edit_button = Gtk.Template.Child()
     run_button = Gtk.Template.Child()
-    buffer = Gtk.Template.Child()
+    scrolled_window = Gtk.Template.Child()
+    placeholder_label = Gtk.Template.Child()
 
     def __init__(self, content:str=None, language:str=None):
         super().__init__()
 
         self.raw_language = language
         self.code_language = None
+        self.code = ''
+        self.buffer = None # Created once the block gets shown
+        self.style_handler_id = None # Only connected while realized, the style manager outlives the block
         if content:
             self.set_content(content)
         if self.raw_language:
@@ -38,11 +51,45 @@ class Code(Gtk.Box):
         self.activity_runner = None
         self.activity_edit = None
 
-        Adw.StyleManager.get_default().connect(
-            'notify::dark',
-            lambda sm, gp: self.update_scheme()
+        self.connect('map', lambda *_: GLib.idle_add(self.create_source_view, priority=GLib.PRIORITY_LOW))
+        self.connect('unrealize', lambda *_: self.disconnect_style_manager())
+
+    def create_source_view(self) -> None:
+        """
+        Replaces the plain label with a highlighted GtkSource view
+        """
+        if not self.get_realized():
+            return
+        if not self.buffer:
+            self.create_buffer()
+        if self.style_handler_id is None:
+            self.style_handler_id = Adw.StyleManager.get_default().connect(
+                'notify::dark',
+                lambda sm, gp: self.update_scheme()
+            )
+            self.update_scheme()
+
+    def create_buffer(self) -> None:
+        self.buffer = GtkSource.Buffer(language=self.code_language)
+        self.buffer.set_text(self.code, len(self.code.encode('utf-8')))
+        view = GtkSource.View(
+            buffer=self.buffer,
+            auto_indent=True,
+            indent_width=4,
+            show_line_numbers=True,
+            editable=False,
+            top_margin=6,
+            bottom_margin=6,
+            left_margin=12,
+            right_margin=12,
+            css_classes=['code_block']
         )
-        self.update_scheme()
+        self.scrolled_window.set_child(view)
+
+    def disconnect_style_manager(self) -> None:
+        if self.style_handler_id is not None:
+            Adw.StyleManager.get_default().disconnect(self.style_handler_id)
+            self.style_handler_id = None
 
     def update_scheme(self):
         scheme_name = 'Adwaita'
@@ -63,14 +110,13 @@ class Code(Gtk.Box):
             self.activity_edit = activities.show_activity(ce, self.get_root())
 
     def save_edit(self, code:str) -> None:
-        self.buffer.set_text(code, len(code.encode('utf-8')))
+        self.set_content(code)
         GLib.idle_add(self.get_ancestor(message.Message).save)
 
     @Gtk.Template.Callback()
     def copy_code(self, button=None) -> None:
         clipboard = Gdk.Display().get_default().get_clipboard()
-        text = self.buffer.get_text(self.buffer.get_start_iter(), self.buffer.get_end_iter(), False)
-        clipboard.set(text)
+        clipboard.set(self.get_code())
         dialog.show_toast(_("Code copied to the clipboard"), self.get_root())
 
     @Gtk.Template.Callback()
@@ -122,7 +168,9 @@ class Code(Gtk.Box):
             cr.run()
 
     def get_code(self) -> str:
-        return self.buffer.get_text(self.buffer.get_start_iter(), self.buffer.get_end_iter(), False)
+        if self.buffer:
+            return self.buffer.get_text(self.buffer.get_start_iter(), self.buffer.get_end_iter(), False)
+        return self.code
 
     def get_language(self) -> str:
         if self.code_language:
@@ -132,9 +180,10 @@ class Code(Gtk.Box):
         return self.raw_language
 
     def set_language(self, value:str) -> None:
-        self.code_language = GtkSource.LanguageManager.get_default().get_language(CODE_LANGUAGE_FALLBACK.get(value.lower(), value))
+        self.code_language = get_source_language(value)
         self.language_label.set_label(self.get_language().title())
-        self.buffer.set_language(self.code_language)
+        if self.buffer:
+            self.buffer.set_language(self.code_language)
         self.run_button.set_visible(get_language_property(self.get_language()))
 
     def get_content(self) -> str:
@@ -150,4 +199,8 @@ class Code(Gtk.Box):
         return '\n'.join(lines)
 
     def set_content(self, value:str) -> None:
-        self.buffer.set_text(value, len(value.encode('utf-8')))
+        self.code = value
+        if self.buffer:
+            self.buffer.set_text(value, len(value.encode('utf-8')))
+        else:
+            self.placeholder_label.set_text(value)
@@ -7,8 +7,71 @@ import gi
 from gi.repository import Gtk, Gdk, Adw, GLib, Gio
 
 from matplotlib.backends.backend_gtk4agg import FigureCanvasGTK4Agg as FigureCanvas
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.figure import Figure
+from concurrent.futures import ThreadPoolExecutor
+import os, io, hashlib, logging
 from .. import dialog, activities
+from .cache import LRUCache
+from ...constants import cache_dir
+from ...extraction import trim_cache
+
+logger = logging.getLogger(__name__)
+
+# Matplotlib isn't thread safe, a single worker keeps renders off the main
+# thread without two figures being drawn at the same time
+render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='LatexRenderer')
+png_cache = LRUCache(max_size=256)
+png_cache_dir = os.path.join(cache_dir, 'latex')
+MAX_PNG_CACHE_SIZE = 32 * 1024 * 1024 # Bytes, least recently used renders go first
+
+def render_png(equation:str, font_size:int=24, color:str='black') -> bytes:
+    """
+    Renders the equation to PNG bytes, errors are rendered as plain text
+    like the interactive canvas does
+    """
+    figure = Figure(dpi=100)
+    FigureCanvasAgg(figure)
+    figure.patch.set_alpha(0)
+    buffer = io.BytesIO()
+    try:
+        figure.text(0, 0, equation, fontsize=font_size, color=color)
+        figure.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0.05, transparent=True)
+    except ValueError as e:
+        figure.clear()
+        figure.text(0, 0, str(e), fontsize=12, color=color, parse_math=False)
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0.05, transparent=True)
+    return buffer.getvalue()
+
+def get_png(equation:str, font_size:int=24, color:str='black') -> bytes:
+    """
+    PNG for the equation from memory, disk or a new render, in that order.
+    Dark mode is handled by the latex_renderer CSS class so color stays black.
+    """
+    key = '{}:{}:{}'.format(font_size, color, equation)
+
+    def load(key:str) -> bytes:
+        path = os.path.join(png_cache_dir, '{}.png'.format(hashlib.sha256(key.encode('utf-8')).hexdigest()))
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                png = f.read()
+            try:
+                os.utime(path) # Marks it as recently used
+            except OSError:
+                pass
+            return png
+        png = render_png(equation, font_size, color)
+        try:
+            os.makedirs(png_cache_dir, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(png)
+            trim_cache(png_cache_dir, MAX_PNG_CACHE_SIZE)
+        except OSError as e:
+            logger.error(e)
+        return png
+
+    return png_cache.get(key, load)
 
 class LatexCanvas(FigureCanvas):
     __gtype_name__ = 'AlpacaLatexCanvas'
@@ -75,30 +138,79 @@ class LatexRenderer(Gtk.Button):
     scrolled_window = Gtk.Template.Child()
 
     def __init__(self, content:str=None):
-        self.canvas = LatexCanvas()
+        self.equation = ''
+        self.png = None
         self.activity = None
-        super().__init__(
-            child=self.canvas
+        super().__init__()
+        self.picture = Gtk.Picture(
+            can_shrink=False,
+            halign=3,
+            valign=3,
+            css_classes=['latex_renderer']
         )
         if content:
             self.set_content(content)
 
     def get_content(self) -> str:
-        return '${}$'.format(self.canvas.get_text().strip('$'))
+        return '${}$'.format(self.equation)
 
     def get_content_for_dictation(self) -> str:
-        return self.canvas.get_text()
+        return self.get_text()
+
+    def get_text(self) -> str:
+        return '${}$'.format(self.equation)
+
+    def set_text(self, text:str) -> None:
+        self.set_content(text)
 
     def set_content(self, content:str=None) -> None:
-        content = content.strip().strip('$')
-        self.canvas.set_text('${}$'.format(content))
+        self.equation = content.strip().strip('$')
+        equation = self.equation
+        future = render_pool.submit(get_png, '${}$'.format(equation))
+        future.add_done_callback(lambda f: GLib.idle_add(self.on_rendered, equation, f))
+
+    def on_rendered(self, equation:str, future) -> None:
+        if equation != self.equation:
+            return
+        try:
+            self.png = future.result()
+        except Exception as e:
+            logger.error(e)
+            return
+        self.picture.set_paintable(Gdk.Texture.new_from_bytes(GLib.Bytes.new(self.png)))
+        if self.scrolled_window.get_child() != self.picture:
+            self.scrolled_window.set_child(self.picture)
+
+    def copy_equation(self) -> None:
+        clipboard = Gdk.Display().get_default().get_clipboard()
+        clipboard.set(self.get_text())
+        dialog.show_toast(_("Equation copied to the clipboard"), self.get_root())
+
+    def download_requested(self) -> None:
+        def on_download(file_dialog, result, user_data):
+            try:
+                file = file_dialog.save_finish(result)
+                path = file.get_path()
+                with open(path, 'wb') as f:
+                    f.write(self.png or get_png(self.get_text()))
+                Gio.AppInfo.launch_default_for_uri('file://{}'.format(path))
+                dialog.show_toast(_("Equation exported successfully"), self.get_root())
+            except GLib.Error as e:
+                logger.error(e)
+
+        file_dialog = Gtk.FileDialog(
+            title=_("Save Equation"),
+            initial_name="{}.png".format(_("equation"))
+        )
+        file_dialog.save(self.get_root(), None, on_download, None)
 
     @Gtk.Template.Callback()
     def edit_equation(self, button=None) -> None:
+        # The interactive canvas only exists inside the editor
         if self.activity:
             self.activity.on_reload()
         else:
-            page = activities.LatexEditor(self.canvas)
+            page = activities.LatexEditor(self)
             self.activity = activities.show_activity(
                 page,
                 self.get_root(),
@@ -116,12 +228,12 @@ class LatexRenderer(Gtk.Button):
         actions = [[
         {
             'label': _('Copy Equation'),
-            'callback': self.canvas.copy_equation,
+            'callback': self.copy_equation,
             'icon': 'edit-copy-symbolic'
         },
         {
             'label': _('Download as Image'),
-            'callback': self.canvas.download_requested,
+            'callback': self.download_requested,
             'icon': 'folder-download-symbolic'
         }]]
 
@@ -7,14 +7,16 @@ import gi
 from gi.repository import Gtk, Adw, GObject, Gio
 from .text import markdown_to_pango
 
-import re
-import pandas as pd
 from .. import dialog
 
 class MarkdownTable:
+    """
+    Plain lists of raw cell values, pango markup is only produced when a
+    cell gets bound in the column view
+    """
     def __init__(self):
         self.headers = []
-        self.rows = Gio.ListStore()
+        self.rows = []
         self.alignments = []
 
     def __repr__(self):
@@ -22,22 +24,43 @@ class MarkdownTable:
         #table_repr += 'Alignments: {}\n'.format(self.alignments)
         table_repr += 'Rows:\n'
         for row in self.rows:
-            table_repr += ' | '.join(row.raw_values) + '\n'
+            table_repr += ' | '.join(row) + '\n'
         return table_repr.replace('*', '')
 
-class Row(GObject.GObject):
-    def __init__(self, _values:list):
-        super().__init__()
-
-        self.values = []
-        self.raw_values = []
+def is_table_line(line:str) -> bool:
+    return len(line) > 2 and line.startswith('|') and line.endswith('|')
+
+def is_separator_line(line:str) -> bool:
+    columns = line.split('|')[1:-1]
+    return is_table_line(line) and all(column.strip() and set(column.strip()) <= set(':-') for column in columns)
+
+def parse_markdown_table(markdown_text:str) -> MarkdownTable:
+    """
+    Single pass over the lines of a markdown table
+    """
+    table = MarkdownTable()
+    lines = markdown_text.strip().split('\n')
+
+    if is_table_line(lines[0]):
+        table.headers = [header.strip() for header in lines[0][1:-1].replace("*", "").split('|') if header.strip()]
+
+    if is_separator_line(lines[1]):
+        for sep in lines[1].replace(" ", "").split('|')[1:-1]:
+            if ':' in sep:
+                if sep.startswith('-') and sep.endswith(':'):
+                    table.alignments.append(1)
+                elif sep.startswith(':') and sep.endswith('-'):
+                    table.alignments.append(0)
+                else:
+                    table.alignments.append(0.5)
+            else:
+                table.alignments.append(0) # Default alignment is start
 
-        for value in _values:
-            self.values.append(markdown_to_pango(value))
-            self.raw_values.append(value)
+    for line in lines[2:]:
+        if is_table_line(line):
+            table.rows.append(line.split('|')[1:-1])
 
-    def get_column_value(self, index):
-        return self.values[index]
+    return table
 
 @Gtk.Template(resource_path='/com/jeffser/Alpaca/widgets/blocks/table.ui')
 class Table(Gtk.Box):
@@ -58,46 +81,6 @@ class Table(Gtk.Box):
     def get_content_for_dictation(self) -> str:
         return str(self.table)
 
-    def parse_markdown_table(self, markdown_text:str):
-        # Define regex patterns for matching the table components
-        header_pattern = r'^\|(.+?)\|$'
-        separator_pattern = r'^\|(\s*[:-]+:?\s*\|)+$'
-        row_pattern = r'^\|(.+?)\|$'
-
-        # Split the text into lines
-        lines = markdown_text.strip().split('\n')
-
-        # Extract headers
-        header_match = re.match(header_pattern, lines[0], re.MULTILINE)
-        if header_match:
-            headers = [header.strip() for header in header_match.group(1).replace("*", "").split('|') if header.strip()]
-            self.table.headers = headers
-
-        # Extract alignments
-        separator_match = re.match(separator_pattern, lines[1], re.MULTILINE)
-        if separator_match:
-            alignments = []
-            separator_columns = lines[1].replace(" ", "").split('|')[1:-1]
-            for sep in separator_columns:
-                if ':' in sep:
-                    if sep.startswith('-') and sep.endswith(':'):
-                        alignments.append(1)
-                    elif sep.startswith(':') and sep.endswith('-'):
-                        alignments.append(0)
-                    else:
-                        alignments.append(0.5)
-                else:
-                    alignments.append(0)  # Default alignment is start
-            self.table.alignments = alignments
-
-        # Extract rows
-        for line in lines[2:]:
-            row_match = re.match(row_pattern, line, re.MULTILINE)
-            if row_match:
-                rows = line.split('|')[1:-1]
-                row = Row(rows)
-                self.table.rows.append(row)
-
     def make_table(self):
 
         def _on_factory_setup(_factory, list_item, align):
@@ -106,8 +89,8 @@ class Table(Gtk.Box):
 
         def _on_factory_bind(_factory, list_item, index):
             label_widget = list_item.get_child()
-            row = list_item.get_item()
-            label_widget.set_label(row.get_column_value(index))
+            row = self.table.rows[int(list_item.get_item().get_string())]
+            label_widget.set_label(markdown_to_pango(row[index]) if index < len(row) else '')
 
         for index, column_name in enumerate(self.table.headers):
             column = Gtk.ColumnViewColumn(title=column_name, expand=True)
@@ -117,7 +100,9 @@ class Table(Gtk.Box):
             column.set_factory(factory)
             self.columnview.append_column(column)
 
-        selection = Gtk.NoSelection.new(model=self.table.rows)
+        # The model only holds row indexes, the values stay in self.table.rows
+        model = Gtk.StringList.new([str(i) for i in range(len(self.table.rows))])
+        selection = Gtk.NoSelection.new(model=model)
         self.columnview.set_model(model=selection)
 
     def get_content(self) -> str:
@@ -126,7 +111,7 @@ class Table(Gtk.Box):
     def set_content(self, value:str) -> None:
         self.markdown = value
         try:
-            self.parse_markdown_table(self.markdown)
+            self.table = parse_markdown_table(self.markdown)
             self.make_table()
             self.main_stack.set_visible_child_name("table")
         except:
@@ -142,9 +127,10 @@ class Table(Gtk.Box):
                 rows = []
                 for row in self.table.rows:
                     rows.append([])
-                    for value in row.raw_values:
+                    for value in row:
                         rows[-1].append(value.strip())
 
+                import pandas as pd
                 df = pd.DataFrame(rows, columns=headers)
                 df.to_excel(file.get_path(), index=False)
                 dialog.show_toast(
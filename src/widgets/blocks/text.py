@@ -8,24 +8,35 @@ from gi.repository import GLib, Gtk, Gdk
 
 import re, unicodedata
 from ..message import Message
-
-def markdown_to_pango(text:str) -> str:
-    """Converts Markdown text to a limited version of PangoMarkup"""
+from .cache import LRUCache
+from ...block_parser import BlockTokenizer
+
+pango_patterns = (
+    (re.compile(r'\*\*(.*?)\*\*', re.MULTILINE), r'<b>\1</b>'),
+    (re.compile(r'\*(.*?)\*', re.MULTILINE), r'<i>\1</i>'),
+    (re.compile(r'^####\s+(.*)', re.MULTILINE), r'<span size="medium" weight="bold">\1</span>'),
+    (re.compile(r'^###\s+(.*)', re.MULTILINE), r'<span size="large">\1</span>'),
+    (re.compile(r'^##\s+(.*)', re.MULTILINE), r'<span size="x-large">\1</span>'),
+    (re.compile(r'^#\s+(.*)', re.MULTILINE), r'<span size="xx-large">\1</span>'),
+    (re.compile(r'_(\((.*?)\)|\d+)', re.MULTILINE), r'<sub>\2\1</sub>'),
+    (re.compile(r'\^(\((.*?)\)|\d+)', re.MULTILINE), r'<sup>\2\1</sup>'),
+    (re.compile(r'\[(.*?)\]\((.*?)\)', re.MULTILINE), r'<a href="\2">\1</a>')
+)
+pango_cache = LRUCache(max_size=2048)
+
+def convert_markdown_to_pango(text:str) -> str:
     text = GLib.markup_escape_text(text)
     text = text.replace("\n* ", "\n• ").replace("\n- ", "\n• ")
     text = text.replace("<|begin_of_solution|>", "")
     text = text.replace("<|end_of_solution|>", "")
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text, flags=re.MULTILINE)
-    text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text, flags=re.MULTILINE)
-    text = re.sub(r'^####\s+(.*)', r'<span size="medium" weight="bold">\1</span>', text, flags=re.MULTILINE)
-    text = re.sub(r'^###\s+(.*)', r'<span size="large">\1</span>', text, flags=re.MULTILINE)
-    text = re.sub(r'^##\s+(.*)', r'<span size="x-large">\1</span>', text, flags=re.MULTILINE)
-    text = re.sub(r'^#\s+(.*)', r'<span size="xx-large">\1</span>', text, flags=re.MULTILINE)
-    text = re.sub(r'_(\((.*?)\)|\d+)', r'<sub>\2\1</sub>', text, flags=re.MULTILINE)
-    text = re.sub(r'\^(\((.*?)\)|\d+)', r'<sup>\2\1</sup>', text, flags=re.MULTILINE)
-    text = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>', text, flags=re.MULTILINE)
+    for pattern, replacement in pango_patterns:
+        text = pattern.sub(replacement, text)
     return text
 
+def markdown_to_pango(text:str) -> str:
+    """Converts Markdown text to a limited version of PangoMarkup"""
+    return pango_cache.get(text, convert_markdown_to_pango)
+
 @Gtk.Template(resource_path='/com/jeffser/Alpaca/widgets/blocks/generating_text.ui')
 class GeneratingText(Gtk.Overlay):
     __gtype_name__ = 'AlpacaGeneratingText'
@@ -36,32 +47,40 @@ class GeneratingText(Gtk.Overlay):
     def __init__(self, content:str=None):
         super().__init__()
         self.textview.remove_css_class('view')
+        self.tokenizer = BlockTokenizer()
         if content:
             self.set_content(content)
 
-    def process_content(self, value:str) -> None:
-        current_text = self.get_content()
-        if value.endswith('\n'):
-            think_block_complete = not current_text.strip().startswith('<think>') or current_text.strip().endswith('</think>')
-            think_block_complete_v2 = not current_text.strip().startswith('<|begin_of_thought|>') or current_text.strip().endswith('<|end_of_thought|>')
-            code_block_complete = not current_text.strip().startswith('```') or (current_text.strip().endswith('```') and len(current_text.strip()) > 3)
-            table_block_complete = not current_text.strip().startswith('|') or '|\n\n' in current_text
-
-            if think_block_complete and think_block_complete_v2 and code_block_complete and table_block_complete:
-                self.set_content()
-                self.get_parent().add_content(current_text)
-
-    def append_content(self, value:str) -> None:
+    def insert_text(self, value:str) -> None:
         text = GLib.markup_escape_text(value)
         if text:
             self.buffer.insert_markup(self.buffer.get_end_iter(), text, len(text.encode('utf-8')))
-            self.process_content(value)
+
+    def append_content(self, value:str) -> None:
+        state = self.tokenizer.state
+        descriptors = self.tokenizer.feed(value)
+        if descriptors or self.tokenizer.state != state:
+            # The buffer only ever holds what the tokenizer hasn't closed yet
+            self.buffer.delete(self.buffer.get_start_iter(), self.buffer.get_end_iter())
+            self.insert_text(self.tokenizer.get_pending())
+            self.get_parent().add_blocks(descriptors)
+        else:
+            self.insert_text(value)
+
+    def finish(self) -> list:
+        """
+        Returns the descriptors of the blocks still open once the response ends
+        """
+        descriptors = self.tokenizer.finish()
+        self.buffer.delete(self.buffer.get_start_iter(), self.buffer.get_end_iter())
+        return descriptors
 
     def get_content(self) -> str:
         return self.buffer.get_text(self.buffer.get_start_iter(), self.buffer.get_end_iter(), False)
 
     def set_content(self, value:str=None) -> None:
         self.buffer.delete(self.buffer.get_start_iter(), self.buffer.get_end_iter())
+        self.tokenizer = BlockTokenizer()
         if value:
             GLib.idle_add(self.append_content, value)
 
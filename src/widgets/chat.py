@@ -5,14 +5,62 @@ Handles the chat widget
 
 import gi
 from gi.repository import Gtk, Gio, Adw, Gdk, GLib
-import logging, os, datetime, random, json, threading, re, importlib.util
+import logging, os, datetime, random, json, threading, re, importlib.util, bisect, base64
+from concurrent.futures import ThreadPoolExecutor
 from ..constants import SAMPLE_PROMPTS, cache_dir
+from .. import documents
 from ..sql_manager import generate_uuid, prettify_model_name, generate_numbered_name, Instance as SQL
 from . import dialog, voice, models, blocks
 from .message import Message
 
 logger = logging.getLogger(__name__)
 
+def string_to_datetime(value:str) -> datetime.datetime:
+    return datetime.datetime.strptime(value + (":00" if value.count(":") == 1 else ""), '%Y/%m/%d %H:%M:%S')
+
+# Shared by every chat so loading a long conversation doesn't spawn a thread per message
+message_loader = ThreadPoolExecutor(max_workers=4, thread_name_prefix='MessageLoader')
+
+class SearchScheduler:
+    """
+    Debounces search input, matches on a worker thread and applies the
+    results in a single idle callback. A newer query cancels older ones.
+    """
+
+    def __init__(self, delay:int=150):
+        self.delay = delay
+        self.timeout_id = None
+        self.generation = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Search')
+
+    def schedule(self, match:callable, apply:callable):
+        self.generation += 1
+        generation = self.generation
+        is_cancelled = lambda: generation != self.generation
+
+        def finish(results):
+            if not is_cancelled() and results is not None:
+                apply(results)
+
+        def run_match():
+            if is_cancelled():
+                return
+            try:
+                results = match(is_cancelled)
+            except Exception as e:
+                logger.error(e)
+                return
+            if not is_cancelled():
+                GLib.idle_add(finish, results)
+
+        def start():
+            self.timeout_id = None
+            self.executor.submit(run_match)
+
+        if self.timeout_id:
+            GLib.source_remove(self.timeout_id)
+        self.timeout_id = GLib.timeout_add(self.delay, start)
+
 
 @Gtk.Template(resource_path='/com/jeffser/Alpaca/widgets/chat/folder.ui')
 class Folder(Adw.NavigationPage):
@@ -114,8 +162,7 @@ class Folder(Adw.NavigationPage):
         else:
             self.list_stack.set_visible_child_name('content' if folder_visible or chat_visible else 'empty')
 
-    def on_search(self, raw_query:str):
-        query = re.escape(raw_query)
+    def on_search(self, raw_query:str, scheduler=None):
         root = self.get_root()
         include_messages = root.settings.get_value('folder-search-mode').unpack()
 
@@ -126,38 +173,42 @@ class Folder(Adw.NavigationPage):
             self.list_stack.set_visible_child_name('empty')
             return
 
-        for row in list(self.folder_list_box):
-            row.set_visible(re.search(query, row.get_name(), re.IGNORECASE))
+        # Snapshot the rows on the main thread, the worker only sees plain values
+        rows = [(row, row.get_name(), None) for row in list(self.folder_list_box)]
+        rows += [(row, row.get_name(), row.chat.chat_id) for row in list(self.chat_list_box)]
 
-            if row.get_visible():
-                if query:
-                    query_escaped = GLib.markup_escape_text(query)
-                    row_label_text = GLib.markup_escape_text(row.get_name())
-                    highlighted_text = re.sub(f"({query_escaped})", r"<span background='yellow' bgalpha='30%'>\1</span>", row_label_text, flags=re.IGNORECASE)
-                    row.label.set_markup(highlighted_text)
-                else:
-                    row.label.set_markup(row.get_name())
-
-        for row in list(self.chat_list_box):
-            title_match = re.search(query, row.get_name(), re.IGNORECASE)
-
-            messages_str = ""
-            message_match = False
-
-            if include_messages:
-                messages_str = '\n'.join([m.get('content') for m in row.chat.convert_to_ollama()]) or '\n'.join([m[4] for m in SQL.get_messages(row.chat)])
-                message_match = re.search(query, messages_str, re.IGNORECASE)
+        match = lambda is_cancelled: self.match_search(raw_query, rows, include_messages, is_cancelled)
+        if scheduler:
+            scheduler.schedule(match, self.apply_search)
+        else:
+            self.apply_search(match(lambda: False))
 
-            row.set_visible(title_match or message_match)
-            if row.get_visible():
+    def match_search(self, raw_query:str, rows:list, include_messages:bool, is_cancelled:callable) -> list:
+        query = re.escape(raw_query)
+        query_escaped = GLib.markup_escape_text(query)
+        matching_chat_ids = set()
+        if include_messages and raw_query.strip():
+            matching_chat_ids = SQL.search_chat_ids(raw_query)
+
+        results = []
+        for row, name, chat_id in rows:
+            if is_cancelled():
+                return None
+            visible = bool(re.search(query, name, re.IGNORECASE)) or chat_id in matching_chat_ids
+            markup = None
+            if visible:
                 if query:
-                    query_escaped = GLib.markup_escape_text(query)
-                    row_label_text = GLib.markup_escape_text(row.get_name())
-                    highlighted_text = re.sub(f"({query_escaped})", r"<span background='yellow' bgalpha='30%'>\1</span>", row_label_text, flags=re.IGNORECASE)
-                    row.label.set_markup(highlighted_text)
+                    markup = re.sub(f"({query_escaped})", r"<span background='yellow' bgalpha='30%'>\1</span>", GLib.markup_escape_text(name), flags=re.IGNORECASE)
                 else:
-                    row.label.set_markup(row.get_name())
-
+                    markup = name
+            results.append((row, visible, markup))
+        return results
+
+    def apply_search(self, results:list):
+        for row, visible, markup in results:
+            row.set_visible(visible)
+            if visible:
+                row.label.set_markup(markup)
         self.update_visibility(True)
 
     def update(self):
@@ -468,10 +519,21 @@ class Chat(Gtk.Stack):
     use_template_button = Gtk.Template.Child()
     use_character_button = Gtk.Template.Child()
 
+    render_margin: float = 1.0 # Pages around the viewport whose messages get rendered
+    recycle_margin: float = 4.0 # Rendered messages further than this many pages get recycled
+    page_size: int = 50 # Messages fetched at once, older pages load when scrolling up
+
     def __init__(self, chat_id:str=None, name:str=_("New Chat"), folder_id:str=None, is_template=False):
         super().__init__()
         self.set_name(name)
         self.busy = False
+        self.render_update_pending = False
+        self.rendered_messages = set()
+        self.oldest_loaded = None # (date_time, id) cursor of the oldest loaded message
+        self.has_older_messages = False
+        self.search_query = '' # Highlighted in messages that get rendered later
+        self.scroll_anchor = None # Distance from the bottom kept while older messages are prepended
+        self.scroll_anchor_lock = False
         self.chat_id = chat_id
         self.folder_id = folder_id
         self.is_template = is_template
@@ -479,6 +541,9 @@ class Chat(Gtk.Stack):
         self.use_template_button.set_visible(bool(self.chat_id))
         GLib.idle_add(self.update_prompts)
         GLib.idle_add(self.connect_model_selector)
+        vadjustment = self.scrolledwindow.get_vadjustment()
+        vadjustment.connect('value-changed', self.on_scroll)
+        vadjustment.connect('changed', self.on_scroll_range_changed)
         #self.connect('notify::root', lambda *_: self.connect_model_selector())
 
     def connect_model_selector(self):
@@ -496,24 +561,98 @@ class Chat(Gtk.Stack):
         use_character = char_dict.get('data', {}).get('extensions', {}).get('com.jeffser.Alpaca', {}).get('enabled', False)
         self.use_character_button.set_visible(use_character)
 
-    def on_search(self, query:str):
-        query = re.escape(query)
-        for m in list(self.container):
-            content = m.get_content()
-            if content:
-                string_search = re.search(query, content, re.IGNORECASE)
-                m.set_visible(string_search)
-                for block in list(m.block_container):
-                    if isinstance(block, blocks.text.Text):
-                        if query:
-                            query_escaped = GLib.markup_escape_text(query)
-                            block_content = GLib.markup_escape_text(block.get_content())
-                            highlighted_text = re.sub(f"({query_escaped})", r"<span background='yellow' bgalpha='30%'>\1</span>", block_content, flags=re.IGNORECASE)
-                            block.set_markup(highlighted_text)
-                        else:
-                            block.set_content(block.get_content())
-
-        GLib.idle_add(self.update_visibility, True)
+    def on_search(self, raw_query:str, scheduler=None):
+        # Older pages that aren't loaded as widgets are searched in the database
+        cursor = self.oldest_loaded if self.has_older_messages and self.chat_id else None
+        messages = self.get_search_snapshot(list(self.container))
+
+        match = lambda is_cancelled: self.match_search(raw_query, messages, cursor, is_cancelled)
+        if scheduler:
+            scheduler.schedule(match, lambda results: self.apply_search(raw_query, results))
+        else:
+            GLib.idle_add(self.apply_search, raw_query, match(lambda: False))
+
+    def get_search_snapshot(self, messages:list) -> list:
+        snapshot = []
+        for m in messages:
+            text_blocks = [(block, block.get_content()) for block in list(m.block_container) if isinstance(block, blocks.text.Text)]
+            snapshot.append((m, m.get_content(), text_blocks))
+        return snapshot
+
+    def match_search(self, raw_query:str, messages:list, cursor:tuple, is_cancelled:callable) -> tuple:
+        """
+        Matches the loaded messages and the ones older than the cursor, returns
+        the results and the (date_time, id) of the oldest hit not loaded yet
+        """
+        query = re.escape(raw_query)
+        oldest_hit = None
+        if raw_query and cursor:
+            for message in SQL.get_messages_page(self.chat_id, cursor[0], -1, cursor[1]):
+                if is_cancelled():
+                    return None
+                # Chronological order, the first hit is the oldest
+                if message[4] and re.search(query, message[4], re.IGNORECASE):
+                    oldest_hit = (message[3], message[0])
+                    break
+
+        results = self.match_messages(raw_query, messages, is_cancelled)
+        if results is None:
+            return None
+        return results, oldest_hit
+
+    def match_messages(self, raw_query:str, messages:list, is_cancelled:callable) -> list:
+        query = re.escape(raw_query)
+        query_escaped = GLib.markup_escape_text(query)
+        results = []
+        for m, content, text_blocks in messages:
+            if is_cancelled():
+                return None
+            if not content:
+                continue
+            markups = []
+            for block, block_content in text_blocks:
+                if query:
+                    markup = re.sub(f"({query_escaped})", r"<span background='yellow' bgalpha='30%'>\1</span>", GLib.markup_escape_text(block_content), flags=re.IGNORECASE)
+                else:
+                    markup = blocks.text.markdown_to_pango(block_content.strip())
+                markups.append((block, markup))
+            results.append((m, bool(re.search(query, content, re.IGNORECASE)), markups))
+        return results
+
+    def apply_search(self, raw_query:str, search:tuple):
+        results, oldest_hit = search
+        self.search_query = raw_query
+        if oldest_hit:
+            # Loads the pages down to the oldest hit, then matches what they added
+            first_loaded = self.container.get_first_child()
+            while self.has_older_messages and self.oldest_loaded and oldest_hit < self.oldest_loaded:
+                if not self.load_older_messages():
+                    break
+            loaded = []
+            for m in list(self.container):
+                if m == first_loaded:
+                    break
+                loaded.append(m)
+            results = self.match_messages(raw_query, self.get_search_snapshot(loaded), lambda: False) + results
+
+        for m, visible, markups in results:
+            m.set_visible(visible)
+            for block, markup in markups:
+                block.set_markup(markup)
+
+        if any(visible for m, visible, markups in results):
+            self.set_visible_child_name('content')
+        else:
+            self.set_visible_child_name('no-results' if len(list(self.container)) > 0 else 'welcome-screen')
+
+    def highlight_message(self, m) -> None:
+        """
+        Applies the current search to a message that was just rendered, its
+        blocks didn't exist when the search ran
+        """
+        for message, visible, markups in self.match_messages(self.search_query, self.get_search_snapshot([m]), lambda: False):
+            for block, markup in markups:
+                block.set_markup(markup)
 
     def update_visibility(self, searching:bool=False):
         for m in list(self.container):
@@ -538,62 +677,204 @@ class Chat(Gtk.Stack):
         self.container.append(message)
         GLib.idle_add(self.update_visibility)
 
+    def on_scroll(self, vadjustment):
+        if not self.scroll_anchor_lock:
+            self.scroll_anchor = None
+        self.schedule_render_update()
+
+    def on_scroll_range_changed(self, vadjustment):
+        if self.scroll_anchor is not None:
+            self.scroll_anchor_lock = True
+            vadjustment.set_value(vadjustment.get_upper() - self.scroll_anchor)
+            self.scroll_anchor_lock = False
+        self.schedule_render_update()
+
+    def schedule_render_update(self):
+        if not self.render_update_pending:
+            self.render_update_pending = True
+            GLib.idle_add(self.update_rendered_messages)
+
+    def update_rendered_messages(self):
+        """
+        Renders the messages close to the viewport and recycles the blocks
+        of the ones that scrolled far away, so long chats only keep a
+        window of messages rendered.
+        """
+        self.render_update_pending = False
+        viewport = self.scrolledwindow.get_child()
+        vadjustment = self.scrolledwindow.get_vadjustment()
+        page_size = vadjustment.get_page_size()
+        if not viewport or not self.get_mapped() or page_size <= 0:
+            return
+
+        def get_bounds(message) -> tuple:
+            success, rect = message.compute_bounds(viewport)
+            if success:
+                return rect.get_y(), rect.get_y() + rect.get_height()
+            return -1, -1
+
+        top = vadjustment.get_value()
+        bottom = top + page_size
+
+        if self.has_older_messages and top < page_size:
+            self.scroll_anchor = vadjustment.get_upper() - top
+            self.load_older_messages()
+
+        messages = [m for m in list(self.container) if m.get_visible()]
+
+        index = bisect.bisect_left(messages, top - page_size * self.render_margin, key=lambda m: get_bounds(m)[1])
+        for message in messages[index:]:
+            if get_bounds(message)[0] > bottom + page_size * self.render_margin:
+                break
+            message.materialize()
+            self.rendered_messages.add(message)
+
+        for message in list(self.rendered_messages):
+            message_top, message_bottom = get_bounds(message)
+            if message.get_parent() != self.container:
+                self.rendered_messages.discard(message)
+            elif message_bottom < top - page_size * self.recycle_margin or message_top > bottom + page_size * self.recycle_margin:
+                message.dematerialize()
+                self.rendered_messages.discard(message)
+
     def load_messages(self):
-        def load_message(message_element, content):
-            attachments = SQL.get_attachments(message_element)
-            message_element.block_container.set_content(content)
+        self.oldest_loaded = None
+        self.has_older_messages = True
+        self.load_older_messages()
+        self.scroll_anchor = 0 # Start at the most recent message
+        GLib.idle_add(self.update_visibility)
 
+    def load_older_messages(self, limit:int=None) -> int:
+        """
+        Prepends the page of messages older than the oldest loaded one,
+        limit -1 loads every remaining message.
+        """
+        def load_message(message_element, attachments):
             for attachment in attachments:
                 message_element.add_attachment(
                     file_id=attachment[0],
                     name=attachment[2],
                     attachment_type=attachment[1],
-                    content=attachment[3]
+                    content=attachment[3],
+                    blob_id=attachment[4]
                 )
 
-        messages = SQL.get_messages(self)
+        if not self.has_older_messages:
+            return 0
+
+        limit = limit or self.page_size
+        cursor = self.oldest_loaded or (None, None)
+        messages, attachments = SQL.get_chat_bundle(self.chat_id, cursor[0], limit, cursor[1])
+        self.has_older_messages = limit > 0 and len(messages) == limit
+        if messages:
+            self.oldest_loaded = (messages[0][3], messages[0][0])
+
+        previous_element = None
         for message in messages:
             message_element = Message(
-                dt=datetime.datetime.strptime(message[3] + (":00" if message[3].count(":") == 1 else ""), '%Y/%m/%d %H:%M:%S'),
+                dt=string_to_datetime(message[3]),
                 message_id=message[0],
                 mode=('user', 'assistant', 'system').index(message[1]),
                 author=message[2]
             )
-            threading.Thread(target=load_message, args=(message_element, message[4])).start()
-            self.container.append(message_element)
-        GLib.idle_add(self.update_visibility)
+            message_element.set_pending_content(message[4])
+            message_loader.submit(load_message, message_element, attachments.get(message[0], []))
+            self.container.insert_child_after(message_element, previous_element)
+            previous_element = message_element
+        self.schedule_render_update()
+        return len(messages)
+
+    def get_message_records(self, stop_before:Message=None) -> list:
+        """
+        Lightweight records of the chat's messages, messages from older
+        pages that haven't been loaded as widgets are read from the database.
+        """
+        records = []
+        if self.has_older_messages and self.oldest_loaded:
+            messages, attachments = SQL.get_chat_bundle(self.chat_id, self.oldest_loaded[0], -1, self.oldest_loaded[1])
+            for message in messages:
+                files = [{
+                    'id': a[0],
+                    'type': a[1],
+                    'name': a[2],
+                    'content': base64.b64encode(SQL.get_blob(a[4])).decode('utf-8') if a[4] else a[3]
+                } for a in attachments.get(message[0], [])]
+                mode = ('user', 'assistant', 'system').index(message[1])
+                records.append({
+                    'mode': mode,
+                    'dt': string_to_datetime(message[3]),
+                    'model': (message[2] or None) if mode == 1 else None,
+                    'content': message[4],
+                    'images': [f for f in files if f.get('type') == 'image'],
+                    'attachments': [f for f in files if f.get('type') != 'image']
+                })
 
-    def convert_to_ollama(self) -> list:
-        messages = []
         for message in list(self.container):
-            if message.get_content() and message.dt:
-                message_data = {
-                    'role': ('user', 'assistant', 'system')[message.mode],
-                    'content': ''
-                }
+            if message == stop_before:
+                break
+            records.append({
+                'mode': message.mode,
+                'dt': message.dt,
+                'model': message.get_model(),
+                'content': message.get_content(),
+                'images': message.image_attachment_container.get_content(),
+                'attachments': message.attachment_container.get_content()
+            })
+        return records
+
+    def get_prompt_records(self, stop_before:Message=None) -> list:
+        return [record for record in self.get_message_records(stop_before) if record.get('content') and record.get('dt')]
+
+    def convert_to_ollama(self, stop_before:Message=None, num_ctx:int=None, reserved_tokens:int=0, records:list=None) -> list:
+        """
+        Messages in the format the instances use, when num_ctx is given long
+        documents are trimmed to the chunks relevant to the latest message.
+        reserved_tokens are kept for content the instance adds afterwards.
+        """
+        if records is None:
+            records = self.get_prompt_records(stop_before)
+        if num_ctx and records:
+            document_attachments = [a for record in records for a in record.get('attachments') if a.get('type') in documents.DOCUMENT_TYPES]
+            if document_attachments:
+                used_tokens = reserved_tokens + sum(documents.estimate_tokens(record.get('content')) for record in records)
+                used_tokens += sum(documents.estimate_tokens(a.get('content') or '') for record in records for a in record.get('attachments') if a.get('type') not in documents.DOCUMENT_TYPES + ('thought', 'metadata'))
+                fitted = documents.fit_documents(
+                    [a.get('content') or '' for a in document_attachments],
+                    records[-1].get('content'),
+                    documents.get_document_budget(num_ctx, used_tokens)
+                )
+                for attachment, content in zip(document_attachments, fitted):
+                    attachment['content'] = content
 
-                for image in message.image_attachment_container.get_content():
-                    if 'images' not in message_data:
-                        message_data['images'] = []
+        messages = []
+        for record in records:
+            message_data = {
+                'role': ('user', 'assistant', 'system')[record.get('mode')],
+                'content': ''
+            }
 
-                    message_data['images'].append(image['content'])
+            for image in record.get('images'):
+                if 'images' not in message_data:
+                    message_data['images'] = []
 
-                for attachment in message.attachment_container.get_content():
-                    if attachment.get('type') not in ('thought', 'metadata'):
-                        message_data['content'] += '```{} ({})\n{}\n```\n\n'.format(attachment.get('name'), attachment.get('type'), attachment.get('content'))
-                message_data['content'] += message.get_content()
-                messages.append(message_data)
+                message_data['images'].append(image['content'])
+
+            for attachment in record.get('attachments'):
+                if attachment.get('type') not in ('thought', 'metadata'):
+                    message_data['content'] += '```{} ({})\n{}\n```\n\n'.format(attachment.get('name'), attachment.get('type'), attachment.get('content'))
+            message_data['content'] += record.get('content')
+            messages.append(message_data)
         return messages
 
     def convert_to_json(self, include_metadata:bool=False) -> list:
         messages = []
-        for message in list(self.container):
-            if message.get_content() and message.dt:
+        for record in self.get_message_records():
+            if record.get('content') and record.get('dt'):
                 message_data = {
-                    'role': ('user', 'assistant', 'system')[message.mode],
+                    'role': ('user', 'assistant', 'system')[record.get('mode')],
                     'content': []
                 }
-                for image in message.image_attachment_container.get_content():
+                for image in record.get('images'):
                     message_data['content'].append({
                         'type': 'image_url',
                         'image_url': f'data:image/png;base64,{image.get("content")}'
@@ -602,15 +883,15 @@ class Chat(Gtk.Stack):
                     'type': 'text',
                     'text': ''
                 })
-                for attachment in message.attachment_container.get_content():
+                for attachment in record.get('attachments'):
                     if attachment.get('type') == 'thought':
                         message_data['thinking'] = attachment.get('content')
                     elif attachment.get('type') != 'metadata':
                         message_data['content'][0]['text'] += '```{} ({})\n{}\n```\n\n'.format(attachment.get('name'), attachment.get('type'), attachment.get('content'))
-                message_data['content'][0 if ("text" in message_data.get("content", [''])[0]) else 1]['text'] += message.get_content()
+                message_data['content'][0 if ("text" in message_data.get("content", [''])[0]) else 1]['text'] += record.get('content')
                 if include_metadata:
-                    message_data['date'] = message.dt.strftime("%Y/%m/%d %H:%M:%S")
-                    message_data['model'] = message.get_model()
+                    message_data['date'] = record.get('dt').strftime("%Y/%m/%d %H:%M:%S")
+                    message_data['model'] = record.get('model')
                 messages.append(message_data)
         return messages
 
@@ -1086,17 +1367,17 @@ class ChatRow(Gtk.ListBoxRow):
     def export_md(self, obsidian:bool):
         logger.info("Exporting chat (MD)")
         markdown = []
-        for message_element in list(self.chat.container):
-            if message_element.get_content() and message_element.dt:
+        for record in self.chat.get_message_records():
+            if record.get('content') and record.get('dt'):
                 message_author = _('User')
-                if message_element.get_model():
-                    message_author = prettify_model_name(message_element.get_model())
-                if message_element.mode == 2:
+                if record.get('model'):
+                    message_author = prettify_model_name(record.get('model'))
+                if record.get('mode') == 2:
                     message_author = _('System')
 
-                markdown.append('### **{}** | {}'.format(message_author, message_element.dt.strftime("%Y/%m/%d %H:%M:%S")))
-                markdown.append(message_element.get_content())
-                for file in message_element.image_attachment_container.get_content():
+                markdown.append('### **{}** | {}'.format(message_author, record.get('dt').strftime("%Y/%m/%d %H:%M:%S")))
+                markdown.append(record.get('content'))
+                for file in record.get('images'):
                     markdown.append('![🖼️ {}](data:image/{};base64,{})'.format(file.get('name'), file.get('name').split('.')[1], file.get('content')))
                 emojis = {
                     'plain_text': '📃',
@@ -1106,7 +1387,7 @@ class ChatRow(Gtk.ListBoxRow):
                     'website': '🌐',
                     'thought': '🧠'
                 }
-                for file in message_element.attachment_container.get_content():
+                for file in record.get('attachments'):
                     if obsidian:
                         file_block = "> [!quote]- {}\n".format(file.get('name'))
                         for line in file.get('content').split("\n"):
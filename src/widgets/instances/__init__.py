@@ -54,6 +54,8 @@ class InstancePreferencesDialog(Adw.Dialog):
     model_directory_el = Gtk.Template.Child()
     default_model_el = Gtk.Template.Child()
     title_model_el = Gtk.Template.Child()
+    title_keep_alive_el = Gtk.Template.Child()
+    embedding_model_el = Gtk.Template.Child()
 
     def __init__(self, instance):
         super().__init__()
@@ -140,22 +142,31 @@ class InstancePreferencesDialog(Adw.Dialog):
             factory.connect("bind", lambda factory, list_item: list_item.get_child().set_label(list_item.get_item().get_string()))
             self.default_model_el.set_factory(factory)
             self.title_model_el.set_factory(factory)
+            self.embedding_model_el.set_factory(factory)
 
             string_list_default = Gtk.StringList()
             string_list_title = Gtk.StringList()
             string_list_title.append(_('Use Current Model'))
+            string_list_embedding = Gtk.StringList()
+            string_list_embedding.append(_('Disabled'))
             self.model_list = self.instance.get_local_models()
             for i, model in enumerate(self.model_list):
                 string_list_default.append(prettify_model_name(model.get('name')))
                 string_list_title.append(prettify_model_name(model.get('name')))
+                string_list_embedding.append(prettify_model_name(model.get('name')))
 
             self.default_model_el.set_model(string_list_default)
             self.set_simple_element_value(self.default_model_el)
             self.title_model_el.set_model(string_list_title)
             self.set_simple_element_value(self.title_model_el)
+            self.set_simple_element_value(self.title_keep_alive_el)
+            self.embedding_model_el.set_model(string_list_embedding)
+            self.set_simple_element_value(self.embedding_model_el)
         else:
             self.default_model_el.set_visible(False)
             self.title_model_el.set_visible(False)
+            self.title_keep_alive_el.set_visible(False)
+            self.embedding_model_el.set_visible(False)
 
     def set_simple_element_value(self, el):
         if el.get_name().startswith('override:'):
@@ -169,7 +180,7 @@ class InstancePreferencesDialog(Adw.Dialog):
                 value = self.instance.properties.get('overrides', {}).get(el.get_name().removeprefix('override:'))
             else:
                 value = self.instance.properties.get(el.get_name())
-            if el.get_name() in ('default_model', 'title_model'):
+            if el.get_name() in ('default_model', 'title_model', 'embedding_model'):
                 in_properties = len(list(el.get_model())) > 0
                 if isinstance(value, dict):
                     value = value.get('name')
@@ -203,7 +214,7 @@ class InstancePreferencesDialog(Adw.Dialog):
                 return None
             index = el.get_selected()
             return self.model_list[index].get('name')
-        elif el.get_name() == 'title_model':
+        elif el.get_name() in ('title_model', 'embedding_model'):
             index = el.get_selected()
             if index == 0 or len(self.model_list) == 0:
                 return None
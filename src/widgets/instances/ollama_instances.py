@@ -5,9 +5,11 @@ from gi.repository import Adw, Gtk, GLib
 import json, logging, os, shutil, subprocess, threading, re, signal, pwd, getpass, datetime, time, ollama
 from .ollama_manager import OllamaManager, get_latest_ollama_tag
 from .. import dialog, tools, chat
+from . import titles
 from ...ollama_models import OLLAMA_MODELS
-from ...constants import data_dir, cache_dir, TITLE_GENERATION_PROMPT_OLLAMA, OLLAMA_BINARY_PATH, CAN_SELF_MANAGE_OLLAMA, is_ollama_installed
+from ...constants import data_dir, cache_dir, TITLE_GENERATION_PROMPT_OLLAMA, RETRIEVAL_PROMPT, OLLAMA_BINARY_PATH, CAN_SELF_MANAGE_OLLAMA, is_ollama_installed
 from ...sql_manager import generate_uuid, dict_to_metadata_string, Instance as SQL
+from ... import network, retrieval, documents
 
 logger = logging.getLogger(__name__)
 
@@ -49,7 +51,21 @@ class BaseInstance:
             chat_element.busy = True
             GLib.idle_add(chat_element.set_visible_child_name, 'content')
 
-        messages = chat_element.convert_to_ollama()[:list(chat_element.container).index(bot_message)]
+        # Only trim documents when we know the context size the model gets
+        num_ctx = self.properties.get('num_ctx') if self.properties.get('override_parameters') else None
+        records = chat_element.get_prompt_records(stop_before=bot_message)
+        retrieval_message = None
+        excerpts = self.get_excerpts(chat_element, records, num_ctx)
+        if excerpts:
+            retrieval_message = {
+                'role': 'system',
+                'content': '{}\n\n{}'.format(RETRIEVAL_PROMPT, '\n\n---\n\n'.join(excerpts))
+            }
+        messages = chat_element.convert_to_ollama(
+            num_ctx=num_ctx,
+            reserved_tokens=documents.estimate_tokens(retrieval_message.get('content')) if retrieval_message else 0,
+            records=records
+        )
 
         character_dict = SQL.get_model_preferences(model).get('character', {})
         if character_dict.get('data', {}).get('extensions', {}).get('com.jeffser.Alpaca', {}).get('enabled', False):
@@ -68,36 +84,45 @@ class BaseInstance:
                             break
                     messages.insert(index, lore_message)
 
+        if retrieval_message and len(messages) > 0:
+            messages.insert(len(messages) - 1, retrieval_message)
+
         return chat_element, messages
 
+    def get_excerpts(self, chat_element, records:list, num_ctx:int=None) -> list:
+        """
+        Chunks of other chats relevant to what the user wrote, without the
+        documents attached to it
+        """
+        embedding_model = self.properties.get('embedding_model')
+        if not embedding_model or not chat_element.chat_id or len(records) == 0:
+            return []
+        try:
+            excerpts = retrieval.retrieve(self.get_embeddings, embedding_model, chat_element.chat_id, records[-1].get('content'))
+        except Exception as e:
+            logger.error(e)
+            return []
+        if num_ctx:
+            # Excerpts take at most half of what the documents could use
+            used_tokens = sum(documents.estimate_tokens(record.get('content')) for record in records)
+            excerpts = retrieval.fit_excerpts(excerpts, documents.get_document_budget(num_ctx, used_tokens) // 2)
+        return excerpts
+
+    def get_embeddings(self, model:str, texts:list) -> list:
+        return self.client.embed(model=model, input=texts, truncate=True).embeddings
+
     def generate_message(self, bot_message, model:str):
         chat, messages = self.prepare_chat(bot_message, model)
 
         if chat.chat_id and chat.get_name().startswith(_("New Chat")):
-            threading.Thread(
-                target=self.generate_chat_title,
-                args=(
-                    chat,
-                    messages[-1].get('content'),
-                    model
-                ),
-                daemon=True
-            ).start()
+            titles.title_queue.request(self, chat, messages[-1].get('content'), model)
         self.generate_response(bot_message, chat, messages, model)
 
     def use_tools(self, bot_message, model:str, available_tools:dict):
         chat, messages = self.prepare_chat(bot_message, model)
 
         if chat.chat_id and chat.get_name().startswith(_("New Chat")):
-            threading.Thread(
-                target=self.generate_chat_title,
-                args=(
-                    chat,
-                    messages[-1].get('content'),
-                    model
-                ),
-                daemon=True
-            ).start()
+            titles.title_queue.request(self, chat, messages[-1].get('content'), model)
 
         self.generate_response(bot_message, chat, messages, model, available_tools=available_tools)
 
@@ -141,12 +166,12 @@ class BaseInstance:
                 params["options"]["seed"] = self.properties.get('seed')
 
         metadata_string = ""
-        tool_calls = []
-        thought = ""
-        content = ""
         try:
             bot_message.block_container.clear()
             while chat.busy:
+                tool_calls = []
+                thought = ""
+                content = ""
                 params['messages'] = messages
                 response = self.client.chat(**params)
                 for chunk in response:
@@ -178,38 +203,10 @@ class BaseInstance:
 
                 messages.append({'role': 'assistant', 'thinking': thought, 'content': content, 'tool_calls': tool_calls})
 
-                for call in tool_calls:
-                    selected_tool = available_tools.get(call.function.name)
-                    tool_response = selected_tool.run(
-                        call.function.arguments,
-                        messages,
-                        bot_message
-                    )
-                    messages.append({"role": "tool", "tool_name": call.function.name, "content": str(tool_response)})
-                    attachment_content = []
-
-                    if len(call.function.arguments) > 0:
-                        attachment_content += [
-                            '## {}'.format(_('Arguments')),
-                            '| {} | {} |'.format(_('Argument'), _('Value')),
-                            '| --- | --- |'
-                        ]
-                        attachment_content += ['| {} | {} |'.format(k, v) for k, v in call.function.arguments.items()]
-
-                    attachment_content += [
-                        '## {}'.format(_('Result')),
-                        str(tool_response)
-                    ]
-
-                    def add_attachment():
-                        attachment = bot_message.add_attachment(
-                            file_id = generate_uuid(),
-                            name = selected_tool.display_name,
-                            attachment_type = 'tool',
-                            content = '\n'.join(attachment_content)
-                        )
-                        SQL.insert_or_update_attachment(bot_message, attachment)
-                    GLib.idle_add(add_attachment)
+                calls = [(call.function.name, call.function.arguments) for call in tool_calls]
+                tool_responses = tools.run_tool_calls(calls, available_tools, messages, bot_message)
+                for (name, arguments), tool_response in zip(calls, tool_responses):
+                    messages.append({"role": "tool", "tool_name": name, "content": str(tool_response)})
 
         except ollama.ResponseError as e:
             logger.error(e)
@@ -251,15 +248,19 @@ class BaseInstance:
             metadata_string = None
         bot_message.finish_generation(metadata_string)
 
-    def generate_chat_title(self, chat, prompt:str, fallback_model:str):
-        if not chat.row or not chat.row.get_parent():
-            return
-        model = self.get_title_model()
+    def generate_chat_title(self, chat, prompt:str, fallback_model:str) -> str:
+        model = self.get_title_model() or fallback_model
+        # Never unload the model that is answering, otherwise keep the title
+        # model around for a while so the next new chat doesn't reload it
+        if model == fallback_model:
+            keep_alive = self.properties.get('keep_alive', 300)
+        else:
+            keep_alive = int(self.properties.get('title_keep_alive', 0))
         params = {
             "options": {
                 "temperature": 0.2
             },
-            "model": model or fallback_model,
+            "model": model,
             "stream": False,
             "messages": [
                 {
@@ -279,25 +280,13 @@ class BaseInstance:
                 ]
             },
             'think': False,
-            "keep_alive": 0
+            "keep_alive": keep_alive
         }
         if self.properties.get("override_parameters"):
             params["options"]["num_ctx"] = self.properties.get('num_ctx', 16384)
-        try:
-            response = self.client.chat(**params)
-            data = json.loads(response.message.content or '{"title": "New Chat"}')
-            generated_title = data.get('title').replace('\n', '').strip()
-
-            if len(generated_title) > 30:
-                generated_title = generated_title[:30].strip() + '...'
-
-            GLib.idle_add(
-                chat.row.edit,
-                generated_title,
-                chat.is_template
-            )
-        except Exception as e:
-            logger.exception(e)
+        response = self.client.chat(**params)
+        data = json.loads(response.message.content or '{}')
+        return data.get('title')
 
     def get_default_model(self):
         local_models = self.get_local_models()
@@ -323,7 +312,7 @@ class BaseInstance:
                 headers={
                     'Authorization': 'Bearer {}'.format(self.properties.get('api'))
                 },
-                verify=not self.properties.get('allow_self_signed_ssl', False)
+                transport=network.get_transport(not self.properties.get('allow_self_signed_ssl', False))
             )
 
     def get_local_models(self) -> list:
@@ -451,9 +440,11 @@ class OllamaManaged(BaseInstance):
         'seed': 0,
         'num_ctx': 16384,
         'keep_alive': 300,
+        'title_keep_alive': 60,
         'model_directory': os.path.join(data_dir, '.ollama', 'models'),
         'default_model': None,
         'title_model': None,
+        'embedding_model': None,
         'overrides': {
             'HSA_OVERRIDE_GFX_VERSION': '',
             'CUDA_VISIBLE_DEVICES': '',
@@ -618,7 +609,7 @@ class OllamaManaged(BaseInstance):
                 headers={
                     'Authorization': 'Bearer {}'.format(self.properties.get('api'))
                 },
-                verify=not self.properties.get('allow_self_signed_ssl', False)
+                transport=network.get_transport(not self.properties.get('allow_self_signed_ssl', False))
             )
 
 class Ollama(BaseInstance):
@@ -635,8 +626,10 @@ class Ollama(BaseInstance):
         'seed': 0,
         'num_ctx': 16384,
         'keep_alive': 300,
+        'title_keep_alive': 60,
         'default_model': None,
         'title_model': None,
+        'embedding_model': None,
         'think': False,
         'share_name': 0,
         'show_response_metadata': False,
@@ -2,7 +2,8 @@
 
 from gi.repository import Adw, Gtk, GLib, Gio
 from ...constants import is_ollama_installed, is_rocm_installed, OLLAMA_BINARY_PATH, CAN_SELF_MANAGE_OLLAMA, DEVICE_ARCH, cache_dir, data_dir
-import requests, os, threading, tarfile, shutil
+import os, threading, tarfile, shutil
+from ... import network
 import zstandard as zstd
 from pathlib import Path
 
@@ -89,7 +90,7 @@ class OllamaManager(Adw.Dialog):
             self.installer_statuspage.set_description('{} / {}'.format(done, remaining))
             self.installer_statuspage.get_child().set_fraction(downloaded / total)
 
-        response = requests.get(url, stream=True)
+        response = network.get(url, stream=True)
         response.raise_for_status()
 
         total_size = int(response.headers.get('content-length', 0))
@@ -276,7 +277,7 @@ class OllamaManager(Adw.Dialog):
 def get_latest_ollama_tag() -> str or None:
     url = f"https://api.github.com/repos/ollama/ollama/releases/latest"
     try:
-        response = requests.get(url, timeout=10)
+        response = network.get(url, timeout=10)
         response.raise_for_status()
         return response.json().get('tag_name')
     except:
@@ -2,12 +2,14 @@
 
 from gi.repository import Adw, GLib
 
-import openai, requests, json, logging, threading, re
+import openai, json, logging, threading, re
 from pydantic import BaseModel
 
 from .. import dialog, tools, chat
+from . import titles
 from ...sql_manager import generate_uuid, Instance as SQL
 from ...constants import MAX_TOKENS_TITLE_GENERATION, TITLE_GENERATION_PROMPT_OPENAI
+from ... import network, completion
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +49,8 @@ class BaseInstance:
     def start(self):
         if not self.client:
             arguments = {
-                'api_key': self.properties.get('api')
+                'api_key': self.properties.get('api'),
+                'http_client': network.get_http_client()
             }
             if self.instance_type != 'chatgpt':
                 arguments['base_url'] = self.properties.get('url').strip()
@@ -87,7 +90,7 @@ class BaseInstance:
             chat_element.busy = True
             GLib.idle_add(chat_element.set_visible_child_name, 'content')
 
-        messages = chat_element.convert_to_ollama()[:list(chat_element.container).index(bot_message)]
+        messages = chat_element.convert_to_ollama(stop_before=bot_message)
 
         character_dict = SQL.get_model_preferences(model).get('character', {})
         if character_dict.get('data', {}).get('extensions', {}).get('com.jeffser.Alpaca', {}).get('enabled', False):
@@ -112,15 +115,7 @@ class BaseInstance:
         chat, messages = self.prepare_chat(bot_message, model)
 
         if chat.chat_id and chat.get_name().startswith(_("New Chat")):
-            threading.Thread(
-                target=self.generate_chat_title,
-                args=(
-                    chat,
-                    messages[-1].get('content'),
-                    model
-                ),
-                daemon=True
-            ).start()
+            titles.title_queue.request(self, chat, messages[-1].get('content'), model)
 
         self.generate_response(bot_message, chat, messages, model)
 
@@ -128,74 +123,11 @@ class BaseInstance:
         chat, messages = self.prepare_chat(bot_message, model)
 
         if chat.chat_id and chat.get_name().startswith(_("New Chat")):
-            threading.Thread(
-                target=self.generate_chat_title,
-                args=(
-                    chat,
-                    messages[-1].get('content'),
-                    model
-                ),
-                daemon=True
-            ).start()
+            titles.title_queue.request(self, chat, messages[-1].get('content'), model)
 
-        try:
-            completion = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                tools=[v.get_metadata() for v in available_tools.values()]
-            )
-            if completion.choices[0] and completion.choices[0].message:
-                if completion.choices[0].message.tool_calls:
-                    for call in completion.choices[0].message.tool_calls:
-                        # Parse arguments once
-                        arguments = json.loads(call.function.arguments)
-                        
-                        if available_tools.get(call.function.name):
-                            tool_response = available_tools.get(call.function.name).run(arguments, messages, bot_message)
-
-                            attachment_content = []
-
-                            if len(arguments) > 0:
-                                attachment_content += [
-                                    '## {}'.format(_('Arguments')),
-                                    '| {} | {} |'.format(_('Argument'), _('Value')),
-                                    '| --- | --- |'
-                                ]
-                                attachment_content += ['| {} | {} |'.format(k, v) for k, v in arguments.items()]
-
-                            attachment_content += [
-                                '## {}'.format(_('Result')),
-                                tool_response
-                            ]
-
-                            attachment = bot_message.add_attachment(
-                                file_id = generate_uuid(),
-                                name = available_tools.get(call.function.name).name,
-                                attachment_type = 'tool',
-                                content = '\n'.join(attachment_content)
-                            )
-                            SQL.insert_or_update_attachment(bot_message, attachment)
-                        else:
-                            tool_response = ''
-
-                        messages.append({
-                            "role": "tool",
-                            "tool_call_id": call.id,
-                            "content": str(tool_response)
-                        })
-
-        except Exception as e:
-            dialog.simple_error(
-                parent = bot_message.get_root(),
-                title = _('Tool Error'),
-                body = _('An error occurred while running tool'),
-                error_log = e
-            )
-            logger.error(e)
+        self.generate_response(bot_message, chat, messages, model, available_tools=available_tools)
 
-        self.generate_response(bot_message, chat, messages, model)
-
-    def generate_response(self, bot_message, chat, messages:list, model:str):
+    def generate_response(self, bot_message, chat, messages:list, model:str, available_tools:dict={}):
         if 'no-system-messages' in self.limitations:
             for i in range(len(messages)):
                 if messages[i].get('role') == 'system':
@@ -222,17 +154,33 @@ class BaseInstance:
             if self.properties.get('seed', 0) != 0:
                 params["seed"] = self.properties.get('seed')
 
+        if available_tools:
+            params["tools"] = [v.get_metadata() for v in available_tools.values()]
+
         if chat.busy:
             try:
                 bot_message.block_container.clear()
-                response = self.client.chat.completions.create(**params)
-                for chunk in response:
-                    if chunk.choices and chunk.choices[0].delta:
-                        delta = chunk.choices[0].delta
-                        if delta.content:
-                            bot_message.update_message(delta.content)
-                    if not chat.busy:
+                while chat.busy:
+                    params['messages'] = messages
+                    streamed = completion.StreamedCompletion()
+                    response = self.client.chat.completions.create(**params)
+                    for chunk in response:
+                        content, reasoning = streamed.add_chunk(chunk)
+                        if reasoning:
+                            bot_message.update_thinking(reasoning)
+                        if content:
+                            bot_message.update_message(content)
+                        if not chat.busy:
+                            break
+
+                    GLib.idle_add(bot_message.remove_and_attach_thought)
+
+                    if not streamed.tool_calls or not chat.busy:
                         break
+
+                    messages.append(streamed.get_assistant_message())
+                    tool_responses = tools.run_tool_calls(streamed.get_calls(), available_tools, messages, bot_message)
+                    messages.extend(streamed.get_tool_messages(tool_responses))
             except Exception as e:
                 dialog.simple_error(
                     parent = bot_message.get_root(),
@@ -245,7 +193,7 @@ class BaseInstance:
                     GLib.idle_add(self.row.get_parent().unselect_all)
         bot_message.finish_generation()
 
-    def generate_chat_title(self, chat, prompt:str, fallback_model:str):
+    def generate_chat_title(self, chat, prompt:str, fallback_model:str) -> str:
         class ChatTitle(BaseModel): # Pydantic
             title: str
             emoji: str = ""
@@ -261,7 +209,7 @@ class BaseInstance:
             "messages": messages,
             "max_tokens": MAX_TOKENS_TITLE_GENERATION
         }
-        new_chat_title = chat.get_name()
+        new_chat_title = None
 
         try:
             completion = self.client.chat.completions.parse(**params, response_format=ChatTitle)
@@ -270,22 +218,11 @@ class BaseInstance:
                 emoji = response.parsed.emoji if len(response.parsed.emoji) == 1 else ''
                 new_chat_title = '{} {}'.format(emoji, response.parsed.title)
         except Exception as e:
-            try:
-                response = self.client.chat.completions.create(**params)
-                new_chat_title = str(response.choices[0].message.content)
-            except Exception as e:
-                logger.error(e)
-        
-        new_chat_title = re.sub(r'<think>.*?</think>', '', new_chat_title).strip()
-
-        if len(new_chat_title) > 30:
-            new_chat_title = new_chat_title[:30].strip() + '...'
+            response = self.client.chat.completions.create(**params)
+            new_chat_title = str(response.choices[0].message.content)
 
-        GLib.idle_add(
-            chat.row.edit,
-            new_chat_title,
-            chat.is_template
-        )
+        if new_chat_title:
+            return re.sub(r'<think>.*?</think>', '', new_chat_title, flags=re.DOTALL).strip()
 
     def get_default_model(self):
         local_models = self.get_local_models()
@@ -360,7 +297,7 @@ class Gemini(BaseInstance):
         try:
             if not self.available_models or len(self.available_models) == 0:
                 self.available_models = {}
-                response = requests.get('https://generativelanguage.googleapis.com/v1beta/models?key={}'.format(self.properties.get('api')))
+                response = network.get('https://generativelanguage.googleapis.com/v1beta/models?key={}'.format(self.properties.get('api')))
                 for model in response.json().get('models', []):
                     if "generateContent" in model.get("supportedGenerationMethods", []) and 'deprecated' not in model.get('description', ''):
                         model['name'] = model.get('name').removeprefix('models/')
@@ -380,7 +317,7 @@ class Gemini(BaseInstance):
 
     def get_model_info(self, model_name:str) -> dict:
         try:
-            response = requests.get('https://generativelanguage.googleapis.com/v1beta/models/{}?key={}'.format(model_name, self.properties.get('api')))
+            response = network.get('https://generativelanguage.googleapis.com/v1beta/models/{}?key={}'.format(model_name, self.properties.get('api')))
             data = response.json()
             data['capabilities'] = ['completion', 'vision']
             return data
@@ -397,7 +334,7 @@ class Together(BaseInstance):
         try:
             if not self.available_models or len(self.available_models) == 0:
                 self.available_models = {}
-                response = requests.get(
+                response = network.get(
                     'https://api.together.xyz/v1/models',
                     headers={
                         'accept': 'application/json',
@@ -463,7 +400,7 @@ class OpenRouter(BaseInstance):
         try:
             if not self.available_models or len(self.available_models) == 0:
                 self.available_models = {}
-                response = requests.get('https://openrouter.ai/api/v1/models')
+                response = network.get('https://openrouter.ai/api/v1/models')
                 for model in response.json().get('data', []):
                     if model.get('id'):
                         self.available_models[model.get('id')] = {'display_name': model.get('name')}
@@ -497,7 +434,7 @@ class Fireworks(BaseInstance):
         try:
             if not self.available_models or len(self.available_models) == 0:
                 self.available_models = {}
-                response = requests.get(
+                response = network.get(
                     'https://api.fireworks.ai/inference/v1/models',
                     headers={
                         'Authorization': f'Bearer {self.properties.get("api")}'
@@ -530,7 +467,7 @@ class LambdaLabs(BaseInstance):
         try:
             if not self.available_models or len(self.available_models) == 0:
                 self.available_models = {}
-                response = requests.get(
+                response = network.get(
                     'https://api.lambdalabs.com/v1/models',
                     headers={
                         'Authorization': f'Bearer {self.properties.get("api")}'
@@ -608,7 +545,7 @@ class CompactifAI(BaseInstance):
         try:
             if not self.available_models or len(self.available_models) == 0:
                 self.available_models = {}
-                response = requests.get(
+                response = network.get(
                     f'{self.instance_url}/models',
                     headers={
                         'Authorization': f'Bearer {self.properties.get("api")}'
@@ -649,7 +586,8 @@ class SarvamAI(BaseInstance):
             self.client = openai.OpenAI(
                 api_key=self.properties.get('api'),
                 base_url=self.properties.get('url').strip(),
-                default_headers={"api-subscription-key": self.properties.get('api')}
+                default_headers={"api-subscription-key": self.properties.get('api')},
+                http_client=network.get_http_client()
             )
 
 class AtlasCloud(BaseInstance):
@@ -678,7 +616,8 @@ class Cloudflare(BaseInstance):
             # Connect using the extracted account_id and api_key
             self.client = openai.OpenAI(
                 api_key=api_key or "NOKEY",
-                base_url=f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/v1"
+                base_url=f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/v1",
+                http_client=network.get_http_client()
             )
 
     def get_available_models(self) -> dict:
@@ -694,7 +633,7 @@ class Cloudflare(BaseInstance):
                     account_id, api_key = api_prop.split(':', 1)
                     
                 if account_id and api_key:
-                    response = requests.get(
+                    response = network.get(
                         f'https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/models/search',
                         headers={'Authorization': f'Bearer {api_key}'}
                     )
@@ -0,0 +1,102 @@
+# titles.py
+"""
+Queue that generates chat titles once the first reply is done
+"""
+
+from gi.repository import GLib
+from concurrent.futures import ThreadPoolExecutor
+import logging, re, threading
+
+logger = logging.getLogger(__name__)
+
+MAX_TITLE_LENGTH = 30
+
+def shorten_title(title:str) -> str:
+    title = re.sub(r'\s+', ' ', title).strip()
+    if len(title) > MAX_TITLE_LENGTH:
+        title = title[:MAX_TITLE_LENGTH].strip() + '...'
+    return title
+
+def heuristic_title(prompt:str) -> str:
+    """
+    Builds a title out of the first line of the prompt, no model involved
+    """
+    for line in prompt.splitlines():
+        line = re.sub(r'[`*_#>\[\]()~|]', '', line)
+        line = re.sub(r'\s+', ' ', line).strip(' .,:;!?-')
+        if line:
+            break
+    else:
+        return None
+
+    if len(line) > MAX_TITLE_LENGTH:
+        words = []
+        for word in line.split(' '):
+            if len(' '.join(words + [word])) > MAX_TITLE_LENGTH:
+                break
+            words.append(word)
+        line = (' '.join(words) or line[:MAX_TITLE_LENGTH]).rstrip(' .,:;!?-') + '...'
+    return line[0].upper() + line[1:]
+
+class TitleQueue:
+    """
+    Titles used to be generated in their own thread as soon as the message was
+    sent, loading the title model next to the one answering. Requests are now
+    deduplicated per chat, wait until the chat stops generating and run in a
+    small pool.
+    """
+
+    def __init__(self, max_workers:int=2, check_interval:int=250):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='TitleGeneration')
+        self.check_interval = check_interval
+        self.pending = {} # chat_id: job
+        self.lock = threading.Lock()
+
+    def request(self, instance, chat, prompt:str, fallback_model:str) -> None:
+        if not chat.chat_id:
+            return
+        with self.lock:
+            if chat.chat_id in self.pending:
+                return
+            self.pending[chat.chat_id] = {
+                'instance': instance,
+                'chat': chat,
+                'prompt': prompt or '',
+                'fallback_model': fallback_model,
+                'use_model': chat.get_root().settings.get_value('generate-chat-titles').unpack()
+            }
+        GLib.timeout_add(self.check_interval, self.check, chat.chat_id)
+
+    def check(self, chat_id:str) -> bool:
+        job = self.pending.get(chat_id)
+        if not job:
+            return False
+        if job.get('chat').busy:
+            return True
+        self.executor.submit(self.run, chat_id, job)
+        return False
+
+    def run(self, chat_id:str, job:dict) -> None:
+        chat = job.get('chat')
+        try:
+            if not chat.row or not chat.row.get_parent() or not chat.get_name().startswith(_("New Chat")):
+                return
+            title = None
+            # Short prompts already make a fine title
+            if job.get('use_model') and len(job.get('prompt').split()) > 3:
+                try:
+                    title = job.get('instance').generate_chat_title(chat, job.get('prompt'), job.get('fallback_model'))
+                except Exception as e:
+                    logger.error(e)
+            title = shorten_title(title or '') or heuristic_title(job.get('prompt'))
+            if title:
+                GLib.idle_add(
+                    chat.row.edit,
+                    title,
+                    chat.is_template
+                )
+        finally:
+            with self.lock:
+                self.pending.pop(chat_id, None)
+
+title_queue = TitleQueue()
@@ -5,7 +5,7 @@ Handles the message widget
 
 import gi
 from gi.repository import Gtk, Gio, Adw, GLib, Gdk, GtkSource, Spelling
-import os, datetime, threading, sys, base64, logging, re, tempfile
+import os, datetime, threading, sys, base64, hashlib, logging, re, tempfile, time
 from ..sql_manager import prettify_model_name, generate_uuid, format_datetime, Instance as SQL
 from . import attachments, blocks, dialog, voice, tools, models, chat, activities
 
@@ -124,6 +124,8 @@ class BlockContainer(Gtk.Box):
         super().__init__()
         self.generating_block = None
         self.thinking_block = None
+        self.streamed_block = None
+        self.streamed_text = ''
 
     def show_generating_block(self):
         if not self.generating_block or not self.generating_block.get_parent():
@@ -140,6 +142,9 @@ class BlockContainer(Gtk.Box):
             GLib.idle_add(self.prepend, self.thinking_block)
 
     def clear(self) -> None:
+        message = self.get_ancestor(Message)
+        if message:
+            message.pending_content = None
         for child in list(self):
             if child != self.generating_block:
                 self.remove(child)
@@ -160,25 +165,45 @@ class BlockContainer(Gtk.Box):
         if not message.popup.tts_button.get_active() and (self.get_root().settings.get_value('tts-auto-dictate').unpack() or (chat_element and chat_element.chat_id=='LiveChat')):
             message.popup.tts_button.set_active(True)
 
-    def add_content(self, content:str) -> None:
+    def add_blocks(self, descriptors:list) -> None:
         """
-        Used for live generation rendering
+        Used for live generation rendering, the blocks the tokenizer closed go
+        right before the generating block. Text is joined to the previous text
+        block until a blank line, after it a new text block starts so only the
+        last paragraph gets rendered again.
         """
 
-        for block in blocks.text_to_block_list(content):
-            if len(list(self)) <= 1:
-                GLib.idle_add(self.prepend, block)
+        if self.generating_block and self.generating_block.get_parent():
+            last_block = self.generating_block.get_prev_sibling()
+        else:
+            last_block = self.get_last_child()
+
+        for descriptor in descriptors:
+            if descriptor[0] == 'text':
+                text = ''.join(descriptor[1])
+                if isinstance(last_block, blocks.Text):
+                    if last_block is not self.streamed_block:
+                        self.streamed_block, self.streamed_text = last_block, last_block.get_content()
+                    if not text.strip():
+                        self.streamed_text += text
+                        continue
+                    # Whitespace where both pieces meet, two line breaks make a blank line
+                    gap = self.streamed_text[len(self.streamed_text.rstrip()):] + text[:len(text) - len(text.lstrip())]
+                    if gap.count('\n') < 2:
+                        self.streamed_text += text
+                        last_block.set_content(self.streamed_text)
+                        continue
+                if not text.strip():
+                    continue
+                block = blocks.Text(content=text)
+                self.streamed_block, self.streamed_text = block, text
+            else:
+                block = blocks.build_block(descriptor)
+            if last_block:
+                self.insert_child_after(block, last_block)
             else:
-                if isinstance(list(self)[-2], blocks.Text) and isinstance(block, blocks.Text):
-                    if not list(self)[-2].get_content().endswith('\n') or block.get_content().startswith('\n'):
-                        GLib.idle_add(list(self)[-2].append_content, '\n{}'.format(block.get_content()))
-                    else:
-                        GLib.idle_add(list(self)[-2].append_content, block.get_content())
-                elif isinstance(list(self)[-2], blocks.Text) and not isinstance(block, blocks.Text):
-                    GLib.idle_add(list(self)[-2].set_content, list(self)[-2].get_content().strip())
-                    GLib.idle_add(self.insert_child_after, block, list(self)[-2])
-                else:
-                    GLib.idle_add(self.insert_child_after, block, list(self)[-2])
+                self.prepend(block)
+            last_block = block
         GLib.idle_add(self.check_if_should_tts)
 
     def get_content(self) -> list:
@@ -188,6 +213,81 @@ class BlockContainer(Gtk.Box):
         self.show_thinking_block()
         GLib.idle_add(self.thinking_block.append_content, content)
 
+class StreamBuffer:
+    """
+    Collects the deltas of a generating response from the worker thread and
+    hands them to the message once per frame instead of once per token.
+    """
+
+    frame_interval = 16 # ms
+
+    def __init__(self, message):
+        self.message = message
+        self.lock = threading.Lock()
+        self.content = []
+        self.thinking = []
+        self.flush_id = None
+        self.scheduled_time = 0
+        self.start_time = None
+        self.stats = {
+            'tokens': 0,
+            'frames': 0,
+            'frames_dropped': 0,
+            'queue_depth': 0,
+            'max_queue_depth': 0
+        }
+
+    def push(self, content:str=None, thinking:str=None) -> None:
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.monotonic()
+            if content:
+                self.content.append(content)
+            if thinking:
+                self.thinking.append(thinking)
+            self.stats['tokens'] += 1
+            self.stats['queue_depth'] = len(self.content) + len(self.thinking)
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.stats['queue_depth'])
+            if self.flush_id is None:
+                self.scheduled_time = time.monotonic()
+                self.flush_id = GLib.timeout_add(self.frame_interval, self.flush)
+
+    def flush(self) -> bool:
+        with self.lock:
+            content = ''.join(self.content)
+            thinking = ''.join(self.thinking)
+            self.content.clear()
+            self.thinking.clear()
+            self.stats['queue_depth'] = 0
+            if self.flush_id is not None:
+                # Anything later than one extra frame means the main loop skipped frames
+                late = (time.monotonic() - self.scheduled_time) * 1000 - self.frame_interval
+                if late > self.frame_interval:
+                    self.stats['frames_dropped'] += int(late // self.frame_interval)
+            self.flush_id = None
+        self.stats['frames'] += 1
+        self.message.apply_stream(content, thinking)
+        return False
+
+    def finish(self) -> None:
+        """
+        Cancels the pending frame and queues a last flush, anything added to
+        the main loop after this call sees the complete response
+        """
+        with self.lock:
+            if self.flush_id is not None:
+                GLib.source_remove(self.flush_id)
+                self.flush_id = None
+        GLib.idle_add(self.flush)
+        logger.info(str(self.get_stats()))
+
+    def get_stats(self) -> dict:
+        elapsed = time.monotonic() - self.start_time if self.start_time else 0
+        return {
+            **self.stats,
+            'tokens_per_second': round(self.stats['tokens'] / elapsed, 2) if elapsed else 0
+        }
+
 @Gtk.Template(resource_path='/com/jeffser/Alpaca/widgets/message/message.ui')
 class Message(Gtk.Box):
     __gtype_name__ = 'AlpacaMessage'
@@ -213,6 +313,8 @@ class Message(Gtk.Box):
         self.dt = dt
         self.option_button = None
         self.message_id = message_id
+        self.pending_content = None # Raw content waiting to be turned into blocks
+        self.stream_buffer = None
 
         super().__init__()
         self.popup = OptionPopup()
@@ -228,11 +330,51 @@ class Message(Gtk.Box):
         self.update_profile_picture()
 
     def get_content(self) -> str:
+        if self.pending_content is not None:
+            return self.pending_content
         return '\n'.join(self.block_container.get_content())
 
     def get_content_for_dictation(self) -> str:
+        if self.pending_content is not None:
+            return self.pending_content
         return '\n'.join([c.get_content_for_dictation().strip() for c in list(self.block_container) if c is not None])
 
+    def set_pending_content(self, content:str, height:int=-1) -> None:
+        """
+        Keeps the raw content without building its blocks, the chat renders
+        it with materialize() once the message gets close to the viewport.
+        """
+        self.pending_content = content
+        if height < 0:
+            lines = content.count('\n') + len(content) // 100 + 1
+            height = min(lines * 20, 1000)
+        self.main_stack.set_size_request(-1, height)
+
+    def is_materialized(self) -> bool:
+        return self.pending_content is None
+
+    def materialize(self) -> None:
+        if self.pending_content is not None:
+            content = self.pending_content
+            self.pending_content = None
+            self.block_container.set_content(content)
+            GLib.idle_add(self.main_stack.set_size_request, -1, -1)
+            chat_element = self.get_ancestor(chat.Chat)
+            if chat_element and chat_element.search_query:
+                # Runs after the blocks are appended
+                GLib.idle_add(chat_element.highlight_message, self)
+
+    def dematerialize(self) -> None:
+        """
+        Drops the blocks of a message that scrolled far away, its current
+        height is kept so the scroll position doesn't jump.
+        """
+        if self.pending_content is None and self.main_stack.get_visible_child_name() == 'content' and not (self.block_container.generating_block and self.block_container.generating_block.get_parent()):
+            content = self.get_content()
+            height = self.main_stack.get_height()
+            self.block_container.clear()
+            self.set_pending_content(content, height)
+
     def get_model(self) -> str or None:
         """
         Get the model name if the author is a model
@@ -266,8 +408,11 @@ class Message(Gtk.Box):
             )
 
             # Prepare profile picture
-            image_data = base64.b64decode(pfp_b64)
-            texture = Gdk.Texture.new_from_bytes(GLib.Bytes.new(image_data))
+            picture_hash = hashlib.sha256(pfp_b64.encode()).hexdigest()
+            texture = attachments.get_preview_texture(picture_hash)
+            if not texture:
+                texture = Gdk.Texture.new_from_bytes(GLib.Bytes.new(base64.b64decode(pfp_b64)))
+                attachments.add_preview_texture(picture_hash, texture)
             image_element = Gtk.Image.new_from_paintable(texture)
             image_element.set_size_request(40, 40)
             image_element.set_pixel_size(40)
@@ -298,9 +443,9 @@ class Message(Gtk.Box):
             pfp_b64=SQL.get_model_preferences(self.get_model()).get('picture')
         )
 
-    def add_attachment(self, file_id:str, name:str, attachment_type:str, content:str):
+    def add_attachment(self, file_id:str, name:str, attachment_type:str, content:str, blob_id:str=None):
         if attachment_type == 'image':
-            new_image = attachments.ImageAttachment(file_id, name, content)
+            new_image = attachments.ImageAttachment(file_id, name, content, blob_id)
             GLib.idle_add(self.image_attachment_container.add_attachment, new_image)
             return new_image
         else:
@@ -323,29 +468,37 @@ class Message(Gtk.Box):
                 self.block_container.remove(self.block_container.thinking_block)
             self.block_container.thinking_block = None
 
+    def get_stream_buffer(self) -> StreamBuffer:
+        if not self.stream_buffer:
+            self.stream_buffer = StreamBuffer(self)
+        return self.stream_buffer
+
     def update_message(self, content:str):
         if content:
-            GLib.idle_add(self.block_container.generating_block.append_content, content)
-            GLib.idle_add(self.main_stack.set_visible_child_name, 'content')
-
-            chat_element = self.get_ancestor(chat.Chat)
-            if chat_element:
-                vadjustment = chat_element.scrolledwindow.get_vadjustment()
-                if vadjustment.get_value() + 150 >= vadjustment.get_upper() - vadjustment.get_page_size():
-                    GLib.idle_add(vadjustment.set_value, vadjustment.get_upper() - vadjustment.get_page_size())
-
-            GLib.idle_add(self.remove_and_attach_thought)
+            self.get_stream_buffer().push(content=content)
 
     def update_thinking(self, content):
         if content:
-            self.block_container.add_thinking(content)
-            GLib.idle_add(self.main_stack.set_visible_child_name, 'content')
+            self.get_stream_buffer().push(thinking=content)
 
-            chat_element = self.get_ancestor(chat.Chat)
-            if chat_element:
-                vadjustment = chat_element.scrolledwindow.get_vadjustment()
-                if vadjustment.get_value() + 150 >= vadjustment.get_upper() - vadjustment.get_page_size():
-                    GLib.idle_add(vadjustment.set_value, vadjustment.get_upper() - vadjustment.get_page_size())
+    def apply_stream(self, content:str, thinking:str) -> None:
+        """
+        Runs on the main loop with everything streamed since the last frame
+        """
+        if not content and not thinking:
+            return
+        if thinking:
+            self.block_container.add_thinking(thinking)
+        if content and self.block_container.generating_block:
+            self.block_container.generating_block.append_content(content)
+            self.remove_and_attach_thought()
+        self.main_stack.set_visible_child_name('content')
+
+        chat_element = self.get_ancestor(chat.Chat)
+        if chat_element:
+            vadjustment = chat_element.scrolledwindow.get_vadjustment()
+            if vadjustment.get_value() + 150 >= vadjustment.get_upper() - vadjustment.get_page_size():
+                GLib.idle_add(vadjustment.set_value, vadjustment.get_upper() - vadjustment.get_page_size())
 
     def finish_generation(self, response_metadata:str=None):
         chat_element = self.get_ancestor(chat.Chat)
@@ -373,10 +526,15 @@ class Message(Gtk.Box):
         if chat_element and root:
             chat_element.stop_message()
         self.dt = datetime.datetime.now()
-        buffer = self.block_container.generating_block.buffer
-        final_text = buffer.get_text(buffer.get_start_iter(), buffer.get_end_iter(), False)
-        GLib.idle_add(self.block_container.add_content, final_text)
-        GLib.idle_add(self.block_container.remove_generating_block)
+        if self.stream_buffer:
+            self.stream_buffer.finish()
+            self.stream_buffer = None
+
+        def finish_blocks():
+            self.block_container.add_blocks(self.block_container.generating_block.finish())
+            self.block_container.remove_generating_block()
+
+        GLib.idle_add(finish_blocks)
         GLib.idle_add(self.update_profile_picture)
         GLib.idle_add(send_notification)
         GLib.timeout_add(100, self.save)
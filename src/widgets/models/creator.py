@@ -152,8 +152,10 @@ class ModelCreatorDialog(Adw.Dialog):
             SQL.insert_or_update_model_character(model_name, base_model_preferences.get('character'))
 
         system_message = []
-        for attachment in self.context_attachment_container.get_content():
-            system_message.append('```{}\n{}\n```'.format(attachment.get('name'), attachment.get('content').strip()))
+        for attachment in list(self.context_attachment_container.container):
+            if attachment.pending: # Still extracting
+                continue
+            system_message.append('```{}\n{}\n```'.format(attachment.file_name, (attachment.file_content or '').strip()))
         context_buffer = self.context_el.get_buffer()
         system_message.append(context_buffer.get_text(context_buffer.get_start_iter(), context_buffer.get_end_iter(), False).replace('"', '\\"').strip())
         system_message = '\n\n'.join(system_message).strip()
@@ -18,6 +18,7 @@ class PreferencesDialog(Adw.PreferencesDialog):
     check_ollama_update_switch = Gtk.Template.Child()
     zoom_spin = Gtk.Template.Child()
     regenerate_after_edit = Gtk.Template.Child()
+    generate_chat_titles_switch = Gtk.Template.Child()
     image_size_spin = Gtk.Template.Child()
 
     #AUDIO
@@ -110,6 +111,7 @@ class PreferencesDialog(Adw.PreferencesDialog):
         self.check_ollama_update_switch.set_visible(CAN_SELF_MANAGE_OLLAMA)
         self.settings.bind('zoom', self.zoom_spin, 'value', Gio.SettingsBindFlags.DEFAULT)
         self.settings.bind('regenerate-after-edit', self.regenerate_after_edit, 'active', Gio.SettingsBindFlags.DEFAULT)
+        self.settings.bind('generate-chat-titles', self.generate_chat_titles_switch, 'active', Gio.SettingsBindFlags.DEFAULT)
         self.mic_group.set_visible(importlib.util.find_spec('whisper'))
 
         if sys.platform in ('win32', 'darwin'): # MacOS and Windows
@@ -3,7 +3,78 @@
 from gi.repository import GObject, GLib, Gio, Gtk
 from .. import activities, dialog, attachments, chat
 from ...sql_manager import Instance as SQL, generate_uuid
-import os, threading
+from ... import completion
+import os, threading, time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+def add_tool_attachment(bot_message, tool, arguments:dict, tool_response) -> None:
+    attachment_content = []
+
+    if len(arguments) > 0:
+        attachment_content += [
+            '## {}'.format(_('Arguments')),
+            '| {} | {} |'.format(_('Argument'), _('Value')),
+            '| --- | --- |'
+        ]
+        attachment_content += ['| {} | {} |'.format(k, v) for k, v in arguments.items()]
+
+    attachment_content += [
+        '## {}'.format(_('Result')),
+        str(tool_response)
+    ]
+
+    def add_attachment():
+        attachment = bot_message.add_attachment(
+            file_id = generate_uuid(),
+            name = tool.display_name,
+            attachment_type = 'tool',
+            content = '\n'.join(attachment_content)
+        )
+        SQL.insert_or_update_attachment(bot_message, attachment)
+    GLib.idle_add(add_attachment)
+
+class ToolCancelled(Exception):
+    pass
+
+def resolve(future:Future, value) -> None:
+    # Callbacks can fire after the tool was cancelled, those are ignored
+    if not future.done():
+        try:
+            future.set_result(value)
+        except Exception:
+            pass
+
+def wait_for(future:Future, bot_message, timeout:float=None, poll_interval:float=0.5):
+    """
+    Blocks the tool thread until future gets a result. Gives up when the chat
+    stops generating or when the timeout runs out, sleeping in between
+    instead of spinning.
+    """
+    chat_element = bot_message.get_ancestor(chat.Chat)
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        try:
+            return future.result(timeout=poll_interval)
+        except FutureTimeoutError:
+            if chat_element and not chat_element.busy:
+                future.cancel()
+                raise ToolCancelled('The response was stopped')
+            if deadline and time.monotonic() > deadline:
+                future.cancel()
+                raise ToolCancelled('The tool timed out')
+
+def run_tool_calls(calls:list, available_tools:dict, messages:list, bot_message) -> list:
+    """
+    Runs a batch of (name, arguments) tool calls and attaches their results
+    to the message, see completion.run_tool_calls
+    """
+    return completion.run_tool_calls(
+        calls,
+        available_tools,
+        messages,
+        bot_message,
+        lambda tool, arguments, tool_response: add_tool_attachment(bot_message, tool, arguments, tool_response)
+    )
 
 class Property:
     def __init__(self, name:str, description:str, var_type:str, required:bool=False):
@@ -21,6 +92,7 @@ class Base(GObject.Object):
     properties:list = []
 
     runnable:bool = True
+    parallel:bool = True # Can run next to other calls of the same tool
     required_libraries:list = []
 
     def get_metadata(self) -> dict:
@@ -75,10 +147,9 @@ class WebSearch(Base):
         )
     ]
 
-    def on_search_finish(self, md_text:str):
-        self.result = md_text
+    timeout:int = 180
 
-    def start_work(self, search_term:str, bot_message):
+    def start_work(self, search_term:str, bot_message, future:Future):
         page = activities.WebBrowser()
         chat_element = bot_message.get_ancestor(chat.Chat)
         activities.show_activity(
@@ -86,20 +157,19 @@ class WebSearch(Base):
             bot_message.get_root(),
             not chat_element or not chat_element.chat_id
         )
-        threading.Thread(target=page.automate_search, args=(self.on_search_finish, search_term, True), daemon=True).start()
+        threading.Thread(target=page.automate_search, args=(lambda md_text: resolve(future, md_text), search_term, True), daemon=True).start()
 
     def run(self, arguments, messages, bot_message) -> tuple:
-        self.result = 0 # 0=loading | "TEXT"=ok | None=error |
         search_term = arguments.get("search_term", "").strip()
         if not search_term:
             return "Error: Search term was not provided"
 
-        GLib.idle_add(self.start_work, search_term, bot_message)
-        while self.result == 0:
-            continue
+        future = Future()
+        GLib.idle_add(self.start_work, search_term, bot_message, future)
+        result = wait_for(future, bot_message, self.timeout)
 
-        if self.result:
-            return self.result
+        if result:
+            return result
         return "Error: No results found"
 
 class Terminal(Base):
@@ -126,25 +196,21 @@ class Terminal(Base):
     required_libraries:list = ['gi.repository.Vte']
 
     global_page = None
+    parallel:bool = False
 
     def run(self, arguments, messages, bot_message) -> str:
         if not arguments.get('command'):
             return "Error: No command was provided"
 
-        self.waiting_confirmation = True
-        self.current_command = ""
-
-        def dialog_confirmation(cmd:str, confirmation:bool):
-            self.current_command = cmd if confirmation else ""
-            self.waiting_confirmation = False
+        confirmation = Future()
 
         options = {
             _('Cancel'): {
-                'callback': lambda cmd: dialog_confirmation(cmd, False)
+                'callback': lambda cmd: resolve(confirmation, "")
             },
             _('Run'): {
                 'appearance': 'suggested',
-                'callback': lambda cmd: dialog_confirmation(cmd, True),
+                'callback': lambda cmd: resolve(confirmation, cmd),
                 'default': True
             }
         }
@@ -161,27 +227,23 @@ class Terminal(Base):
         )
         GLib.idle_add(entry_dialog.show, bot_message.get_root())
 
-        while self.waiting_confirmation:
-            continue
-
+        self.current_command = wait_for(confirmation, bot_message)
         if not self.current_command:
             return 'The user chose not to execute the command'
 
-        self.waiting_confirmation = True
-
+        finished = Future()
         if not self.global_page or not self.global_page.get_root():
             self.global_page = activities.Terminal(
                 language='auto',
                 code_getter=lambda: ';'.join(['clear', self.current_command]),
-                close_callback=lambda: setattr(self, 'waiting_confirmation', False)
+                close_callback=lambda: resolve(self.finished, True)
             )
             chat_element = bot_message.get_ancestor(chat.Chat)
             GLib.idle_add(activities.show_activity, self.global_page, bot_message.get_root(), not chat_element or not chat_element.chat_id)
+        self.finished = finished
 
         self.global_page.run()
-
-        while self.waiting_confirmation:
-            continue
+        wait_for(finished, bot_message)
 
         result_text = self.global_page.get_text().strip('\n').split('\n')[:-1]
 
@@ -199,33 +261,32 @@ class BackgroundRemover(Base):
 
     required_libraries:list = ['rembg']
 
-    def get_latest_image(self, messages, root) -> str:
-        messages.reverse()
-        for message in messages:
+    parallel:bool = False
+
+    def get_latest_image(self, messages, bot_message) -> str:
+        for message in reversed(messages):
             if len(message.get('images', [])) > 0:
                 return message.get('images')[0]
-        self.image_requested = 0
+        root = bot_message.get_root()
+        image_requested = Future()
 
         def on_attachment(file:Gio.File, remove_original:bool=False):
             if not file:
-                self.image_requested = None
+                resolve(image_requested, None)
                 return
-            self.image_requested = attachments.extract_image(file.get_path(), root.settings.get_value('max-image-size').unpack())
+            resolve(image_requested, attachments.extract_image(file.get_path(), root.settings.get_value('max-image-size').unpack()))
 
         file_filter = Gtk.FileFilter()
         file_filter.add_pixbuf_formats()
-        dialog.simple_file(
+        GLib.idle_add(lambda: dialog.simple_file(
             parent = root,
             file_filters = [file_filter],
             callback = on_attachment
-        )
-
-        while self.image_requested == 0:
-            continue
+        ))
 
-        return self.image_requested
+        return wait_for(image_requested, bot_message)
 
-    def on_save(self, data:str, bot_message):
+    def on_save(self, data:str, bot_message, finished:Future):
         if data:
             attachment = bot_message.add_attachment(
                 file_id=generate_uuid(),
@@ -234,21 +295,16 @@ class BackgroundRemover(Base):
                 content=data
             )
             SQL.insert_or_update_attachment(bot_message, attachment)
-            self.status = 1
-        else:
-            self.status = 2
-
-    def on_close(self):
-        self.status = 2
+        resolve(finished, bool(data))
 
     def run(self, arguments, messages, bot_message) -> tuple:
         threading.Thread(target=bot_message.update_message, args=(_('Loading Image...') + '\n',), daemon=True).start()
-        image_b64 = self.get_latest_image(messages, bot_message.get_root())
+        image_b64 = self.get_latest_image(messages, bot_message)
         if image_b64:
-            self.status = 0 # 0 waiting, 1 finished, 2 canceled / empty image
+            finished = Future()
             page = activities.BackgroundRemover(
-                save_func=lambda data, bm=bot_message: self.on_save(data, bm),
-                close_callback=self.on_close
+                save_func=lambda data, bm=bot_message: self.on_save(data, bm, finished),
+                close_callback=lambda: resolve(finished, False)
             )
             chat_element = bot_message.get_ancestor(chat.Chat)
             GLib.idle_add(
@@ -259,10 +315,7 @@ class BackgroundRemover(Base):
             )
             page.load_image(image_b64)
 
-            while self.status == 0:
-                continue
-
-            if self.status == 1:
+            if wait_for(finished, bot_message):
                 return "Background removed successfully"
             else:
                 return "An error occurred"
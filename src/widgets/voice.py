@@ -305,6 +305,7 @@ class PodcastDialog(Adw.Dialog):
         # run in separate thread
         if len(list(self.chat.container)) == 0: #maybe not loaded
             self.chat.load_messages()
+        self.chat.load_older_messages(-1)
 
         self.default_index = self.settings.get_value('tts-model').unpack()
 
@@ -30,6 +30,7 @@ from gi.repository import Adw, Gtk, Gdk, GLib, GtkSource, Gio, Spelling
 
 from .sql_manager import generate_uuid, generate_numbered_name, prettify_model_name, Instance as SQL
 from . import widgets as Widgets
+from . import images
 from .constants import data_dir, source_dir, cache_dir, is_ollama_installed, IN_FLATPAK
 
 logger = logging.getLogger(__name__)
@@ -201,11 +202,11 @@ class AlpacaWindow(Adw.ApplicationWindow):
 
     @Gtk.Template.Callback()
     def chat_search_changed(self, entry):
-        self.get_chat_list_page().on_search(entry.get_text())
+        self.get_chat_list_page().on_search(entry.get_text(), self.chat_search_scheduler)
 
     @Gtk.Template.Callback()
     def message_search_changed(self, entry, current_chat=None):
-        self.chat_bin.get_child().on_search(entry.get_text())
+        self.chat_bin.get_child().on_search(entry.get_text(), self.message_search_scheduler)
 
     def send_message(self, mode:int=0, available_tools:dict={}): #mode 0=user 1=system
         buffer = self.global_footer.get_buffer()
@@ -243,6 +244,8 @@ class AlpacaWindow(Adw.ApplicationWindow):
         current_chat.add_message(m_element)
 
         for old_attachment in list(self.global_footer.attachment_container.container):
+            if old_attachment.pending: # Still extracting, stays for the next message
+                continue
             attachment = m_element.add_attachment(
                 file_id = generate_uuid(),
                 name = old_attachment.file_name,
@@ -344,6 +347,8 @@ class AlpacaWindow(Adw.ApplicationWindow):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.chat_search_scheduler = Widgets.chat.SearchScheduler()
+        self.message_search_scheduler = Widgets.chat.SearchScheduler()
 
         actions = [[{
             'label': _('New Chat'),
@@ -419,6 +424,7 @@ class AlpacaWindow(Adw.ApplicationWindow):
         root_folder = Widgets.chat.Folder(show_bar=False)
         self.chat_list_navigationview.add(root_folder)
         root_folder.update()
+        SQL.start_maintenance(tasks=(images.remove_unused_previews,))
 
         if self.get_application().args.new_chat:
             self.get_chat_list_page().new_chat(self.get_application().args.new_chat)
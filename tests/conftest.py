@@ -0,0 +1,51 @@
+# conftest.py
+"""
+Loads src/ as the 'alpaca' package the way meson installs it, with the
+data, config and cache directories inside a temporary folder.
+"""
+
+import os, sys, types, gettext, tempfile, threading
+from http.server import ThreadingHTTPServer
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+TEMP_DIR = tempfile.mkdtemp(prefix='alpaca-tests-')
+
+for variable in ('XDG_DATA_HOME', 'XDG_CONFIG_HOME', 'XDG_CACHE_HOME'):
+    os.environ[variable] = os.path.join(TEMP_DIR, variable.lower())
+gettext.install('alpaca')
+
+package = types.ModuleType('alpaca')
+package.__path__ = [SRC_DIR]
+sys.modules.setdefault('alpaca', package)
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    Fresh alpaca.db for the test
+    """
+    from alpaca.sql_manager import Instance, SQLiteConnection, connection_manager
+    previous_path = SQLiteConnection.sql_path
+    SQLiteConnection.sql_path = str(tmp_path / 'alpaca.db')
+    Instance.initialize()
+    yield Instance
+    connection_manager.close_all()
+    SQLiteConnection.sql_path = previous_path
+
+@pytest.fixture
+def serve():
+    """
+    Starts a local HTTP server for a handler class, returns its base url
+    """
+    servers = []
+
+    def start(handler_class) -> str:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,102 @@
+# test_block_parser.py
+"""
+BlockTokenizer against parse_blocks() on the whole response
+"""
+
+import random
+import pytest
+
+from alpaca.block_parser import parse_blocks, BlockTokenizer
+
+CORPUS = (
+    "Hello! How can I help you today?",
+    "Sure, here is a function:\n\n```python\ndef add(a, b):\n    return a + b\n```\n\nCall it with `add(1, 2)`.",
+    "# Heading\n\nSome **bold** text and *italics*.\n\n## Sub heading\n\n- one\n- two\n- three\n",
+    "| Name | Age |\n|------|-----|\n| Ana | 31 |\n| Bob | 27 |\n\nThat's the table.",
+    "Before the table\n| a | b |\n| :-- | --: |\n| 1 | 2 |\n\n\n| 3 | 4 |\nAfter the table",
+    "The area is $A = \\pi r^2$ and the price is 5 dollars.\n\nDisplay math:\n\n$$\n\\int_0^1 x^2 dx = \\frac{1}{3}\n$$\n\nDone.",
+    "Bracket math\n\\[\n\\sum_{i=1}^{n} i = \\frac{n(n+1)}{2}\n\\]\nand text after it.",
+    "$$\nx = 1\n\ny = 2\n$$\nA display block with a blank line inside.",
+    "Look at this ![a cat](https://example.com/cat.png) picture\nand ![broken]() one.",
+    "Intro\n\n---\n\nAfter a separator\n---\nAnother one",
+    "```latex\n\\begin{aligned} a &= b \\\\ c &= d \\end{aligned}\n```\nRendered above.",
+    "  ```bash\n  ls -la\n  ```\nIndented fence.",
+    "```\nplain block without a language\n```\n```js\nconsole.log('back to back')\n```",
+    "Unclosed fence at the end\n\n```python\nprint('never closed')",
+    "A table with no rows\n| a | b |\n|---|---|\nthen text",
+    "<think>\nLet me think about it.\n</think>\n\nThe answer is 42.",
+    "<think>\nPlan:\n\n```python\nx = 1\n```\n\n| a |\n|---|\n| 1 |\n</think>\nThe answer is $x$.",
+    "<|begin_of_thought|>\nHmm\n\n<|end_of_thought|>\nDone\n<think>\nnever closed",
+    "Text right before a fence```python\nx = 1\n```\nafter",
+    "```\n```\nAn empty fence pair is text",
+    "Trailing spaces   \n\n\n\nMany blank lines\n\n",
+    "Mixed: $\\alpha$, ![img](https://example.com/a.png), and\n\n| x |\n|---|\n| 1 |",
+    "1. First step\n2. Second step\n\n```sql\nSELECT *\nFROM chat\n\nWHERE id = 1;\n```\n3. Third step",
+    "Price is $$5$$ today",
+    "| only | header |\n\n|---|---|\n| blank | between |",
+)
+
+def normalize(descriptors) -> list:
+    """
+    Adjacent text descriptors make up the same Text block, which strips its
+    content
+    """
+    result = []
+    for descriptor in descriptors:
+        if descriptor[0] == 'text' and result and result[-1][0] == 'text':
+            result[-1] = ('text', result[-1][1] + ''.join(descriptor[1]))
+        elif descriptor[0] == 'text':
+            result.append(('text', ''.join(descriptor[1])))
+        else:
+            result.append(descriptor)
+    return [('text', descriptor[1].strip()) if descriptor[0] == 'text' else descriptor for descriptor in result if descriptor[0] != 'text' or descriptor[1].strip()]
+
+def stream(content:str, sizes) -> list:
+    tokenizer = BlockTokenizer()
+    descriptors = []
+    index = 0
+    for size in sizes:
+        descriptors.extend(tokenizer.feed(content[index:index + size]))
+        index += size
+    descriptors.extend(tokenizer.feed(content[index:]))
+    descriptors.extend(tokenizer.finish())
+    return descriptors
+
+@pytest.mark.parametrize('content', CORPUS)
+def test_matches_parse_blocks(content):
+    expected = normalize(parse_blocks(content))
+    assert normalize(stream(content, ())) == expected
+    assert normalize(stream(content, [1] * len(content))) == expected
+    lines = content.split('\n')
+    assert normalize(stream(content, [len(line) + 1 for line in lines])) == expected
+
+    generator = random.Random(content)
+    for _ in range(50):
+        sizes = [generator.randint(1, 12) for _ in range(len(content))]
+        assert normalize(stream(content, sizes)) == expected
+
+def test_blocks_are_emitted_once_closed():
+    tokenizer = BlockTokenizer()
+    assert tokenizer.feed('Some text\n') == [('text', ('Some text\n',))]
+    assert tokenizer.feed('```python\nx = 1\n') == []
+    assert tokenizer.get_pending() == '```python\nx = 1\n'
+    assert tokenizer.feed('```\n') == [('code', 'x = 1', 'python')]
+    assert tokenizer.get_pending() == '\n'
+    assert tokenizer.feed('| a | b |\n|---|---|\n| 1 | 2 |\n') == [('text', ('\n',))]
+    assert tokenizer.feed('done') == []
+    assert tokenizer.feed('\n') == [('table', '| a | b |\n|---|---|\n| 1 | 2 |\n'), ('text', ('done\n',))]
+    assert tokenizer.finish() == []
+
+def test_open_display_math_holds_the_paragraph():
+    tokenizer = BlockTokenizer()
+    assert tokenizer.feed('$$\n\\frac{1}{2}\n\n') == []
+    assert tokenizer.feed('= 0.5\n$$\n') == []
+    assert tokenizer.feed('\n') == [('latex', '\\frac{1}{2}\n\n= 0.5'), ('text', ('\n',))]
+
+def test_think_block_is_held_until_it_closes():
+    tokenizer = BlockTokenizer()
+    assert tokenizer.feed('<think>\nFirst idea\n\n```python\nx = 1\n') == []
+    assert tokenizer.feed('```\nSecond idea\n') == []
+    assert tokenizer.get_pending() == '<think>\nFirst idea\n\n```python\nx = 1\n```\nSecond idea\n'
+    assert tokenizer.feed('</think>\n') == [('text', ('<think>\nFirst idea\n\n',)), ('code', 'x = 1', 'python'), ('text', ('\nSecond idea\n</think>\n',))]
+    assert tokenizer.feed('Answer\n') == [('text', ('Answer\n',))]
@@ -0,0 +1,201 @@
+# test_completion.py
+"""
+Streamed completions against a stand-in OpenAI compatible SSE server
+"""
+
+import json, threading
+from http.server import BaseHTTPRequestHandler
+import pytest
+
+openai = pytest.importorskip('openai')
+
+from alpaca import completion
+
+MODEL = 'stand-in-chat'
+
+def delta_chunk(delta:dict, finish_reason:str=None) -> dict:
+    return {
+        'id': 'chatcmpl-test',
+        'object': 'chat.completion.chunk',
+        'created': 0,
+        'model': MODEL,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+    }
+
+def tool_call_delta(index:int, call_id:str=None, name:str=None, arguments:str='') -> dict:
+    call = {'index': index, 'function': {'arguments': arguments}}
+    if call_id:
+        call['id'] = call_id
+        call['type'] = 'function'
+        call['function']['name'] = name
+    return delta_chunk({'tool_calls': [call]})
+
+class CompletionHandler(BaseHTTPRequestHandler):
+    turns = [] # Chunks to stream, one list per request
+    requests = []
+
+    def do_POST(self):
+        assert self.path == '/v1/chat/completions'
+        self.requests.append(json.loads(self.rfile.read(int(self.headers.get('Content-Length')))))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for chunk in self.turns.pop(0):
+            self.wfile.write('data: {}\n\n'.format(json.dumps(chunk)).encode())
+            self.wfile.flush()
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def log_message(self, *args):
+        pass
+
+class StandInMessage:
+    def __init__(self):
+        self.content = ''
+        self.thinking = ''
+
+    def update_message(self, content:str):
+        self.content += content
+
+    def update_thinking(self, content:str):
+        self.thinking += content
+
+class StandInTool:
+    def __init__(self, name:str, response:str, parallel:bool=True, barrier:threading.Barrier=None):
+        self.name = name
+        self.response = response
+        self.parallel = parallel
+        self.barrier = barrier
+        self.calls = []
+
+    def run(self, arguments:dict, messages:list, bot_message) -> str:
+        self.calls.append(arguments)
+        if self.barrier:
+            # Only passes if the other call runs at the same time
+            self.barrier.wait(timeout=5)
+        return self.response
+
+@pytest.fixture
+def client(serve):
+    CompletionHandler.turns = []
+    CompletionHandler.requests = []
+    return openai.OpenAI(base_url='{}/v1'.format(serve(CompletionHandler)), api_key='test', max_retries=0)
+
+def converse(client, messages:list, available_tools:dict, bot_message) -> list:
+    """
+    Same loop as openai_instances.BaseInstance.generate_response, returns the
+    attached tool results
+    """
+    attached = []
+    while True:
+        streamed = completion.StreamedCompletion()
+        for chunk in client.chat.completions.create(model=MODEL, messages=messages, stream=True):
+            content, reasoning = streamed.add_chunk(chunk)
+            if reasoning:
+                bot_message.update_thinking(reasoning)
+            if content:
+                bot_message.update_message(content)
+        if not streamed.tool_calls:
+            return attached
+        messages.append(streamed.get_assistant_message())
+        tool_responses = completion.run_tool_calls(
+            streamed.get_calls(),
+            available_tools,
+            messages,
+            bot_message,
+            lambda tool, arguments, tool_response: attached.append((tool.name, arguments, tool_response))
+        )
+        messages.extend(streamed.get_tool_messages(tool_responses))
+
+def test_tool_call_arguments_split_across_deltas(client):
+    CompletionHandler.turns = [
+        [
+            delta_chunk({'role': 'assistant', 'content': None}),
+            tool_call_delta(0, 'call_1', 'get_weather'),
+            tool_call_delta(0, arguments='{"ci'),
+            tool_call_delta(0, arguments='ty": "Par'),
+            tool_call_delta(0, arguments='is", "unit'),
+            tool_call_delta(0, arguments='": "C"}'),
+            delta_chunk({}, 'tool_calls')
+        ],
+        [delta_chunk({'content': 'It is '}), delta_chunk({'content': 'sunny.'}), delta_chunk({}, 'stop')]
+    ]
+    weather = StandInTool('get_weather', '21°C and sunny')
+    message = StandInMessage()
+    messages = [{'role': 'user', 'content': 'Weather in Paris?'}]
+
+    attached = converse(client, messages, {'get_weather': weather}, message)
+
+    assert weather.calls == [{'city': 'Paris', 'unit': 'C'}]
+    assert attached == [('get_weather', {'city': 'Paris', 'unit': 'C'}, '21°C and sunny')]
+    assert message.content == 'It is sunny.'
+    sent = CompletionHandler.requests[1]['messages']
+    assert sent[1]['tool_calls'] == [{
+        'id': 'call_1',
+        'type': 'function',
+        'function': {'name': 'get_weather', 'arguments': '{"city": "Paris", "unit": "C"}'}
+    }]
+    assert sent[2] == {'role': 'tool', 'tool_call_id': 'call_1', 'content': '21°C and sunny'}
+
+def test_parallel_tool_calls(client):
+    CompletionHandler.turns = [
+        [
+            tool_call_delta(0, 'call_a', 'search'),
+            tool_call_delta(1, 'call_b', 'fetch'),
+            tool_call_delta(1, arguments='{"url": "https://example.com"}'),
+            tool_call_delta(0, arguments='{"query": '),
+            tool_call_delta(0, arguments='"alpaca"}'),
+            delta_chunk({}, 'tool_calls')
+        ],
+        [delta_chunk({'content': 'Done.'}), delta_chunk({}, 'stop')]
+    ]
+    barrier = threading.Barrier(2)
+    search = StandInTool('search', 'search results', barrier=barrier)
+    fetch = StandInTool('fetch', 'page content', barrier=barrier)
+    messages = [{'role': 'user', 'content': 'Look it up'}]
+
+    converse(client, messages, {'search': search, 'fetch': fetch}, StandInMessage())
+
+    assert search.calls == [{'query': 'alpaca'}]
+    assert fetch.calls == [{'url': 'https://example.com'}]
+    sent = CompletionHandler.requests[1]['messages']
+    assert [call['id'] for call in sent[1]['tool_calls']] == ['call_a', 'call_b']
+    assert sent[2:] == [
+        {'role': 'tool', 'tool_call_id': 'call_a', 'content': 'search results'},
+        {'role': 'tool', 'tool_call_id': 'call_b', 'content': 'page content'}
+    ]
+
+def test_calls_to_sequential_tools_keep_their_order(client):
+    CompletionHandler.turns = [
+        [
+            tool_call_delta(0, 'call_1', 'ask', '{"question": "first"}'),
+            tool_call_delta(1, 'call_2', 'ask', '{"question": "second"}'),
+            tool_call_delta(2, 'call_3', 'missing', '{}'),
+            delta_chunk({}, 'tool_calls')
+        ],
+        [delta_chunk({'content': 'Ok.'}), delta_chunk({}, 'stop')]
+    ]
+    ask = StandInTool('ask', 'yes', parallel=False)
+    messages = [{'role': 'user', 'content': 'Ask me'}]
+
+    converse(client, messages, {'ask': ask}, StandInMessage())
+
+    assert ask.calls == [{'question': 'first'}, {'question': 'second'}]
+    assert messages[-1] == {'role': 'tool', 'tool_call_id': 'call_3', 'content': 'Error: Tool "missing" is not available'}
+
+def test_reasoning_deltas(client):
+    CompletionHandler.turns = [[
+        delta_chunk({'role': 'assistant', 'reasoning_content': 'The user '}),
+        delta_chunk({'reasoning_content': 'greets me.'}),
+        delta_chunk({'reasoning': ' Answer briefly.'}),
+        delta_chunk({'content': 'Hello'}),
+        delta_chunk({'content': '!'}),
+        delta_chunk({}, 'stop')
+    ]]
+    message = StandInMessage()
+
+    attached = converse(client, [{'role': 'user', 'content': 'Hi'}], {}, message)
+
+    assert attached == []
+    assert message.thinking == 'The user greets me. Answer briefly.'
+    assert message.content == 'Hello!'
+    assert len(CompletionHandler.requests) == 1
@@ -0,0 +1,61 @@
+# test_images.py
+"""
+Preview cache on disk
+"""
+
+import os, io, random
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+
+from alpaca import images
+from alpaca.sql_manager import SQLiteConnection
+
+def make_image(seed:int) -> bytes:
+    """
+    Noise bigger than the preview size, so the preview gets cached
+    """
+    generator = random.Random(seed)
+    img = Image.frombytes('RGB', (1600, 600), bytes(generator.getrandbits(8) for _ in range(1600 * 600 * 3)))
+    with io.BytesIO() as output:
+        img.save(output, format='PNG')
+        return output.getvalue()
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, 'CACHE_DIR', str(tmp_path / 'thumbnails'))
+    return tmp_path / 'thumbnails'
+
+def test_cache_keeps_recently_used_previews(cache, monkeypatch):
+    first, second, third = (make_image(seed) for seed in range(3))
+    images.get_preview(first, 'first')
+    images.get_preview(second, 'second')
+    sizes = {name: os.path.getsize(cache / name) for name in ('first', 'second')}
+    monkeypatch.setattr(images, 'MAX_CACHE_SIZE', sizes['first'] + sizes['second'] + sizes['second'] // 2)
+
+    os.utime(cache / 'first', (1, 1))
+    os.utime(cache / 'second', (2, 2))
+    # Reading marks it as used, so second is the oldest now
+    assert images.get_preview(first, 'first')
+    images.get_preview(third, 'third')
+
+    assert sorted(os.listdir(cache)) == ['first', 'third']
+
+def test_previews_of_dropped_blobs_are_removed(cache, database):
+    kept, dropped, pending = (make_image(seed) for seed in range(3))
+    with SQLiteConnection() as c:
+        kept_id = database.store_blob(c, kept)
+        dropped_id = database.store_blob(c, dropped)
+        c.cursor.executemany(
+            "INSERT INTO attachment (id, message_id, type, name, content, blob_id) VALUES (?, 'message', 'image', 'image.png', '', ?)",
+            [('kept', kept_id), ('dropped', dropped_id)]
+        )
+    for data, blob_id in ((kept, kept_id), (dropped, dropped_id), (pending, 'pending')):
+        images.get_preview(data, blob_id)
+
+    with SQLiteConnection() as c:
+        c.cursor.execute("DELETE FROM attachment WHERE id='dropped'")
+    assert database.get_blob_ids([kept_id, dropped_id]) == {kept_id}
+
+    images.remove_unused_previews()
+    assert os.listdir(cache) == [kept_id]
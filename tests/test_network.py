@@ -0,0 +1,105 @@
+# test_network.py
+"""
+Shared connection pools against local servers
+"""
+
+import time, threading
+from http.server import BaseHTTPRequestHandler
+import pytest
+
+from alpaca import network
+
+class Handler(BaseHTTPRequestHandler):
+    def respond(self, headers:dict={}):
+        self.send_response(200)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+class BlockingHandler(Handler):
+    active = 0
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def do_GET(self):
+        with self.lock:
+            BlockingHandler.active += 1
+        self.release.wait(timeout=10)
+        self.respond()
+
+class CookieHandler(Handler):
+    cookies = []
+
+    def do_GET(self):
+        self.cookies.append(self.headers.get('Cookie'))
+        self.respond({'Set-Cookie': 'session=abc; Path=/'})
+
+def test_connection_limit_is_per_host(serve):
+    httpx = pytest.importorskip('httpx')
+    BlockingHandler.active = 0
+    BlockingHandler.release.clear()
+    busy_host = serve(BlockingHandler)
+    other_host = serve(CookieHandler)
+    client = httpx.Client(transport=network.get_transport(), timeout=httpx.Timeout(10, pool=0.2))
+
+    threads = [threading.Thread(target=client.get, args=(busy_host,)) for _ in range(network.MAX_CONNECTIONS_PER_HOST)]
+    try:
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while BlockingHandler.active < network.MAX_CONNECTIONS_PER_HOST and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert BlockingHandler.active == network.MAX_CONNECTIONS_PER_HOST
+
+        with pytest.raises(httpx.PoolTimeout):
+            client.get(busy_host)
+        # A busy host doesn't take the connections of the others
+        assert client.get(other_host).status_code == 200
+    finally:
+        BlockingHandler.release.set()
+        for thread in threads:
+            thread.join()
+
+class ProxyHandler(Handler):
+    paths = []
+
+    def do_GET(self):
+        # Proxied requests carry the absolute url
+        self.paths.append(self.path)
+        self.respond()
+
+def test_transport_uses_environment_proxies(serve, monkeypatch):
+    httpx = pytest.importorskip('httpx')
+    ProxyHandler.paths = []
+    CookieHandler.cookies = []
+    proxy = serve(ProxyHandler)
+    direct_host = serve(CookieHandler)
+    for variable in ('HTTP_PROXY', 'HTTPS_PROXY', 'ALL_PROXY', 'NO_PROXY'):
+        monkeypatch.delenv(variable, raising=False)
+        monkeypatch.delenv(variable.lower(), raising=False)
+    monkeypatch.setenv('HTTP_PROXY', proxy)
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1')
+    monkeypatch.setattr(network, 'transports', {})
+    client = httpx.Client(transport=network.get_transport(), timeout=5)
+
+    assert client.get('http://alpaca.invalid/api/tags').status_code == 200
+    assert ProxyHandler.paths == ['http://alpaca.invalid/api/tags']
+    # NO_PROXY hosts skip the proxy
+    assert client.get(direct_host).status_code == 200
+    assert len(CookieHandler.cookies) == 1
+    assert ProxyHandler.paths == ['http://alpaca.invalid/api/tags']
+
+def test_session_keeps_no_cookies(serve):
+    pytest.importorskip('requests')
+    CookieHandler.cookies = []
+    host = serve(CookieHandler)
+
+    assert network.get(host).status_code == 200
+    assert network.get(host).status_code == 200
+    assert CookieHandler.cookies == [None, None]
+    assert len(network.get_session().cookies) == 0
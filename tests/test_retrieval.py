@@ -0,0 +1,131 @@
+# test_retrieval.py
+"""
+Embedding index against a stand-in Ollama /api/embed server
+"""
+
+import json, hashlib, threading
+from http.server import BaseHTTPRequestHandler
+import pytest
+
+np = pytest.importorskip('numpy')
+ollama = pytest.importorskip('ollama')
+
+from alpaca import retrieval
+from alpaca.sql_manager import SQLiteConnection
+
+MODEL = 'stand-in-embed'
+DIMENSIONS = 64
+
+def embed_text(text:str) -> list:
+    """
+    Bag of words vector, texts sharing words are close to each other
+    """
+    vector = [0.0] * DIMENSIONS
+    for word in text.lower().split():
+        digest = hashlib.sha256(word.strip('.,?!').encode()).digest()
+        vector[digest[0] % DIMENSIONS] += 1.0 if digest[1] % 2 else -1.0
+    return vector
+
+class EmbedHandler(BaseHTTPRequestHandler):
+    batches = []
+    lock = threading.Lock()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length'))))
+        assert self.path == '/api/embed'
+        texts = request.get('input')
+        texts = [texts] if isinstance(texts, str) else texts
+        with self.lock:
+            self.batches.append(len(texts))
+        body = json.dumps({
+            'model': request.get('model'),
+            'embeddings': [embed_text(text) for text in texts]
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def embed(serve, database, tmp_path, monkeypatch):
+    monkeypatch.setattr(retrieval, 'EMBEDDINGS_DIR', str(tmp_path / 'embeddings'))
+    monkeypatch.setattr(retrieval, 'indexes', {})
+    EmbedHandler.batches = []
+    client = ollama.Client(host=serve(EmbedHandler))
+    # Same call BaseInstance.get_embeddings makes
+    return lambda model, texts: client.embed(model=model, input=texts, truncate=True).embeddings
+
+def add_messages(chat_id:str, contents:list) -> None:
+    with SQLiteConnection() as c:
+        c.cursor.execute("INSERT OR IGNORE INTO chat (id, name) VALUES (?, ?)", (chat_id, chat_id))
+        c.cursor.executemany(
+            "INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, 'user', '', '2025/01/01 00:00:00', ?)",
+            [('{}-{}'.format(chat_id, i), chat_id, content) for i, content in enumerate(contents)]
+        )
+
+def get_rows() -> dict:
+    with SQLiteConnection() as c:
+        return {row[0]: row[1] for row in c.cursor.execute("SELECT source_id, position FROM embedding WHERE model=?", (MODEL,)).fetchall()}
+
+def assert_vectors_match(rows:dict) -> None:
+    index = retrieval.get_index(MODEL)
+    vectors = index.get_vectors()
+    for source_id, position in rows.items():
+        expected = np.asarray(embed_text(retrieval.SQL.get_source_content('message', source_id)), dtype=np.float32)
+        expected /= np.linalg.norm(expected)
+        assert np.allclose(vectors[position].astype(np.float32), expected, atol=1e-2), source_id
+
+def test_chunks_are_embedded_in_batches(embed):
+    add_messages('old', ['note number {} about cooking pasta'.format(i) for i in range(70)])
+    retrieval.index_history(embed, MODEL, 'current')
+
+    assert EmbedHandler.batches == [32, 32, 6]
+    assert len(get_rows()) == 70
+    assert len(retrieval.get_index(MODEL).get_vectors()) == 70
+
+def test_retrieves_other_chats_only(embed):
+    add_messages('old', ['the server outage happened on tuesday night', 'we had pasta for lunch'])
+    add_messages('current', ['when did the server outage happen'])
+    retrieval.index_history(embed, MODEL, 'current')
+
+    results = retrieval.retrieve(embed, MODEL, 'current', 'when did the server outage happen')
+    assert results[0] == 'the server outage happened on tuesday night'
+    assert 'when did the server outage happen' not in results
+
+def test_edits_and_deletions_are_reindexed(embed):
+    add_messages('old', ['first message about gardens', 'second message about boats', 'third message about trains'])
+    retrieval.index_history(embed, MODEL, 'current')
+    EmbedHandler.batches = []
+
+    with SQLiteConnection() as c:
+        c.cursor.execute("UPDATE message SET content='second message about planes' WHERE id='old-1'")
+        c.cursor.execute("DELETE FROM message WHERE id='old-2'")
+    assert set(get_rows()) == {'old-0'}
+
+    retrieval.index_history(embed, MODEL, 'current')
+    assert EmbedHandler.batches == [1]
+    assert set(get_rows()) == {'old-0', 'old-1'}
+    assert_vectors_match(get_rows())
+
+    results = retrieval.retrieve(embed, MODEL, 'current', 'message about trains')
+    assert 'third message about trains' not in results
+
+def test_compaction_remaps_positions(embed):
+    add_messages('old', ['message {} about topic {}'.format(i, i * 7) for i in range(10)])
+    retrieval.index_history(embed, MODEL, 'current')
+    with SQLiteConnection() as c:
+        c.cursor.execute("DELETE FROM message WHERE id IN ('old-0', 'old-2', 'old-3', 'old-5', 'old-6', 'old-8')")
+        # A row whose vector never made it to the file
+        c.cursor.execute("UPDATE embedding SET position=50 WHERE source_id='old-7'")
+
+    retrieval.get_index(MODEL).compact()
+
+    rows = get_rows()
+    assert set(rows) == {'old-1', 'old-4', 'old-9'}
+    assert sorted(rows.values()) == [0, 1, 2]
+    assert len(retrieval.get_index(MODEL).get_vectors()) == 3
+    assert_vectors_match(rows)
@@ -0,0 +1,95 @@
+# test_sql_manager.py
+"""
+Idle maintenance of the database
+"""
+
+import pytest
+
+from alpaca.sql_manager import Instance, SQLiteConnection, connection_manager
+
+def run_check(database) -> bool:
+    started = database.check_maintenance()
+    if started:
+        database.maintenance_thread.join(timeout=10)
+    return started
+
+def test_maintenance_runs_once_per_idle_period(database, monkeypatch):
+    monkeypatch.setattr(database, 'maintenance_idle_time', 0)
+    monkeypatch.setattr(database, 'maintenance_last_run', 0.0)
+
+    assert run_check(database)
+    worker = database.maintenance_thread.ident
+    # The worker closed its pooled connection
+    assert worker not in connection_manager.connections
+    # Still idle, its own statements don't start another period
+    assert not run_check(database)
+    assert not run_check(database)
+
+    with SQLiteConnection() as c:
+        c.cursor.execute("SELECT COUNT(*) FROM chat").fetchone()
+    assert run_check(database)
+    assert not run_check(database)
+
+def test_maintenance_waits_for_idle(database, monkeypatch):
+    monkeypatch.setattr(database, 'maintenance_idle_time', 3600)
+    monkeypatch.setattr(database, 'maintenance_last_run', 0.0)
+    assert not run_check(database)
+
+def test_maintenance_runs_its_tasks(database, monkeypatch):
+    monkeypatch.setattr(database, 'maintenance_idle_time', 0)
+    monkeypatch.setattr(database, 'maintenance_last_run', 0.0)
+    ran = []
+    monkeypatch.setattr(database, 'maintenance_tasks', (lambda: ran.append(1),))
+    assert run_check(database)
+    assert ran == [1]
+
+@pytest.mark.parametrize('failing', ['migrate_search_index', 'migrate_embeddings'])
+def test_failed_migration_leaves_nothing_behind(failing, tmp_path, monkeypatch):
+    migration = getattr(Instance, failing)
+
+    def fail_midway(c):
+        migration(c)
+        raise RuntimeError('migration failed')
+
+    monkeypatch.setattr(Instance, failing, fail_midway)
+    monkeypatch.setattr(SQLiteConnection, 'sql_path', str(tmp_path / 'alpaca.db'))
+    try:
+        with pytest.raises(RuntimeError):
+            Instance.initialize()
+        with SQLiteConnection() as c:
+            version = c.cursor.execute("PRAGMA user_version").fetchone()[0]
+            triggers = {row[0] for row in c.cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger'").fetchall()}
+            tables = {row[0] for row in c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+    finally:
+        connection_manager.close_all()
+
+    if failing == 'migrate_search_index':
+        assert version == 2
+        assert not triggers
+        assert 'message_search' not in tables
+    else:
+        assert version == 4
+        assert not any(name.startswith('embedding_') for name in triggers)
+        assert 'attachment_blob_delete' in triggers
+
+def test_paging_cursor_survives_renumbered_rowids(database):
+    # Two messages share a date_time, their ids keep them in order
+    rows = [('{:02d}'.format(index), '2025/01/01 10:00:{:02d}'.format(index // 2)) for index in range(7)]
+    with SQLiteConnection() as c:
+        c.cursor.executemany(
+            "INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, 'chat', 'user', NULL, ?, '')",
+            rows
+        )
+
+    page = database.get_messages_page('chat', limit=3)
+    assert [message[0] for message in page] == ['04', '05', '06']
+    cursor = (page[0][3], page[0][0])
+
+    # What VACUUM is allowed to do to tables without an INTEGER PRIMARY KEY
+    with SQLiteConnection() as c:
+        c.cursor.execute("UPDATE message SET rowid = 100 - rowid")
+
+    page = database.get_messages_page('chat', cursor[0], 3, cursor[1])
+    assert [message[0] for message in page] == ['01', '02', '03']
+    page = database.get_messages_page('chat', page[0][3], -1, page[0][0])
+    assert [message[0] for message in page] == ['00']